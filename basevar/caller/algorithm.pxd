@@ -1,5 +1,5 @@
 
-cdef extern from "stdlib.h":
+cdef extern from "stdlib.h" nogil:
     void *malloc(size_t)
     void *memcpy(void *dst, void *src, size_t length)
     void free(void *)
@@ -7,14 +7,36 @@ cdef extern from "stdlib.h":
 cdef extern from "include/em.c":
     pass
 
-cdef extern from "include/em.h":
+cdef extern from "include/em.h" nogil:
+    ctypedef struct em_workspace:
+        int capacity
+        int ntype
+
+    ctypedef struct em_job:
+        double *init_allele_freq
+        double *ind_allele_likelihood
+        double *weight
+        double *sum_marginal_likelihood
+        double *expect_allele_prob
+        int nhyp
+        int nsample
+        int status
+
+    em_workspace *em_workspace_init(int nsample, int ntype)
+    int em_workspace_reserve(em_workspace *ws, int nsample)
+    void em_workspace_destroy(em_workspace *ws)
+    int em_hypotheses(em_workspace *ws, double *init_allele_freq, double *ind_allele_likelihood,
+                      double *weight, double *sum_marginal_likelihood, double *expect_allele_prob,
+                      int nhyp, int nsample, int iter_num, double epsilon)
+    void em_run_jobs(em_workspace *ws, em_job *jobs, int start, int step, int njob, int iter_num, double epsilon)
+
     void em(double *init_allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
             double *expect_allele_prob, int nsample, int ntype, int iter_num, double epsilon)
 
 cdef extern from "include/ranksumtest.c":
     pass
 
-cdef extern from "include/ranksumtest.h":
+cdef extern from "include/ranksumtest.h" nogil:
     double RankSumTest(double *x, int n1, double *y, int n2)
 
 cdef void EM(double* init_allele_freq,
@@ -26,6 +48,33 @@ cdef void EM(double* init_allele_freq,
              int iter_num,
              double epsilon)
 
+cdef struct StrandCacheEntry:
+    int ref_fwd
+    int ref_rev
+    int alt_fwd
+    int alt_rev
+    double fs
+    double sor
+
+# Direct-mapped cache of FS and SOR keyed on the 2x2 strand table, which repeats heavily
+# across the positions at low depth. One for each thread.
+cdef struct StrandCache:
+    StrandCacheEntry entries[8192]  # STRAND_CACHE_SIZE
+    long int hit_num
+    long int miss_num
+
+cdef void strand_cache_init(StrandCache *cache) nogil
+cdef void strand_cache_merge_stats(StrandCache *cache)
+
+cdef void allele_table(bytes ref_base, list alt_bases, int *allele)
+cdef int strand_counts_by_alleles(const int *allele, char **bases, char *strands, int size, int *counts) nogil
+cdef int ranksumtests_by_alleles(const int *allele, char **bases, int *mapqs, int *read_pos_rank,
+                                 int *base_quals, int data_size, double *results) nogil
+cdef void cached_fisher_strand_and_sor(StrandCache *cache, int ref_fwd, int ref_rev, int alt_fwd, int alt_rev,
+                                       double *fs, double *sor) nogil
+
 cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *strands, int size)
+cdef void fisher_strand_and_sor(int ref_fwd, int ref_rev, int alt_fwd, int alt_rev, double *fs, double *sor)
 cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, char **bases, int *info, int data_size)
-
+cdef int ref_vs_alt_ranksumtests(bytes ref_base, list alt_bases, char **bases, int *mapqs, int *read_pos_rank,
+                                 int *base_quals, int data_size, double *results) except -1
@@ -2,11 +2,24 @@
 This module contain some main algorithms of BaseVar
 """
 from scipy.stats.distributions import norm
+from libc.math cimport erfc, fabs, sqrt, log10
+from libc.string cimport memset
+cimport cython
 
 from basevar.io.htslibWrapper cimport kt_fisher_exact
 
-cdef extern from "math.h":
-    double log10(double)
+# The integer annotations in [0, RANK_HIST_SIZE) are counted by histograms in the rank sum tests,
+# the others (rarely, e.g. the read position of very long reads) are sorted by ``RankSumTest``.
+DEF RANK_HIST_SIZE = 1024
+DEF RANK_TEST_NUM = 3
+
+# The size of ``StrandCache.entries`` in algorithm.pxd, must be a power of 2.
+DEF STRAND_CACHE_SIZE = 8192
+
+# The FS/SOR cache of the code running with the GIL, the stats of the caches of threads are
+# merged into it.
+cdef StrandCache strand_cache
+strand_cache_init(&strand_cache)
 
 
 cdef void EM(double* init_allele_freq,
@@ -88,6 +101,205 @@ cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, char **bases,
     return phred_scale_value
 
 
+cdef void allele_table(bytes ref_base, list alt_bases, int *allele):
+    """Fill the 256 entries ``allele`` by the first char of a base: 0 for REF, 1 for ALT and -1 for
+    the others. Only the single bases are set, "N" and indels are always -1.
+    """
+    memset(allele, -1, 256 * sizeof(int))
+    if len(ref_base) == 1:
+        allele[<unsigned char> ref_base[0]] = 0
+
+    cdef bytes alt
+    for alt in alt_bases:
+        if len(alt) == 1:
+            allele[<unsigned char> alt[0]] = 1
+
+    allele[<unsigned char> b'N'] = -1
+    return
+
+
+cdef inline double _phred_scale_of_z(double z) nogil:
+    # erfc(|z| / sqrt(2)) is the two-sided p-value, the same as 2 * norm.sf(abs(z))
+    cdef double pvalue = erfc(fabs(z) * 0.7071067811865476)
+    if pvalue == 1.0:
+        return 0.0
+    elif pvalue > 0:
+        return -10 * log10(pvalue)
+    else:
+        return 10000.0
+
+
+@cython.cdivision(True)
+cdef double _histogram_ranksum_z(int *ref_hist, int *alt_hist, int min_value, int max_value,
+                                 int n1, int n2) nogil:
+    """The z of Mann-Whitney-Wilcoxon rank sum test by the histograms of REF and ALT, which is
+    the same as ``RankSumTest``: tied values get the average of their ranks and the variance is
+    corrected for the ties.
+    """
+    cdef double r1 = 0.0, below = 0.0, tie_sum = 0.0
+    cdef int v, t
+    for v in range(min_value, max_value + 1):
+        t = ref_hist[v] + alt_hist[v]
+        if t == 0:
+            continue
+
+        if ref_hist[v] > 0:
+            r1 += ref_hist[v] * (below + (t + 1) / 2.0)
+        below += t
+        tie_sum += (<double>t * t - 1) * t
+
+    cdef double n = n1 + n2
+    cdef double variance = <double>n1 * n2 / 12.0 * ((n + 1) - tie_sum / (n * (n - 1)))
+    if variance <= 0:
+        # All the values are the same
+        return 0.0
+
+    return (r1 - n1 * (n + 1) / 2.0) / sqrt(variance)
+
+
+cdef double _sorted_ranksum(const int *allele, char **bases, int *info, int data_size) nogil:
+    """The phred scale value of the rank sum test of REF versus ALT by sorting ``info`` (``RankSumTest``),
+    for the annotations out of the histograms. -1 if there's no REF or ALT and -2 if out of memory.
+    """
+    cdef double *x = <double *> malloc(data_size * sizeof(double))
+    cdef double *y = <double *> malloc(data_size * sizeof(double))
+    if x == NULL or y == NULL:
+        free(x)
+        free(y)
+        return -2.0
+
+    cdef char *b
+    cdef int i, a, n1 = 0, n2 = 0
+    for i in range(data_size):
+        b = bases[i]
+        if b[0] == 0 or b[1] != 0:
+            continue
+
+        a = allele[<unsigned char> b[0]]
+        if a == 0:
+            x[n1] = info[i]
+            n1 += 1
+        elif a == 1:
+            y[n2] = info[i]
+            n2 += 1
+
+    cdef double value = -1.0
+    if n1 > 0 and n2 > 0:
+        value = _phred_scale_of_z(RankSumTest(x, n1, y, n2))
+
+    free(x)
+    free(y)
+    return value
+
+
+cdef int ranksumtests_by_alleles(const int *allele, char **bases, int *mapqs, int *read_pos_rank,
+                                 int *base_quals, int data_size, double *results) nogil:
+    """``ref_vs_alt_ranksumtests`` by the REF/ALT table of ``allele_table``, which runs without the GIL.
+
+    Return 0, or -1 if out of memory.
+    """
+    cdef int *annotations[RANK_TEST_NUM]
+    annotations[0] = mapqs
+    annotations[1] = read_pos_rank
+    annotations[2] = base_quals
+
+    # [annotation][REF or ALT][value]
+    cdef int hist[RANK_TEST_NUM][2][RANK_HIST_SIZE]
+    memset(hist, 0, sizeof(hist))
+
+    cdef int min_value[RANK_TEST_NUM]
+    cdef int max_value[RANK_TEST_NUM]
+    cdef bint is_out_of_range[RANK_TEST_NUM]
+    cdef int k
+    for k in range(RANK_TEST_NUM):
+        min_value[k] = RANK_HIST_SIZE
+        max_value[k] = -1
+        is_out_of_range[k] = False
+
+    cdef int n[2]
+    n[0] = n[1] = 0
+
+    cdef char *b
+    cdef int i, a, v
+    for i in range(data_size):
+        b = bases[i]
+        if b[0] == b'N' or b[0] == b'-' or b[0] == b'+' or b[0] == 0 or b[1] != 0:
+            continue
+
+        a = allele[<unsigned char> b[0]]
+        if a < 0:
+            continue
+
+        n[a] += 1
+        for k in range(RANK_TEST_NUM):
+            v = annotations[k][i]
+            if 0 <= v < RANK_HIST_SIZE:
+                hist[k][a][v] += 1
+                if v < min_value[k]:
+                    min_value[k] = v
+                if v > max_value[k]:
+                    max_value[k] = v
+            else:
+                is_out_of_range[k] = True
+
+    for k in range(RANK_TEST_NUM):
+        if n[0] == 0 or n[1] == 0:
+            # -1 represent to None
+            results[k] = -1.0
+        elif is_out_of_range[k]:
+            results[k] = _sorted_ranksum(allele, bases, annotations[k], data_size)
+            if results[k] == -2.0:
+                return -1
+        else:
+            results[k] = _phred_scale_of_z(_histogram_ranksum_z(hist[k][0], hist[k][1], min_value[k],
+                                                                max_value[k], n[0], n[1]))
+
+    return 0
+
+
+cdef int ref_vs_alt_ranksumtests(bytes ref_base, list alt_bases, char **bases, int *mapqs, int *read_pos_rank,
+                                 int *base_quals, int data_size, double *results) except -1:
+    """Rank sum tests of mapping quality, read position and base quality of REF versus ALT in one
+    pass over the samples, the same as calling ``ref_vs_alt_ranksumtest`` for each of them.
+
+    The phred scale values are set into ``results`` in the same order, -1 if there's no REF or ALT.
+    """
+    cdef int allele[256]
+    allele_table(ref_base, alt_bases, allele)
+    if ranksumtests_by_alleles(allele, bases, mapqs, read_pos_rank, base_quals, data_size, results) < 0:
+        raise MemoryError()
+
+    return 0
+
+
+cdef int strand_counts_by_alleles(const int *allele, char **bases, char *strands, int size,
+                                  int *counts) nogil:
+    """Count the strands of REF and ALT by the table of ``allele_table`` into ``counts``:
+    [ref_fwd, ref_rev, alt_fwd, alt_rev]. Runs without the GIL.
+
+    Return -1, or the index of the first base with a strange strand symbol.
+    """
+    memset(counts, 0, 4 * sizeof(int))
+
+    cdef char *b
+    cdef int i, a
+    for i in range(size):
+
+        # ignore "N" or indels
+        b = bases[i]
+        if b[0] == b'N' or b[0] == b'-' or b[0] == b'+':
+            continue
+
+        if strands[i] != b'+' and strands[i] != b'-':
+            return i
+
+        a = allele[<unsigned char> b[0]] if b[0] != 0 and b[1] == 0 else -1
+        if a >= 0:
+            counts[2 * a + (0 if strands[i] == b'+' else 1)] += 1
+
+    return -1
+
+
 cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *strands, int size):
     """
     A method for calculating the strand bias of REF_BASE and ALT_BASE
@@ -107,45 +319,95 @@ cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *stran
     :return: list-like
         FS, ref_fwd, ref_rev, alt_fwd, alt_rev
     """
-    cdef int ref_fwd = 0, ref_rev = 0, alt_fwd = 0, alt_rev = 0
+    cdef int allele[256]
+    allele_table(ref_base, alt_bases, allele)
 
-    cdef int i = 0
-    # for s, b in zip(strands, bases):
-    for i in range(size):
+    # [ref_fwd, ref_rev, alt_fwd, alt_rev]
+    cdef int counts[4]
+    cdef int i = strand_counts_by_alleles(allele, bases, strands, size, counts)
+    if i >= 0:
+        raise ValueError('[ERROR] Get strange strand symbol: "%s"' % chr(strands[i]))
 
-        # ignore "N" or indels
-        if bases[i][0] in ['N', '-', '+']:
-            # `bases[i]` is char*
-            continue
+    cdef double fs, sor
+    fisher_strand_and_sor(counts[0], counts[1], counts[2], counts[3], &fs, &sor)
+    return (fs, sor, counts[0], counts[1], counts[2], counts[3])
 
-        if strands[i] == '+':
-            if bases[i] == ref_base:
-                ref_fwd += 1
 
-            elif bases[i] in alt_bases:
-                alt_fwd += 1
+cdef void strand_cache_init(StrandCache *cache) nogil:
+    cdef int i
+    for i in range(STRAND_CACHE_SIZE):
+        # An empty entry never matches a real table
+        cache.entries[i].ref_fwd = -1
 
-        elif strands[i] == '-':
-            if bases[i] == ref_base:
-                ref_rev += 1
-            elif bases[i] in alt_bases:
-                alt_rev += 1
+    cache.hit_num = 0
+    cache.miss_num = 0
+    return
+
+
+cdef void strand_cache_merge_stats(StrandCache *cache):
+    """Move the hits and misses of ``cache`` (of a thread) into the stats of this process."""
+    strand_cache.hit_num += cache.hit_num
+    strand_cache.miss_num += cache.miss_num
+    cache.hit_num = 0
+    cache.miss_num = 0
+    return
 
-        else:
-            raise ValueError('[ERROR] Get strange strand symbol: "%s"' % chr(strands[i]))
 
-    cdef double left_p, right_p, twoside_p, fs
+cdef void cached_fisher_strand_and_sor(StrandCache *cache, int ref_fwd, int ref_rev, int alt_fwd, int alt_rev,
+                                       double *fs, double *sor) nogil:
+    """FS and SOR of the strand counts of REF and ALT, looked up in ``cache`` first. A cache must
+    not be shared by the threads.
+    """
+    cdef unsigned int h = <unsigned int> ref_fwd * 73856093u ^ <unsigned int> ref_rev * 19349663u ^ \
+                          <unsigned int> alt_fwd * 83492791u ^ <unsigned int> alt_rev * 2654435761u
+    cdef StrandCacheEntry *entry = &cache.entries[(h ^ (h >> 16)) & (STRAND_CACHE_SIZE - 1)]
+    if (entry.ref_fwd == ref_fwd and entry.ref_rev == ref_rev and
+            entry.alt_fwd == alt_fwd and entry.alt_rev == alt_rev):
+        cache.hit_num += 1
+        fs[0] = entry.fs
+        sor[0] = entry.sor
+        return
+
+    cache.miss_num += 1
+    _fisher_strand_and_sor(ref_fwd, ref_rev, alt_fwd, alt_rev, fs, sor)
+
+    entry.ref_fwd = ref_fwd
+    entry.ref_rev = ref_rev
+    entry.alt_fwd = alt_fwd
+    entry.alt_rev = alt_rev
+    entry.fs = fs[0]
+    entry.sor = sor[0]
+    return
+
+
+cdef void fisher_strand_and_sor(int ref_fwd, int ref_rev, int alt_fwd, int alt_rev, double *fs, double *sor):
+    """FS and SOR of the strand counts of REF and ALT, looked up in the cache of this process first."""
+    cached_fisher_strand_and_sor(&strand_cache, ref_fwd, ref_rev, alt_fwd, alt_rev, fs, sor)
+    return
+
+
+def strand_cache_stats():
+    """The hits and misses of the FS/SOR caches in this process."""
+    cdef long int total = strand_cache.hit_num + strand_cache.miss_num
+    return "%d hits, %d misses (hit rate %.2f%%)" % (
+        strand_cache.hit_num, strand_cache.miss_num, 100.0 * strand_cache.hit_num / total if total else 0.0)
+
+
+@cython.cdivision(True)
+cdef void _fisher_strand_and_sor(int ref_fwd, int ref_rev, int alt_fwd, int alt_rev,
+                                 double *fs, double *sor) nogil:
+    cdef double left_p, right_p, twoside_p
 
     # exact_fisher_test from htslib
     kt_fisher_exact(ref_fwd, ref_rev, alt_fwd, alt_rev, &left_p, &right_p, &twoside_p)
     if twoside_p == 1.0:
-        fs = 0.0
+        fs[0] = 0.0
     elif twoside_p > 0.0:
-        fs = -10 * log10(twoside_p)
+        fs[0] = -10 * log10(twoside_p)
     else:
-        fs = 10000.0
+        fs[0] = 10000.0
 
     # Strand bias estimated by the Symmetric Odds Ratio test
     # https://software.broadinstitute.org/gatk/documentation/tooldocs/current/org_broadinstitute_gatk_tools_walkers_annotator_StrandOddsRatio.php
-    cdef double sor = float(ref_fwd * alt_rev) / (ref_rev * alt_fwd) if ref_rev * alt_fwd > 0 else 10000.0
-    return (fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev)
+    sor[0] = <double> (ref_fwd * alt_rev) / (ref_rev * alt_fwd) if ref_rev * alt_fwd > 0 else 10000.0
+    return
@@ -4,6 +4,8 @@ cdef extern from "stdlib.h" nogil:
     void *malloc(size_t)
     void *calloc(size_t, size_t)
     void *memcpy(void *dst, void *src, size_t length)
+    void *memset(void *dst, int c, size_t length)
+    void *realloc(void *, size_t)
     void free(void *)
 
 cdef extern from "math.h" nogil:
@@ -12,6 +14,12 @@ cdef extern from "math.h" nogil:
     double log(double)
     double log10(double)
 
+from basevar.caller.algorithm cimport em_workspace, em_job, StrandCache
+
+# A kernel run by the threads of ``BaseTypeEngine.run_parallel`` without GIL, the thread
+# ``thread_index`` of ``thread_num`` takes the jobs thread_index, thread_index + thread_num, ...
+ctypedef void (*parallel_kernel)(void *context, int thread_index, int thread_num, int job_num) nogil
+
 
 cdef class BaseTuple:
     cdef int combination_num
@@ -21,6 +29,9 @@ cdef class BaseTuple:
     cdef double **alleles_freq_list  # => bp
     cdef void destroy(self)
 
+cdef class BaseTypeEngine
+
+
 cdef class BaseType:
     cdef int good_individual_num
     cdef int base_type_num
@@ -30,15 +41,72 @@ cdef class BaseType:
     cdef double _var_qual
     cdef float min_af
     cdef double *ind_allele_likelihood
+    cdef int lik_row_num  # => rows of ``ind_allele_likelihood``
+    cdef double *lik_row_weight  # => how many samples of each row, NULL if one sample per row
     cdef double *qual_pvalue
     cdef dict af_by_lrt
     cdef dict depth
 
-    cdef void cinit(self, bytes ref_base, char **bases, int *quals, int total_sample_size, float min_af)
-    cdef bint lrt(self, list specific_base_comb)
+    # hypotheses of LRT set by BaseTypeEngine, at most 15 base combinations of [A, C, G, T]
+    cdef list lrt_bases
+    cdef int hyp_num
+    cdef double hyp_init_allele_freq[60]
+    cdef double hyp_sum_marginal_likelihood[15]
+    cdef double hyp_expect_allele_freq[60]
+
+    cdef void cinit(self, bytes ref_base, char **bases, int *quals, int total_sample_size, float min_af,
+                    bint compress=*)
+    cdef bint lrt(self, list specific_base_comb, BaseTypeEngine engine=*) except *
     cdef void _set_init_ind_allele_likelihood(self, char **ind_bases, list base_element, int total_individual_num)
+    cdef void _init_compressed_rows(self, int max_row_num)
+    cdef int _add_compressed_sample(self, int *class_index, int max_qual, char *base, int qual, double qual_pvalue)
+    cdef bint _set_compressed_ind_allele_likelihood(self, char **ind_bases, int *quals, int total_individual_num)
     cdef double *_set_allele_frequence(self, tuple bases)
     cdef double sum_likelihood(self, double *data, int num, bint is_log)
     cdef BaseTuple _f(self, list bases, int n)
     cdef double *calculate_chivalue(self, double lr_alt, double *lr_null, int comb_num)
     cdef int find_argmin(self, double *data, int comb_num)
+    cdef bint _set_lrt_result(self, list bases, double *base_frq, double chi_sqrt_value)
+
+cdef class BaseTypeEngine:
+    cdef int thread_num
+    cdef em_workspace **workspaces  # => one for each thread
+    cdef em_job *jobs
+    cdef int job_num
+    cdef int job_capacity
+    cdef StrandCache **strand_caches  # => one for each thread, used by the kernels of callers
+    cdef object pool
+
+    # the kernel running by ``run_parallel``
+    cdef parallel_kernel kernel
+    cdef void *kernel_context
+    cdef int kernel_job_num
+
+    # counters of the pre-screen
+    cdef long prescreen_site_num
+    cdef long skip_by_min_af
+    cdef long skip_by_error_bound
+
+    cdef bint is_non_variant(self, bytes ref_base, char **bases, int *quals, int size, float min_af)
+    cdef bint lrt(self, BaseType bt, list specific_base_comb)
+    cdef list lrt_block(self, list basetypes, list specific_base_combs)
+    cdef int run_parallel(self, parallel_kernel kernel, void *context, int job_num) except -1
+    cdef void _run_kernel(self, int thread_index, int thread_num)
+    cdef int _set_hypotheses(self, BaseType bt, list specific_base_comb) except -1
+    cdef int _run_em(self, list basetypes) except -1
+    cdef bint _lrt_by_hypotheses(self, BaseType bt)
+
+cdef class PopGroupEngine:
+    cdef list groups  # => the order of groups in output
+    cdef int group_num
+    cdef int sample_size
+    cdef int *sample_group  # => sample index to group index, -1 if the sample is not in any group
+    cdef int *group_size
+    cdef int *group_depth  # => group_num * 4 for [A, C, G, T]
+    cdef int *class_index  # => (group, base, quality) to row of likelihood in group BaseType
+    cdef int class_capacity
+
+    cdef list base_depth_and_indel(self, char **bases)
+    cdef list group_indels(self, char **bases)
+    cdef list basetypes(self, bytes ref_base, char **bases, int *quals, float min_af)
+    cdef list _gather_basetypes(self, bytes ref_base, char **bases, int *quals, float min_af)
@@ -3,17 +3,39 @@
 This module contain functions of LRT and Base genotype.
 """
 import itertools  # Use the combinations function
+from multiprocessing.pool import ThreadPool
 from scipy.stats.distributions import chi2
 
-from basevar.caller.algorithm cimport EM
+from basevar.caller.algorithm cimport EM, em_workspace_init, em_workspace_destroy, em_run_jobs
+from basevar.caller.algorithm cimport strand_cache_init, strand_cache_merge_stats
 
 DEF LRT_THRESHOLD = 24  # 24 corresponding to a chi-pvalue of 10^-6
 DEF QUAL_THRESHOLD = 60  # -10 * lg(10^-6)
 DEF MLN10TO10 = -0.23025850929940458  # log(10)/10
+DEF EM_ITER_NUM = 100
+DEF EM_EPSILON = 0.001
+DEF PRESCREEN_EPSILON = 1e-6  # margin for the rounding error of log-likelihood sums
 cdef list BASE = ['A', 'C', 'G', 'T']
 cdef dict BASE2IDX = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
 
 
+cdef inline int _base_code(char *b):
+    """Return the index of ``b`` in [A, C, G, T], or 4 for any other base."""
+    if b[0] == 0 or b[1] != 0:
+        return 4
+
+    if b[0] == b'A':
+        return 0
+    elif b[0] == b'C':
+        return 1
+    elif b[0] == b'G':
+        return 2
+    elif b[0] == b'T':
+        return 3
+    else:
+        return 4
+
+
 cdef class BaseTuple:
     def __cinit__(self, int combination_num, int base_num, int base_type_num):
 
@@ -72,7 +94,8 @@ cdef class BaseType:
         # do nothings
         pass
 
-    cdef void cinit (self, bytes ref_base, char **bases, int *quals, int total_sample_size, float min_af):
+    cdef void cinit (self, bytes ref_base, char **bases, int *quals, int total_sample_size, float min_af,
+                     bint compress=False):
         """ Iinitial all the data here.
         
         A class for calculate the base probability
@@ -90,6 +113,10 @@ cdef class BaseType:
             Base quality for ``bases``. The same size with ``bases``
             Cause: The ``quals`` is an integer array which has be converted
                 by phred-scale
+
+        ``compress``: bool, optional
+            Group the samples by (base, base quality) and keep one likelihood row
+            for each group, EM will run over the groups instead of samples.
         """
         self._ref_base = ref_base  # ref_base must be upper() before pass to this class.
         self._alt_bases = None
@@ -112,12 +139,18 @@ cdef class BaseType:
         for i in range(total_sample_size):
             self.qual_pvalue[i] = 1.0 - exp(MLN10TO10 * quals[i])
 
-        # A big 1-D array
-        self.ind_allele_likelihood = <double*>(calloc(self.good_individual_num * self.base_type_num, sizeof(double)))
-        assert self.ind_allele_likelihood != NULL, "Could not allocate memory for ind_allele_likelihood in BaseType"
+        self.lik_row_num = self.good_individual_num
+        self.lik_row_weight = NULL
+        if not (compress and self._set_compressed_ind_allele_likelihood(bases, quals, total_sample_size)):
 
-        # set allele likelihood for each individual and get depth
-        self._set_init_ind_allele_likelihood(bases, BASE, total_sample_size)
+            # A big 1-D array
+            self.ind_allele_likelihood = <double*>(calloc(self.good_individual_num * self.base_type_num,
+                                                          sizeof(double)))
+            assert self.ind_allele_likelihood != NULL, (
+                "Could not allocate memory for ind_allele_likelihood in BaseType")
+
+            # set allele likelihood for each individual and get depth
+            self._set_init_ind_allele_likelihood(bases, BASE, total_sample_size)
         self.total_depth = float(sum(self.depth.values()))
 
         # estimated allele frequency by EM and LRT
@@ -135,6 +168,9 @@ cdef class BaseType:
         if self.qual_pvalue != NULL:
             free(self.qual_pvalue)
 
+        if self.lik_row_weight != NULL:
+            free(self.lik_row_weight)
+
     cdef void _set_init_ind_allele_likelihood(self, char **ind_bases, list base_element, int total_individual_num):
 
         cdef int i = 0
@@ -161,6 +197,86 @@ cdef class BaseType:
                     self.depth[ind_bases[i]] += 1
         return
 
+    cdef bint _set_compressed_ind_allele_likelihood(self, char **ind_bases, int *quals, int total_individual_num):
+        """Set allele likelihood for each (base, base quality) class of the good individuals and get depth.
+
+        Individuals with the same base and base quality have the same likelihood, so we just keep one
+        row for each class and record the size of class in ``lik_row_weight``.
+
+        Return False if it could not be compressed, which will happen with negative base quality.
+        """
+        cdef int i = 0
+        cdef int k = 0
+        cdef int max_qual = 0
+        for i in range(total_individual_num):
+            if quals[i] < 0:
+                return False
+
+            if quals[i] > max_qual:
+                max_qual = quals[i]
+
+        # [A, C, G, T] and one more for all the other bases
+        cdef int class_size = (self.base_type_num + 1) * (max_qual + 1)
+        cdef int *class_index = <int*>(malloc(class_size * sizeof(int)))
+        assert class_index != NULL, "Could not allocate memory for class_index in BaseType"
+        for k in range(class_size):
+            class_index[k] = -1
+
+        self._init_compressed_rows(min(self.good_individual_num, class_size))
+
+        cdef int base_depth[4]
+        memset(base_depth, 0, 4 * sizeof(int))
+
+        cdef int code
+        for i in range(total_individual_num):
+
+            # ignore all the 'N' bases and indels.
+            if ind_bases[i][0] == b'N' or ind_bases[i][0] == b'-' or ind_bases[i][0] == b'+':
+                continue
+
+            code = self._add_compressed_sample(class_index, max_qual, ind_bases[i], quals[i], self.qual_pvalue[i])
+            if code < self.base_type_num:
+                base_depth[code] += 1
+
+        for k in range(self.base_type_num):
+            self.depth[BASE[k]] += base_depth[k]
+
+        free(class_index)
+        return True
+
+    cdef void _init_compressed_rows(self, int max_row_num):
+        """Allocate ``max_row_num`` likelihood rows and their weights for the (base, base quality) classes."""
+        self.lik_row_num = 0
+        self.ind_allele_likelihood = <double*>(calloc(max(1, max_row_num) * self.base_type_num, sizeof(double)))
+        assert self.ind_allele_likelihood != NULL, "Could not allocate memory for ind_allele_likelihood in BaseType"
+
+        self.lik_row_weight = <double*>(calloc(max(1, max_row_num), sizeof(double)))
+        assert self.lik_row_weight != NULL, "Could not allocate memory for lik_row_weight in BaseType"
+
+    cdef int _add_compressed_sample(self, int *class_index, int max_qual, char *base, int qual, double qual_pvalue):
+        """Add a good sample into the row of its (base, base quality) class.
+
+        ``class_index`` maps each class (base code * (``max_qual`` + 1) + ``qual``) to its row, -1 for
+        a class without row yet, and the number of samples of each row is in ``lik_row_weight``.
+
+        Return the index of ``base`` in [A, C, G, T], or 4 for any other base.
+        """
+        cdef int k, code = _base_code(base)
+        cdef int row = class_index[code * (max_qual + 1) + qual]
+        if row < 0:
+            row = self.lik_row_num
+            class_index[code * (max_qual + 1) + qual] = row
+            self.lik_row_num += 1
+
+            for k in range(self.base_type_num):
+                if k == code:
+                    self.ind_allele_likelihood[row * self.base_type_num + k] = qual_pvalue
+                else:
+                    self.ind_allele_likelihood[row * self.base_type_num + k] = (1.0 - qual_pvalue)/3
+
+        self.lik_row_weight[row] += 1
+        return code
+
     cdef double* _set_allele_frequence(self, tuple bases):
         """
         init the base likelihood by bases
@@ -262,16 +378,24 @@ cdef class BaseType:
         # a double-type value
         return s
 
-    cdef bint lrt(self, list specific_base_comb):
+    cdef bint lrt(self, list specific_base_comb, BaseTypeEngine engine=None) except *:
         """The main function. likelihood ratio test.
 
         Parameter:
             ``specific_base_comb``: list like
                 Calculating LRT for specific base combination
+            ``engine``: The ``BaseTypeEngine`` of the caller, which is required if the likelihood
+                is compressed.
         """
         if self.total_depth == 0:
             return False
 
+        # ``_f`` runs EM sample by sample, the compressed likelihood could only be done by the engine.
+        if self.lik_row_weight != NULL:
+            if engine is None:
+                raise ValueError("The likelihood of BaseType is compressed, LRT must be done by BaseTypeEngine.")
+            return engine.lrt(self, specific_base_comb)
+
         cdef list bases = []
         if specific_base_comb:
             bases = [b for b in specific_base_comb if self.depth[b] / self.total_depth >= self.min_af]
@@ -321,6 +445,18 @@ cdef class BaseType:
         if lrt_chi_value != NULL:
             free(lrt_chi_value)
 
+        cdef bint is_variant = self._set_lrt_result(bases, base_frq, chi_sqrt_value)
+        free(base_frq)
+
+        return is_variant
+
+    cdef bint _set_lrt_result(self, list bases, double *base_frq, double chi_sqrt_value):
+        """Record the alt bases, allele frequencies and the variant quality after LRT.
+
+        ``bases``: The base combination accepted by LRT.
+        ``base_frq``: The expected allele frequencies of [A, C, G, T] for ``bases``.
+        ``chi_sqrt_value``: The chi-square value of the last test.
+        """
         self._alt_bases = [b for b in bases if b != self._ref_base]
         self.af_by_lrt = {b:"%.6f" % base_frq[BASE2IDX[b]] for b in self._alt_bases}
 
@@ -376,3 +512,541 @@ cdef class BaseType:
         def __get__(self):
             # A double value
             return self._var_qual
+
+
+cdef class BaseTypeEngine:
+    """Calculate LRT for BaseType with the shared EM workspaces.
+
+    All the base combination hypotheses of one position are set up together, the EM of
+    a block of positions could then be run by ``thread_num`` threads without GIL, one
+    workspace for each thread. The result is exactly the same with ``BaseType.lrt``.
+
+    The threads could also run the other per-site kernels of callers by ``run_parallel``, with
+    a FS/SOR cache for each thread in ``strand_caches``.
+    """
+    def __cinit__(self, int sample_size=0, int thread_num=1):
+
+        self.thread_num = max(1, thread_num)
+        self.workspaces = <em_workspace**>(calloc(self.thread_num, sizeof(em_workspace*)))
+        assert self.workspaces != NULL, "Could not allocate memory for workspaces in BaseTypeEngine."
+
+        cdef int i
+        for i in range(self.thread_num):
+            self.workspaces[i] = em_workspace_init(sample_size, len(BASE))
+            assert self.workspaces[i] != NULL, "Could not allocate memory for workspace in BaseTypeEngine."
+
+        self.strand_caches = <StrandCache**>(calloc(self.thread_num, sizeof(StrandCache*)))
+        assert self.strand_caches != NULL, "Could not allocate memory for strand_caches in BaseTypeEngine."
+        for i in range(self.thread_num):
+            self.strand_caches[i] = <StrandCache*>(malloc(sizeof(StrandCache)))
+            assert self.strand_caches[i] != NULL, "Could not allocate memory for strand_cache in BaseTypeEngine."
+            strand_cache_init(self.strand_caches[i])
+
+        self.jobs = NULL
+        self.job_num = 0
+        self.job_capacity = 0
+        self.pool = ThreadPool(self.thread_num) if self.thread_num > 1 else None
+
+    def __dealloc__(self):
+        """Free memory"""
+        cdef int i
+        if self.workspaces != NULL:
+            for i in range(self.thread_num):
+                em_workspace_destroy(self.workspaces[i])
+
+            free(self.workspaces)
+            self.workspaces = NULL
+
+        if self.strand_caches != NULL:
+            for i in range(self.thread_num):
+                free(self.strand_caches[i])
+
+            free(self.strand_caches)
+            self.strand_caches = NULL
+
+        if self.jobs != NULL:
+            free(self.jobs)
+            self.jobs = NULL
+
+    def close(self):
+        """Stop the threads and merge the stats of FS/SOR caches into ``strand_cache_stats``"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        cdef int i
+        for i in range(self.thread_num):
+            strand_cache_merge_stats(self.strand_caches[i])
+
+    cdef bint is_non_variant(self, bytes ref_base, char **bases, int *quals, int size, float min_af):
+        """Cheap pre-screen before building ``BaseType``, return True if the position could not be
+        a variant by ``lrt``, so it's safe to skip it. It never skip a variant:
+
+        1. No depth, or no alt base with frequence >= ``min_af``. ``lrt`` will return False directly.
+
+        2. The bases pass ``min_af`` are just [ref, alt]. The log-likelihood of [ref, alt] is never larger
+           than sum(log(max(L_ref, L_alt))) for any allele frequence, so the chi-square value of
+           dropping alt is bounded by 2 * sum(max(0, log(L_alt / L_ref))). If the bound is less than
+           LRT_THRESHOLD and [ref] is more likely than [alt], ``lrt`` takes [ref].
+        """
+        self.prescreen_site_num += 1
+
+        cdef int ref_code = _base_code(ref_base)
+        cdef int depth[4]
+        cdef double base_llr[4]  # sum of log(L_base / L_other) of the reads for each base
+        cdef double pos_llr[4]   # the same as ``base_llr`` but only the positive ones
+        cdef double neg_llr[4]   # the same as ``base_llr`` but only the negative ones, without sign
+        memset(depth, 0, 4 * sizeof(int))
+        memset(base_llr, 0, 4 * sizeof(double))
+        memset(pos_llr, 0, 4 * sizeof(double))
+        memset(neg_llr, 0, 4 * sizeof(double))
+
+        cdef bint is_bounded = True
+        cdef double p, llr
+        cdef int i, code
+        for i in range(size):
+
+            # ignore all the 'N' bases and indels, just like ``BaseType``.
+            if bases[i][0] == b'N' or bases[i][0] == b'-' or bases[i][0] == b'+':
+                continue
+
+            code = _base_code(bases[i])
+            if code == 4:
+                continue
+
+            depth[code] += 1
+            p = 1.0 - exp(MLN10TO10 * quals[i])
+            if p <= 0 or p >= 1:
+                # log-likelihood could be inf
+                is_bounded = False
+                continue
+
+            llr = log(3 * p / (1.0 - p))
+            base_llr[code] += llr
+            if llr > 0:
+                pos_llr[code] += llr
+            else:
+                neg_llr[code] -= llr
+
+        cdef double total_depth = depth[0] + depth[1] + depth[2] + depth[3]
+        if total_depth == 0:
+            self.skip_by_min_af += 1
+            return True
+
+        cdef int alt_code = -1
+        cdef int alt_num = 0
+        cdef bint has_ref = False
+        for code in range(4):
+            if depth[code] / total_depth >= min_af:
+                if code == ref_code:
+                    has_ref = True
+                else:
+                    alt_code = code
+                    alt_num += 1
+
+        if alt_num == 0:
+            self.skip_by_min_af += 1
+            return True
+
+        if (is_bounded and has_ref and alt_num == 1 and
+                2 * (pos_llr[alt_code] + neg_llr[ref_code]) < LRT_THRESHOLD - PRESCREEN_EPSILON and
+                base_llr[ref_code] - base_llr[alt_code] > PRESCREEN_EPSILON):
+            self.skip_by_error_bound += 1
+            return True
+
+        return False
+
+    cdef bint lrt(self, BaseType bt, list specific_base_comb):
+        """Likelihood ratio test for ``bt``, the same decision path with ``BaseType.lrt``."""
+        return self.lrt_block([bt], [specific_base_comb])[0]
+
+    cdef list lrt_block(self, list basetypes, list specific_base_combs):
+        """Calculate LRT for a block of positions, the EM of all the positions are run by the threads
+        and then the LRT are decided one by one in the order of ``basetypes``.
+
+        ``basetypes``: A list of BaseType.
+        ``specific_base_combs``: None or a list of base combinations with the same size of ``basetypes``.
+
+        Return a list of bool to tell which one is variant.
+        """
+        cdef BaseType bt
+        cdef int i
+        for i, bt in enumerate(basetypes):
+            self._set_hypotheses(bt, specific_base_combs[i] if specific_base_combs else None)
+
+        self._run_em(basetypes)
+        return [self._lrt_by_hypotheses(bt) for bt in basetypes]
+
+    cdef int _set_hypotheses(self, BaseType bt, list specific_base_comb) except -1:
+        """Set the initial allele frequencies of all the base combination hypotheses for ``bt``.
+
+        Every non-empty combination of ``bt.lrt_bases`` is a bit mask of the index in ``bt.lrt_bases``
+        and the hypothesis of mask ``m`` is in row ``m - 1``. Return the number of hypotheses, which
+        is 0 if ``bt`` could not be a variant.
+        """
+        bt.hyp_num = 0
+        if bt.total_depth == 0:
+            return 0
+
+        if specific_base_comb:
+            bt.lrt_bases = [b for b in specific_base_comb if bt.depth[b] / bt.total_depth >= bt.min_af]
+        else:
+            bt.lrt_bases = [b for b in BASE if bt.depth[b] / bt.total_depth >= bt.min_af]
+
+        cdef int bases_num = len(bt.lrt_bases)
+        if bases_num == 0 or (bases_num == 1 and bt.lrt_bases[0] == bt._ref_base):
+            # no base or it's reference base.
+            return 0
+
+        cdef int ntype = bt.base_type_num
+        cdef int mask, j
+        bt.hyp_num = (1 << bases_num) - 1
+        memset(bt.hyp_init_allele_freq, 0, bt.hyp_num * ntype * sizeof(double))
+        for mask in range(1, bt.hyp_num + 1):
+            for j in range(bases_num):
+                if mask & (1 << j):
+                    bt.hyp_init_allele_freq[(mask - 1) * ntype + BASE2IDX[bt.lrt_bases[j]]] = (
+                        bt.depth[bt.lrt_bases[j]] / bt.total_depth)
+
+        return bt.hyp_num
+
+    cdef int _run_em(self, list basetypes) except -1:
+        """Run EM for all the hypotheses of ``basetypes``, share by the threads if more than one."""
+        cdef BaseType bt
+        cdef em_job *jobs
+        if len(basetypes) > self.job_capacity:
+            jobs = <em_job*>(realloc(self.jobs, len(basetypes) * sizeof(em_job)))
+            if jobs == NULL:
+                raise MemoryError("Could not allocate memory for jobs in BaseTypeEngine.")
+
+            self.jobs = jobs
+            self.job_capacity = len(basetypes)
+
+        self.job_num = 0
+        for bt in basetypes:
+            if bt.hyp_num == 0:
+                continue
+
+            self.jobs[self.job_num].init_allele_freq = bt.hyp_init_allele_freq
+            self.jobs[self.job_num].ind_allele_likelihood = bt.ind_allele_likelihood
+            self.jobs[self.job_num].weight = bt.lik_row_weight
+            self.jobs[self.job_num].sum_marginal_likelihood = bt.hyp_sum_marginal_likelihood
+            self.jobs[self.job_num].expect_allele_prob = bt.hyp_expect_allele_freq
+            self.jobs[self.job_num].nhyp = bt.hyp_num
+            self.jobs[self.job_num].nsample = bt.lik_row_num
+            self.jobs[self.job_num].status = 0
+            self.job_num += 1
+
+        cdef EMContext context
+        context.workspaces = self.workspaces
+        context.jobs = self.jobs
+        self.run_parallel(_em_kernel, &context, self.job_num)
+
+        cdef int i
+        for i in range(self.job_num):
+            if self.jobs[i].status != 0:
+                raise MemoryError("Could not allocate memory for EM in BaseTypeEngine.")
+
+        return 0
+
+    cdef int run_parallel(self, parallel_kernel kernel, void *context, int job_num) except -1:
+        """Run ``job_num`` jobs of ``kernel`` by the threads without GIL, return when all the jobs
+        are done. ``kernel`` must not touch any Python object.
+        """
+        if job_num == 0:
+            return 0
+
+        self.kernel = kernel
+        self.kernel_context = context
+        self.kernel_job_num = job_num
+        if self.pool is None or job_num < 2:
+            self._run_kernel(0, 1)
+        else:
+            self.pool.map(self._kernel_thread, range(min(self.thread_num, job_num)))
+
+        self.kernel = NULL
+        self.kernel_context = NULL
+        return 0
+
+    def _kernel_thread(self, int thread_index):
+        self._run_kernel(thread_index, min(self.thread_num, self.kernel_job_num))
+
+    cdef void _run_kernel(self, int thread_index, int thread_num):
+        """Run the jobs of ``thread_index`` and release GIL."""
+        cdef parallel_kernel kernel = self.kernel
+        cdef void *context = self.kernel_context
+        cdef int job_num = self.kernel_job_num
+        with nogil:
+            kernel(context, thread_index, thread_num, job_num)
+
+        return
+
+    cdef bint _lrt_by_hypotheses(self, BaseType bt):
+        """Walk from complex to simplicity after EM, just like ``BaseType.lrt``."""
+        if bt.hyp_num == 0:
+            return False
+
+        cdef int bases_num = len(bt.lrt_bases)
+        cdef int cur_mask = bt.hyp_num
+        cdef int comb_mask, min_mask
+        cdef double lr_alt = bt.hyp_sum_marginal_likelihood[cur_mask - 1]
+        cdef double chi_sqrt_value = 0
+        cdef double chi_value
+        cdef double min_chi_value = 0
+        cdef list index
+        cdef tuple comb
+        cdef int n, j
+        for n in range(1, bases_num)[::-1]:
+
+            index = [j for j in range(bases_num) if cur_mask & (1 << j)]
+            min_mask = 0
+            for comb in itertools.combinations(index, n):
+
+                comb_mask = 0
+                for j in comb:
+                    comb_mask |= 1 << j
+
+                chi_value = 2 * (lr_alt - bt.hyp_sum_marginal_likelihood[comb_mask - 1])
+                if min_mask == 0 or chi_value < min_chi_value:
+                    min_mask = comb_mask
+                    min_chi_value = chi_value
+
+            lr_alt = bt.hyp_sum_marginal_likelihood[min_mask - 1]
+            chi_sqrt_value = min_chi_value
+
+            # Take the null hypothesis and continue
+            if chi_sqrt_value < LRT_THRESHOLD:
+                cur_mask = min_mask
+
+            # Take the alternate hypothesis
+            else:
+                break
+
+        return bt._set_lrt_result([bt.lrt_bases[j] for j in range(bases_num) if cur_mask & (1 << j)],
+                                  bt.hyp_expect_allele_freq + (cur_mask - 1) * bt.base_type_num,
+                                  chi_sqrt_value)
+
+
+# The context of ``_em_kernel``
+cdef struct EMContext:
+    em_workspace **workspaces
+    em_job *jobs
+
+
+cdef void _em_kernel(void *context, int thread_index, int thread_num, int job_num) nogil:
+    """Run the EM jobs of ``thread_index`` with its own workspace."""
+    cdef EMContext *em = <EMContext*> context
+    em_run_jobs(em.workspaces[thread_index], em.jobs, thread_index, thread_num, job_num, EM_ITER_NUM, EM_EPSILON)
+    return
+
+
+cdef class PopGroupEngine:
+    """Gather the data of all the population groups in one pass over the samples of a position.
+
+    The group of each sample is recorded in a sample => group index array, so we don't have
+    to copy the bases and qualities into new arrays for each group.
+    """
+    def __cinit__(self, dict popgroup, int sample_size):
+        """
+        ``popgroup``: group_id => [a list samples_index]
+        ``sample_size``: The number of all the samples
+        """
+        self.groups = list(popgroup.keys())
+        self.group_num = len(self.groups)
+        self.sample_size = sample_size
+
+        self.sample_group = <int*>(malloc(max(1, sample_size) * sizeof(int)))
+        assert self.sample_group != NULL, "Could not allocate memory for sample_group in PopGroupEngine."
+
+        self.group_size = <int*>(calloc(max(1, self.group_num), sizeof(int)))
+        assert self.group_size != NULL, "Could not allocate memory for group_size in PopGroupEngine."
+
+        self.group_depth = <int*>(calloc(max(1, self.group_num * len(BASE)), sizeof(int)))
+        assert self.group_depth != NULL, "Could not allocate memory for group_depth in PopGroupEngine."
+
+        cdef int i, g
+        for i in range(sample_size):
+            self.sample_group[i] = -1
+
+        for g, group in enumerate(self.groups):
+            self.group_size[g] = len(popgroup[group])
+            for i in popgroup[group]:
+                self.sample_group[i] = g
+
+        self.class_index = NULL
+        self.class_capacity = 0
+
+    def __dealloc__(self):
+        """Free memory"""
+        if self.sample_group != NULL:
+            free(self.sample_group)
+            self.sample_group = NULL
+
+        if self.group_size != NULL:
+            free(self.group_size)
+            self.group_size = NULL
+
+        if self.group_depth != NULL:
+            free(self.group_depth)
+            self.group_depth = NULL
+
+        if self.class_index != NULL:
+            free(self.class_index)
+            self.class_index = NULL
+
+    cdef list base_depth_and_indel(self, char **bases):
+        """Base depth and indels of each group, the same as ``_base_depth_and_indel`` in variantcaller
+        for the bases of each group.
+
+        Return a list of [base_depth, indels] in the order of ``self.groups``
+        """
+        cdef list group_indels = self.group_indels(bases)
+        cdef list group_info = []
+        cdef int g, k
+        for g in range(self.group_num):
+            group_info.append([{b: self.group_depth[g * 4 + k] for k, b in enumerate(BASE)}, group_indels[g]])
+
+        return group_info
+
+    cdef list group_indels(self, char **bases):
+        """Count the depth of [A, C, G, T] of each group into ``self.group_depth`` and return the
+        indels of each group, which is "." if the group has no indel.
+        """
+        cdef list indel_depth = [None] * self.group_num
+        memset(self.group_depth, 0, self.group_num * len(BASE) * sizeof(int))
+
+        cdef int i, g, code
+        for i in range(self.sample_size):
+            g = self.sample_group[i]
+            if g < 0 or bases[i][0] == b'N':
+                continue
+
+            code = _base_code(bases[i])
+            if code < 4:
+                self.group_depth[g * 4 + code] += 1
+            else:
+                # Indel
+                if indel_depth[g] is None:
+                    indel_depth[g] = {}
+
+                indel_depth[g][bases[i]] = indel_depth[g].get(bases[i], 0) + 1
+
+        return [bytes(','.join([k + '|' + str(v) for k, v in indel_depth[g].items()])
+                      if indel_depth[g] else ".") for g in range(self.group_num)]
+
+    cdef list basetypes(self, bytes ref_base, char **bases, int *quals, float min_af):
+        """Create the BaseType of each group with the likelihood of (base, base quality) classes, which
+        is the same as ``BaseType.cinit`` with ``compress=True`` for the bases of each group.
+
+        Return a list of BaseType in the order of ``self.groups``
+        """
+        cdef int i, g, k, code
+        cdef int max_qual = 0
+        for i in range(self.sample_size):
+            if self.sample_group[i] < 0:
+                continue
+
+            if quals[i] < 0:
+                # Could not be compressed by base quality
+                return self._gather_basetypes(ref_base, bases, quals, min_af)
+
+            if quals[i] > max_qual:
+                max_qual = quals[i]
+
+        # [A, C, G, T] and one more for all the other bases
+        cdef int class_size = (len(BASE) + 1) * (max_qual + 1)
+        cdef int *class_index
+        if self.group_num * class_size > self.class_capacity:
+            class_index = <int*>(realloc(self.class_index, self.group_num * class_size * sizeof(int)))
+            assert class_index != NULL, "Could not allocate memory for class_index in PopGroupEngine."
+            self.class_index = class_index
+            self.class_capacity = self.group_num * class_size
+
+        for k in range(self.group_num * class_size):
+            self.class_index[k] = -1
+
+        cdef list group_bts = []
+        cdef BaseType bt
+        for g in range(self.group_num):
+            bt = BaseType()
+            bt._ref_base = ref_base
+            bt._alt_bases = None
+            bt._var_qual = 0.0
+            bt.min_af = min_af
+            bt.depth = {b: 0 for b in BASE}
+            bt.base_type_num = len(BASE)
+            bt.af_by_lrt = {}
+            bt.good_individual_num = 0
+
+            # For the samples of the group in order, as ``BaseType.cinit``
+            bt.qual_pvalue = <double*>(calloc(max(1, self.group_size[g]), sizeof(double)))
+            assert bt.qual_pvalue != NULL, "Could not allocate memory for qual_pvalue in PopGroupEngine."
+            bt._init_compressed_rows(min(self.group_size[g], class_size))
+            group_bts.append(bt)
+
+        memset(self.group_depth, 0, self.group_num * len(BASE) * sizeof(int))
+
+        cdef int *group_sample_num = <int*>(calloc(max(1, self.group_num), sizeof(int)))
+        assert group_sample_num != NULL, "Could not allocate memory for group_sample_num in PopGroupEngine."
+
+        cdef double qual_pvalue
+        for i in range(self.sample_size):
+            g = self.sample_group[i]
+            if g < 0:
+                continue
+
+            bt = group_bts[g]
+            qual_pvalue = 1.0 - exp(MLN10TO10 * quals[i])
+            bt.qual_pvalue[group_sample_num[g]] = qual_pvalue
+            group_sample_num[g] += 1
+
+            # ignore all the 'N' bases and indels.
+            if bases[i][0] == b'N' or bases[i][0] == b'-' or bases[i][0] == b'+':
+                continue
+
+            bt.good_individual_num += 1
+            code = bt._add_compressed_sample(self.class_index + g * class_size, max_qual, bases[i], quals[i],
+                                             qual_pvalue)
+            if code < 4:
+                self.group_depth[g * 4 + code] += 1
+
+        free(group_sample_num)
+
+        for g in range(self.group_num):
+            bt = group_bts[g]
+            for k, b in enumerate(BASE):
+                bt.depth[b] = self.group_depth[g * 4 + k]
+
+            bt.total_depth = float(sum(bt.depth.values()))
+
+        return group_bts
+
+    cdef list _gather_basetypes(self, bytes ref_base, char **bases, int *quals, float min_af):
+        """Copy the bases and qualities of each group and create the BaseType one by one."""
+        cdef list group_bts = []
+        cdef list index = [[] for _ in range(self.group_num)]
+        cdef int i, g
+        for i in range(self.sample_size):
+            if self.sample_group[i] >= 0:
+                index[self.sample_group[i]].append(i)
+
+        cdef char **group_bases = <char**>(calloc(max(1, self.sample_size), sizeof(char*)))
+        cdef int *group_quals = <int*>(calloc(max(1, self.sample_size), sizeof(int)))
+        assert group_bases != NULL and group_quals != NULL, (
+            "Could not allocate memory for group_bases in PopGroupEngine.")
+
+        cdef BaseType bt
+        for g in range(self.group_num):
+            for i in range(len(index[g])):
+                group_bases[i] = bases[index[g][i]]
+                group_quals[i] = quals[index[g][i]]
+
+            bt = BaseType()
+            bt.cinit(ref_base, group_bases, group_quals, len(index[g]), min_af, compress=True)
+            group_bts.append(bt)
+
+        free(group_bases)
+        free(group_quals)
+
+        return group_bts
@@ -4,6 +4,7 @@ Author: Shujia Huang
 Date: 2019-06-10 09:19:19
 """
 from basevar.io.fasta cimport FastaFile
+from basevar.io.bam cimport AlignmentReaderPool
 
 cdef class BaseVarProcess:
     cdef list samples
@@ -19,5 +20,8 @@ cdef class BaseVarProcess:
     cdef basestring cache_dir
 
     cdef object options
+    cdef AlignmentReaderPool reader_pool
+    cdef void run_in_regions(self)
+    cdef void close(self)
     cdef void run_variant_discovery_in_regions(self)
     cdef void run_variant_discovery_by_batchfiles(self)
@@ -8,11 +8,16 @@ import sys
 import time
 
 from basevar.io.fasta import FastaFile
+from basevar.io.bam cimport AlignmentReaderPool
+from basevar.io.htslibWrapper cimport init_io_thread_pool, destroy_io_thread_pool
+from basevar.io.batchfile import INDEX_SUFFIX
+from basevar.caller.manifest import file_md5
+from basevar.caller.algorithm import strand_cache_stats
 
 from basevar.log import logger
 from basevar import utils
 
-from basevar.caller.variantcaller import output_header
+from basevar.caller.variantcaller import output_header, open_cvg_file, open_vcf_file
 from basevar.caller.variantcaller cimport variants_discovery
 from basevar.caller.variantcaller cimport variant_discovery_in_regions
 from basevar.caller.batchcaller cimport create_batchfiles_in_regions
@@ -40,7 +45,7 @@ cdef class BaseVarProcess:
         self.samples = samples
 
         self.align_files = align_files
-        self.fa_file_hd = FastaFile(ref_file, ref_file + ".fai")
+        self.fa_file_hd = FastaFile(ref_file, ref_file + ".fai", access=options.reference_access)
 
         self.out_vcf_file = out_vcf_file
         self.out_cvg_file = out_cvg_file
@@ -48,6 +53,9 @@ cdef class BaseVarProcess:
         self.options = options
         self.cache_dir = cache_dir
 
+        # Keep the alignment files opened across chromosomes, at most ``max_open_files`` at the same time.
+        self.reader_pool = AlignmentReaderPool(options.max_open_files)
+
         self.regions = regions
         self.dict_regions = utils.regions2dict(regions)
 
@@ -58,15 +66,71 @@ cdef class BaseVarProcess:
             self.popgroup = utils.load_popgroup_info(self.samples, options.pop_group_file)
 
     def run(self):
-        # self.run_variant_discovery_in_regions()  # do not create batch files
-        self.run_variant_discovery_by_batchfiles()
+        # The htslib threads must be created in the process which reads the alignment files, and
+        # could only be destroyed after all the files have been closed by ``reader_pool``.
+        init_io_thread_pool(self.options.io_threads)
+
+        self.run_in_regions()
+
+        self.close()
+        destroy_io_thread_pool()
+        return
+
+    def run_windows(self, work_queue, result_queue):
+        """Take windows from ``work_queue`` and call variants in them one by one until get None.
+
+        Each window is (index, regions, out_cvg_file, out_vcf_file, cache_dir) and (index, pid,
+        seconds elapsed, md5 of out_cvg_file, md5 of out_vcf_file) is put into ``result_queue``
+        after the window is done.
+        The opened alignment files and htslib threads are kept for all the windows.
+        """
+        init_io_thread_pool(self.options.io_threads)
+
+        while True:
+            window = work_queue.get()
+            if window is None:
+                break
+
+            start_time = time.time()
+            index, self.regions, self.out_cvg_file, self.out_vcf_file, self.cache_dir = window
+            self.dict_regions = utils.regions2dict(self.regions)
+            if not self.options.without_batchfile:
+                utils.safe_makedir(self.cache_dir)
+
+            self.run_in_regions()
+
+            # The result is the proof of a successful window, the marker file is useless.
+            os.remove(self.out_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY")
+            result_queue.put((index, os.getpid(), time.time() - start_time, file_md5(self.out_cvg_file),
+                              file_md5(self.out_vcf_file) if self.out_vcf_file else None))
+
+        self.close()
+        destroy_io_thread_pool()
+        return
+
+    cdef void run_in_regions(self):
+        if self.options.without_batchfile:
+            self.run_variant_discovery_in_regions()  # do not create batch files
+        else:
+            self.run_variant_discovery_by_batchfiles()
+
+        return
+
+    cdef void close(self):
+        self.fa_file_hd.close()
+        logger.info("Alignment reader pool: %s" % self.reader_pool.stats())
+        logger.info("FS/SOR cache: %s" % strand_cache_stats())
+        self.reader_pool.close()
         return
 
     cdef void run_variant_discovery_by_batchfiles(self):
 
-        VCF = open(self.out_vcf_file, "w") if self.out_vcf_file else None
-        CVG = open(self.out_cvg_file, "w")
-        output_header(self.fa_file_hd.filename, self.samples, self.popgroup, CVG, out_vcf_handle=VCF)
+        VCF = open_vcf_file(self.out_vcf_file, self.options) if self.out_vcf_file else None
+        cdef bint sites_only = "sites" in self.options.vcf_mode
+
+        CVG = open_cvg_file(self.out_cvg_file, self.options)
+        output_header(self.fa_file_hd.filename, self.samples, self.popgroup, CVG, out_vcf_handle=VCF,
+                      sites_only=sites_only)
 
         if self.options.smartrerun:
             utils.safe_remove(utils.get_last_modification_file(self.cache_dir))
@@ -104,7 +168,8 @@ cdef class BaseVarProcess:
                                                       self.fa_file_hd,
                                                       self.samples,
                                                       self.cache_dir,
-                                                      self.options)
+                                                      self.options,
+                                                      self.reader_pool)
 
             logger.info("Batchfiles in %s:%s-%s for %d samples done, %d seconds elapsed." % (
                 chrid, region_boundary_start+1, region_boundary_end, sample_num, time.time() - start_time))
@@ -113,7 +178,7 @@ cdef class BaseVarProcess:
             logger.info("**************** variants discovery process ****************")
             try:
                 _is_empty = variants_discovery(chrid, batchfiles, self.popgroup, self.options.min_af,
-                                               CVG, VCF)
+                                               self.options.calling_threads, CVG, VCF, sites_only=sites_only)
             except Exception, e:
                 logger.error("Variants discovery in region %s:%s-%s. Error: %s" % (
                     chrid, region_boundary_start+1, region_boundary_end+1, e))
@@ -131,8 +196,6 @@ cdef class BaseVarProcess:
         if VCF:
             VCF.close()
 
-        self.fa_file_hd.close()
-
         if is_empty:
             logger.warning("\n***************************************************************************\n"
                            "[WARNING] No reads are satisfy with the mapping quality (>=%d) in all of your\n"
@@ -144,6 +207,8 @@ cdef class BaseVarProcess:
 
             for f in total_batch_files:
                 os.remove(f)
+                if os.path.exists(f + INDEX_SUFFIX):
+                    os.remove(f + INDEX_SUFFIX)
 
             try:
                 os.removedirs(self.cache_dir)
@@ -161,6 +226,7 @@ cdef class BaseVarProcess:
     cdef void run_variant_discovery_in_regions(self):
         """Run the process of calling variant without creating batch files.
         This function will hit A BIG IO problem when we need to read huge number of BAM files.
+        The regions are loaded and called window by window within ``options.memory_budget``.
         """
         start_time = time.time()
         cdef bint is_empty
@@ -173,7 +239,8 @@ cdef class BaseVarProcess:
                 self.popgroup,
                 self.out_cvg_file,
                 self.out_vcf_file,
-                self.options
+                self.options,
+                self.reader_pool
             )
 
         except Exception, e:
@@ -4,6 +4,7 @@ Author: Shujia Huang
 Date: 2019-06-04 16:13:08
 """
 from basevar.io.fasta cimport FastaFile
+from basevar.io.bam cimport AlignmentReaderPool
 
 cdef extern from "stdlib.h" nogil:
     void *calloc(size_t, size_t)
@@ -20,4 +21,5 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
                                        FastaFile fa,
                                        list sample_ids,
                                        basestring outdir,
-                                       object options)
\ No newline at end of file
+                                       object options,
+                                       AlignmentReaderPool reader_pool=*)
\ No newline at end of file
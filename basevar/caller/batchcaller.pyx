@@ -10,22 +10,24 @@ import time
 
 from basevar.log import logger
 
-from basevar.io.openfile import Open
 from basevar.io.fasta cimport FastaFile
-from basevar.io.bam cimport load_bamdata
+from basevar.io.batchfile import BATCHFILE_SUFFIX
+from basevar.io.batchfile cimport BatchFileWriter
+from basevar.io.bam cimport AlignmentReaderPool, load_bamdata
 from basevar.io.read cimport BamReadBuffer
-from basevar.caller.batch cimport BatchGenerator
+from basevar.caller.batch cimport BatchInfo, BatchGenerator
 
 
 cdef list create_batchfiles_in_regions(bytes chrom_name,
                                        list regions,
-                                       long int region_boundary_start, # 1-base
-                                       long int region_boundary_end,   # 1-base
+                                       long int region_boundary_start, # 0-base
+                                       long int region_boundary_end,   # 0-base
                                        list align_files,
                                        FastaFile fa,
                                        list samples,
                                        basestring outdir,
-                                       object options):
+                                       object options,
+                                       AlignmentReaderPool reader_pool=None):
     """
     ``regions`` is a 2-D array
         They all are the some chromosome: [[start1,end1], [start2, end2], ...]
@@ -35,6 +37,7 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
         # get sequence of chrom_name from reference fasta
         fa = self.ref_file_hd.fetch(chrid)
 
+    ``reader_pool``: alignment files will be kept opened in it for the next call if it's provided.
     """
     # store all the batch files
     cdef list batchfiles = []
@@ -53,8 +56,9 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
         start_time = time.time()
 
         m += 1
-        part_file_name = "basevar.%s.%d_%d.batch.gz" % (
-            "%s.%s.%s" % (chrom_name, region_boundary_start+1, region_boundary_end+1), m, part_num)
+        part_file_name = "basevar.%s.%d_%d.batch%s" % (
+            "%s.%s.%s" % (chrom_name, region_boundary_start+1, region_boundary_end+1), m, part_num,
+            BATCHFILE_SUFFIX)
         part_file_name = os.path.join(outdir, part_file_name)  # Join Path could fix different OS
 
         # store the name of batchfiles into a list.
@@ -75,15 +79,16 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
             batch_sample_ids = samples[i:i+batchcount]
 
         generate_batchfile(chrom_name,
-                           region_boundary_start,  # 1-base
-                           region_boundary_end,    # 1-base
+                           region_boundary_start,  # 0-base
+                           region_boundary_end,    # 0-base
                            regions,
                            sub_align_files,
                            refseq,
                            fa,
                            part_file_name,
                            batch_sample_ids,
-                           options)
+                           options,
+                           reader_pool)
 
         logger.info("Done for batchfile %s , %d seconds elapsed." % (
             part_file_name, time.time() - start_time))
@@ -92,15 +97,16 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
 
 
 cdef void generate_batchfile(bytes chrom_name,
-                             long int bigstart, # 1-base
-                             long int bigend,   # 1-base
+                             long int bigstart, # 0-base
+                             long int bigend,   # 0-base
                              list regions,
                              list batch_align_files,
                              char *ref_seq,
                              FastaFile fa,
                              bytes out_batch_file,
                              list batch_sample_ids,
-                             object options):
+                             object options,
+                             AlignmentReaderPool reader_pool):
 
     """Loading bamfile and create a batchfile in ``regions``.
 
@@ -120,7 +126,7 @@ cdef void generate_batchfile(bytes chrom_name,
     try:
         # load the whole mapping reads in [chrom_name, bigstart, bigend]
         sample_read_buffers = load_bamdata(bam_files, batch_sample_ids, chrom_name,
-                                           bigstart-1, bigend-1, ref_seq, options)
+                                           bigstart, bigend, ref_seq, options, reader_pool)
 
     except Exception, e:
         logger.error("Exception in region %s:%s-%s. Error: %s" % (chrom_name, bigstart, bigend, e))
@@ -173,23 +179,15 @@ cdef void output_batch_file(bytes chrom_name, FastaFile fa, list region_batch_bu
     cdef int position_number = 0
     cdef int i = 0, j = 0
     cdef BatchGenerator batch_buffer
-    with Open(out_batch_file, "wb", isbgz=True) if out_batch_file.endswith(".gz") else \
-            open(out_batch_file, "w") as OUT:
-
-        OUT.write("##fileformat=BaseVarBatchFile_v1.0\n")
-        if batch_sample_ids:
-            OUT.write("##SampleIDs=%s\n" % ",".join(batch_sample_ids))
-
-        suff_header = ["#CHROM", "POS", "REF", "Depth(CoveredSample)", "MappingQuality", "Readbases",
-                       "ReadbasesQuality", "ReadPositionRank", "Strand"]
-        OUT.write("%s\n" % "\t".join(suff_header))
+    cdef BatchFileWriter writer
+    with BatchFileWriter(out_batch_file, chrom_name, batch_sample_ids) as writer:
 
         for i in range(region_number):
 
             batch_buffer = region_batch_buffers[i]
             position_number = len(batch_buffer.batch_heap)
             for j in range(position_number):
-                OUT.write("%s\n" % batch_buffer.batch_heap[j])
+                writer.write(<BatchInfo> batch_buffer.batch_heap[j])
     return
 
 
@@ -0,0 +1,31 @@
+"""Header for the CVG record encoder
+"""
+from basevar.caller.batch cimport BatchInfo
+from basevar.caller.basetype cimport PopGroupEngine
+
+
+# The statistics of a CVG record, which could be counted without GIL
+cdef struct CVGStats:
+    int depth[4]  # => [A, C, G, T]
+    int ref_fwd
+    int ref_rev
+    int alt_fwd
+    int alt_rev
+    int indel_num
+    double fs
+    double sor
+
+cdef int cvg_stats(char **bases, char *strands, int size, const char *ref_base, CVGStats *stats) nogil
+
+
+cdef class CVGWriter:
+    cdef object out_handle
+    cdef char *buffer
+    cdef Py_ssize_t size
+    cdef Py_ssize_t capacity
+    cdef readonly long int line_num
+
+    cdef int _put(self, const char *s, Py_ssize_t n) except -1
+    cdef int _put_int(self, long int x) except -1
+    cdef int _put_float(self, double x) except -1
+    cdef int write_record(self, BatchInfo batchinfo, PopGroupEngine group_engine, CVGStats *stats=*) except -1
@@ -0,0 +1,243 @@
+# cython: profile=True
+"""Encoder of CVG records
+
+A CVG record is output for every covered position, so the depth of bases, strand counts and
+the text of the record are all done in C and the records are written in bulk from a buffer.
+"""
+from cpython cimport PyBytes_FromStringAndSize
+from libc.stdio cimport snprintf
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy, memset
+
+from basevar.caller.algorithm cimport fisher_strand_and_sor
+from basevar.caller.batch cimport BatchInfo
+from basevar.caller.basetype cimport PopGroupEngine
+
+# Flush the buffer once it's full
+DEF BUFFER_SIZE = 1 << 20
+
+
+cdef inline int _base_code(const char *b) nogil:
+    """Return the index of ``b`` in [A, C, G, T], or 4 for any other base."""
+    if b[0] == 0 or b[1] != 0:
+        return 4
+
+    if b[0] == b'A':
+        return 0
+    elif b[0] == b'C':
+        return 1
+    elif b[0] == b'G':
+        return 2
+    elif b[0] == b'T':
+        return 3
+    else:
+        return 4
+
+
+cdef class CVGWriter:
+    """Write CVG records into ``out_handle`` (any object with ``write`` and ``close``) by a buffer.
+
+    The header and any other text could be written by ``write``, in order with the records.
+    """
+    def __cinit__(self, out_handle, Py_ssize_t buffer_size=BUFFER_SIZE):
+        self.out_handle = out_handle
+        self.capacity = max(1024, buffer_size)
+        self.size = 0
+        self.line_num = 0
+
+        self.buffer = <char *> malloc(self.capacity * sizeof(char))
+        assert self.buffer != NULL, "Could not allocate memory for the buffer of CVGWriter."
+
+    def __dealloc__(self):
+        if self.buffer != NULL:
+            free(self.buffer)
+            self.buffer = NULL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def write(self, bytes text):
+        self._put(text, len(text))
+
+    def flush(self):
+        if self.size > 0:
+            self.out_handle.write(PyBytes_FromStringAndSize(self.buffer, self.size))
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.out_handle.close()
+
+    cdef int _put(self, const char *s, Py_ssize_t n) except -1:
+        if self.size + n > self.capacity:
+            self.flush()
+
+            if n > self.capacity:
+                self.buffer = <char *> realloc(self.buffer, n * sizeof(char))
+                assert self.buffer != NULL, "Could not allocate memory for the buffer of CVGWriter."
+                self.capacity = n
+
+        memcpy(self.buffer + self.size, s, n)
+        self.size += n
+        return 0
+
+    cdef int _put_int(self, long int x) except -1:
+        cdef char tmp[24]
+        cdef int i = 24
+        cdef bint negative = x < 0
+        if negative:
+            x = -x
+
+        while True:
+            i -= 1
+            tmp[i] = <char> (ord('0') + x % 10)
+            x //= 10
+            if x == 0:
+                break
+
+        if negative:
+            i -= 1
+            tmp[i] = b'-'
+
+        return self._put(tmp + i, 24 - i)
+
+    cdef int _put_float(self, double x) except -1:
+        # The same as "%.3f" % x in Python
+        cdef char tmp[64]
+        cdef int n = snprintf(tmp, 64, "%.3f", x)
+        return self._put(tmp, n)
+
+    cdef int write_record(self, BatchInfo batchinfo, PopGroupEngine group_engine, CVGStats *stats=NULL) except -1:
+        """Output the coverage of ``batchinfo``, nothing will be output if no [A, C, G, T] covers it.
+        ``stats`` are the statistics of ``batchinfo`` by ``cvg_stats`` and FS/SOR of the strand counts,
+        which are counted here if it's NULL.
+
+        The same as the record of the Python formatter it replaced, which is
+            CHROM POS REF Depth A C G T Indels FS SOR REF_FWD,REF_REV,ALT_FWD,ALT_REV [Group ...]
+        """
+        cdef bytes ref_base = batchinfo.ref_base
+        cdef bytes upper_ref_base = ref_base.upper()
+        cdef bint is_local = stats == NULL
+        cdef CVGStats local_stats
+        cdef int i
+        if is_local:
+            stats = &local_stats
+            i = cvg_stats(batchinfo.sample_bases, batchinfo.strands, batchinfo.size, upper_ref_base, stats)
+            if i >= 0:
+                raise ValueError('[ERROR] Get strange strand symbol: "%s"' % chr(batchinfo.strands[i]))
+
+        cdef int total_depth = stats.depth[0] + stats.depth[1] + stats.depth[2] + stats.depth[3]
+        if total_depth == 0:
+            return 0
+
+        if is_local:
+            fisher_strand_and_sor(stats.ref_fwd, stats.ref_rev, stats.alt_fwd, stats.alt_rev, &stats.fs, &stats.sor)
+
+        cdef dict indel_depth = {}
+        cdef char *b
+        if stats.indel_num > 0:
+            for i in range(batchinfo.size):
+                b = batchinfo.sample_bases[i]
+                if b[0] != b'N' and _base_code(b) == 4:
+                    indel_depth[b] = indel_depth.get(b, 0) + 1
+
+        self._put(batchinfo.chrid, len(batchinfo.chrid))
+        self._put("\t", 1)
+        self._put_int(batchinfo.position)
+        self._put("\t", 1)
+        self._put(ref_base, len(ref_base))
+        self._put("\t", 1)
+        self._put_int(total_depth)
+        for i in range(4):
+            self._put("\t", 1)
+            self._put_int(stats.depth[i])
+
+        cdef bytes indels = bytes(','.join([k + '|' + str(v) for k, v in indel_depth.items()])) \
+            if indel_depth else b"."
+        self._put("\t", 1)
+        self._put(indels, len(indels))
+        self._put("\t", 1)
+        self._put_float(stats.fs)
+        self._put("\t", 1)
+        self._put_float(stats.sor)
+        self._put("\t", 1)
+        self._put_int(stats.ref_fwd)
+        self._put(",", 1)
+        self._put_int(stats.ref_rev)
+        self._put(",", 1)
+        self._put_int(stats.alt_fwd)
+        self._put(",", 1)
+        self._put_int(stats.alt_rev)
+
+        # base depth and indels for each subgroup
+        cdef list group_indels
+        cdef int g
+        if group_engine.group_num > 0:
+            group_indels = group_engine.group_indels(batchinfo.sample_bases)
+            for g in range(group_engine.group_num):
+                for i in range(4):
+                    self._put("\t" if i == 0 else ":", 1)
+                    self._put_int(group_engine.group_depth[g * 4 + i])
+
+                if group_indels[g] != b".":
+                    self._put(":", 1)
+                    self._put(group_indels[g], len(group_indels[g]))
+
+        self._put("\n", 1)
+        self.line_num += 1
+        return 0
+
+
+cdef int cvg_stats(char **bases, char *strands, int size, const char *ref_base, CVGStats *stats) nogil:
+    """Count the depth of [A, C, G, T] and indels and the strands of REF and the top ALT base of a
+    position into ``stats`` without GIL, all but FS and SOR of the strand counts.
+
+    Return -1, or the index of the first base with a strange strand symbol.
+    """
+    cdef int fwd[4]
+    cdef int rev[4]
+    memset(stats.depth, 0, sizeof(stats.depth))
+    memset(fwd, 0, sizeof(fwd))
+    memset(rev, 0, sizeof(rev))
+    stats.indel_num = 0
+
+    cdef const char *b
+    cdef int i, code
+    for i in range(size):
+        b = bases[i]
+        if b[0] == b'N':
+            continue
+
+        code = _base_code(b)
+        if code < 4:
+            stats.depth[code] += 1
+            if strands[i] == b'+':
+                fwd[code] += 1
+            elif strands[i] == b'-':
+                rev[code] += 1
+            else:
+                return i
+        else:
+            # Indel
+            stats.indel_num += 1
+
+    # The top 2 bases, the first one wins when they have the same depth (the same as a stable sort).
+    cdef int b1 = 0, b2 = -1
+    for i in range(1, 4):
+        if stats.depth[i] > stats.depth[b1]:
+            b1 = i
+
+    for i in range(4):
+        if i != b1 and (b2 < 0 or stats.depth[i] > stats.depth[b2]):
+            b2 = i
+
+    cdef int ref_code = _base_code(ref_base)
+    cdef int alt_code = b1 if b1 != ref_code else b2
+    stats.ref_fwd = fwd[ref_code] if ref_code < 4 else 0
+    stats.ref_rev = rev[ref_code] if ref_code < 4 else 0
+    stats.alt_fwd = fwd[alt_code]
+    stats.alt_rev = rev[alt_code]
+    return -1
@@ -4,6 +4,12 @@ This is a caller process
 import sys
 import time
 import multiprocessing
+try:
+    from Queue import Empty
+except ImportError:  # Python 3
+    from queue import Empty
+
+from basevar.log import logger
 
 
 class CallerProcess(multiprocessing.Process):
@@ -25,6 +31,18 @@ class CallerProcess(multiprocessing.Process):
         return self.single_process.run()
 
 
+class WindowWorker(CallerProcess):
+    """A process which keeps taking windows from ``work_queue`` until it gets None."""
+
+    def __init__(self, work_queue, result_queue, func, *args, **kwargs):
+        CallerProcess.__init__(self, func, *args, **kwargs)
+        self.work_queue = work_queue
+        self.result_queue = result_queue
+
+    def run(self):
+        return self.single_process.run_windows(self.work_queue, self.result_queue)
+
+
 def process_runner(processes):
     """run and monitor the process"""
 
@@ -49,3 +67,72 @@ def process_runner(processes):
         p.join()
 
     return
+
+
+def window_runner(workers, tasks, work_queue, result_queue, on_done=None):
+    """Feed ``tasks`` to ``workers`` by ``work_queue`` and monitor the progress.
+
+    ``tasks`` is a list of (weight, window), window is (index, regions, ...) which is put into
+    ``work_queue`` from the heaviest one, so that a big window will not be left to the end.
+    Every worker puts (index, pid, seconds elapsed, ...) into ``result_queue`` once a window is done,
+    which is passed to ``on_done`` if it's provided.
+    """
+    cdef dict regions = {}
+    cdef long int total_size = 0
+    for _, window in tasks:
+        regions[window[0]] = window[1]
+        total_size += sum([e - s + 1 for _, s, e in window[1]])
+
+    for _, window in sorted(tasks, key=lambda x: x[0], reverse=True):
+        work_queue.put(window)
+
+    # One stop signal for each worker
+    for _ in workers:
+        work_queue.put(None)
+
+    for p in workers:
+        p.start()
+
+    cdef int done_num = 0
+    cdef int task_num = len(tasks)
+    cdef long int done_size = 0, size
+    start_time = time.time()
+    while done_num < task_num:
+        try:
+            result = result_queue.get(timeout=1)
+
+        except KeyboardInterrupt:
+            sys.stderr.write('KeyboardInterrupt detected, terminating '
+                             'all processes...\n')
+            for p in workers:
+                p.terminate()
+
+            sys.exit(1)
+
+        except Empty:
+            if True not in [p.is_alive() for p in workers]:
+                logger.error("All the workers stopped with %d/%d windows done." % (done_num, task_num))
+                sys.exit(1)
+
+            continue
+
+        index, pid, elapsed = result[:3]
+        if on_done is not None:
+            on_done(result)
+
+        done_num += 1
+        size = sum([e - s + 1 for _, s, e in regions[index]])
+        done_size += size
+
+        total_elapsed = time.time() - start_time
+        logger.info("[%d/%d] Window %d %s:%s-%s done by process %d, %d positions in %d seconds (%.1f positions/s). "
+                    "%.1f%% positions done, about %d seconds left." % (
+                        done_num, task_num, index, regions[index][0][0], regions[index][0][1], regions[index][-1][2],
+                        pid, size, elapsed, size / elapsed if elapsed > 0 else 0.0,
+                        100.0 * done_size / total_size if total_size else 100.0,
+                        total_elapsed * (total_size - done_size) / done_size if done_size else 0))
+
+    for p in workers:
+        p.join()
+
+    return
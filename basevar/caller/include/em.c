@@ -3,13 +3,13 @@
 */
 #include <math.h>
 #include <stdlib.h>
+#include <string.h>
 #include "em.h"
 
 static void singleEM(double *allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
-                     double *expect_allele_prob, int nsample, int ntype) {
-    double *likelihood = (double *) calloc(ntype, sizeof(double));
-    double *ind_allele_prob = (double *) calloc(ntype * nsample, sizeof(double)); // covert ind_allele_prob to col major
-    // step E 
+                     double *expect_allele_prob, double *likelihood, double *ind_allele_prob,
+                     double *weight, double total_weight, int nsample, int ntype) {
+    // step E
     int i, j;
     for(i=0; i<nsample; ++i){
         for(j=0; j<ntype; ++j){
@@ -19,20 +19,18 @@ static void singleEM(double *allele_freq, double *ind_allele_likelihood, double
         for(j=0; j<ntype; ++j){
             /* col major may be fast for step M
              * need to deal with marginal_likelihood[i] is close to zero */
-            ind_allele_prob[j * nsample + i] = likelihood[j] / marginal_likelihood[i]; 
+            ind_allele_prob[j * nsample + i] = likelihood[j] / marginal_likelihood[i];
         }
     }
-    free(likelihood);
 
     // step M
     for(j=0; j<ntype; ++j){
         for(i=0; i<nsample; ++i){
-            expect_allele_prob[j] += ind_allele_prob[j * nsample + i]; 
+            expect_allele_prob[j] += (weight ? weight[i] : 1.0) * ind_allele_prob[j * nsample + i];
         }
-        expect_allele_prob[j] = expect_allele_prob[j] / nsample;
+        expect_allele_prob[j] = expect_allele_prob[j] / total_weight;
     }
-    free(ind_allele_prob);
-    
+
     return;
 }
 
@@ -46,46 +44,181 @@ static void update_allele_freq(double *allele_freq, double *expect_allele_prob,
     return;
 }
 
-static double delta_bylog(double *bf, double *af, int n) {
+static double delta_bylog(double *bf, double *af, double *weight, int n) {
     double delta = 0.0;
     int i;
     for(i=0; i<n; ++i){
         // need to deal with log(0) == inf;
-        delta += fabs(log(af[i]) - log(bf[i]));
+        delta += (weight ? weight[i] : 1.0) * fabs(log(af[i]) - log(bf[i]));
         bf[i] = af[i];
         af[i] = 0.0;
     }
     return delta;
 }
 
-void em(double *init_allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
-        double *expect_allele_prob, int nsample, int ntype, int iter_num, double epsilon) {
+/*
+ * The EM iteration itself. All the scratch buffers come from ``ws`` and ``marginal_likelihood``,
+ * ``expect_allele_prob`` must be zero when calling this function.
+ *
+ * Each row of ``ind_allele_likelihood`` stands for ``weight[i]`` samples with the same likelihood,
+ * or just one sample if ``weight`` is NULL.
+ */
+static void em_core(em_workspace *ws, double *init_allele_freq, double *ind_allele_likelihood,
+                    double *marginal_likelihood, double *expect_allele_prob, double *weight,
+                    int nsample, int iter_num, double epsilon) {
 
-    double *af_marginal_likelihood = (double *) calloc(nsample, sizeof(double));
-    double *allele_freq = (double *) malloc(ntype * sizeof(double));
+    int ntype = ws->ntype;
     double delta;
+    double total_weight = 0.0;
     int i, j;
 
+    if (weight) {
+        for(i = 0; i < nsample; ++i){
+            total_weight += weight[i];
+        }
+    } else {
+        total_weight = nsample;
+    }
+
     /*
-     copy allele_freq in case that init_allele_freq be modified; 
+     copy allele_freq in case that init_allele_freq be modified;
     */
     for(j = 0; j < ntype; ++j){
-	    allele_freq[j] = init_allele_freq[j];
+        ws->allele_freq[j] = init_allele_freq[j];
     }
-    singleEM(allele_freq, ind_allele_likelihood, marginal_likelihood, expect_allele_prob, nsample, ntype);
+    memset(ws->af_marginal_likelihood, 0, nsample * sizeof(double));
+
+    singleEM(ws->allele_freq, ind_allele_likelihood, marginal_likelihood, expect_allele_prob,
+             ws->likelihood, ws->ind_allele_prob, weight, total_weight, nsample, ntype);
 
     for(i=0; i<iter_num; ++i){
-        update_allele_freq(allele_freq, expect_allele_prob, ntype);
-        singleEM(allele_freq, ind_allele_likelihood, af_marginal_likelihood, expect_allele_prob, nsample, ntype);
-        delta = delta_bylog(marginal_likelihood, af_marginal_likelihood, nsample);
+        update_allele_freq(ws->allele_freq, expect_allele_prob, ntype);
+        singleEM(ws->allele_freq, ind_allele_likelihood, ws->af_marginal_likelihood, expect_allele_prob,
+                 ws->likelihood, ws->ind_allele_prob, weight, total_weight, nsample, ntype);
+        delta = delta_bylog(marginal_likelihood, ws->af_marginal_likelihood, weight, nsample);
         if(delta < epsilon){
             break;
         }
     }
 
-    free(af_marginal_likelihood);
-    free(allele_freq);
+    return;
+}
+
+em_workspace *em_workspace_init(int nsample, int ntype) {
+
+    em_workspace *ws = (em_workspace *) calloc(1, sizeof(em_workspace));
+    if (ws == NULL) return NULL;
+
+    ws->ntype = ntype;
+    ws->likelihood = (double *) calloc(ntype, sizeof(double));
+    ws->allele_freq = (double *) calloc(ntype, sizeof(double));
+    if (ws->likelihood == NULL || ws->allele_freq == NULL || em_workspace_reserve(ws, nsample) != 0) {
+        em_workspace_destroy(ws);
+        return NULL;
+    }
+
+    return ws;
+}
+
+int em_workspace_reserve(em_workspace *ws, int nsample) {
+
+    double *ind_allele_prob, *marginal_likelihood, *af_marginal_likelihood;
+    if (nsample <= ws->capacity) return 0;
+
+    // Grow geometrically, the sample size of neighbouring positions is almost the same.
+    if (nsample < 2 * ws->capacity) nsample = 2 * ws->capacity;
+
+    ind_allele_prob = (double *) realloc(ws->ind_allele_prob, (size_t)nsample * ws->ntype * sizeof(double));
+    if (ind_allele_prob == NULL) return -1;
+    ws->ind_allele_prob = ind_allele_prob;
+
+    marginal_likelihood = (double *) realloc(ws->marginal_likelihood, nsample * sizeof(double));
+    if (marginal_likelihood == NULL) return -1;
+    ws->marginal_likelihood = marginal_likelihood;
+
+    af_marginal_likelihood = (double *) realloc(ws->af_marginal_likelihood, nsample * sizeof(double));
+    if (af_marginal_likelihood == NULL) return -1;
+    ws->af_marginal_likelihood = af_marginal_likelihood;
+
+    ws->capacity = nsample;
+    return 0;
+}
+
+void em_workspace_destroy(em_workspace *ws) {
+
+    if (ws == NULL) return;
+
+    free(ws->likelihood);
+    free(ws->allele_freq);
+    free(ws->ind_allele_prob);
+    free(ws->marginal_likelihood);
+    free(ws->af_marginal_likelihood);
+    free(ws);
 
     return;
 }
 
+int em_hypotheses(em_workspace *ws, double *init_allele_freq, double *ind_allele_likelihood,
+                  double *weight, double *sum_marginal_likelihood, double *expect_allele_prob,
+                  int nhyp, int nsample, int iter_num, double epsilon) {
+
+    int ntype = ws->ntype;
+    double s;
+    int h, i, j;
+
+    if (em_workspace_reserve(ws, nsample) != 0) return -1;
+
+    for(h=0; h<nhyp; ++h){
+
+        sum_marginal_likelihood[h] = 0.0;
+        memset(expect_allele_prob + h * ntype, 0, ntype * sizeof(double));
+
+        // Hypothesis without any supporting base is not a hypothesis, skip it.
+        s = 0.0;
+        for(j=0; j<ntype; ++j){
+            s += init_allele_freq[h * ntype + j];
+        }
+        if(s == 0){
+            continue;
+        }
+
+        memset(ws->marginal_likelihood, 0, nsample * sizeof(double));
+        em_core(ws, init_allele_freq + h * ntype, ind_allele_likelihood, ws->marginal_likelihood,
+                expect_allele_prob + h * ntype, weight, nsample, iter_num, epsilon);
+
+        s = 0.0;
+        for(i=0; i<nsample; ++i){
+            s += (weight ? weight[i] : 1.0) * log(ws->marginal_likelihood[i]);
+        }
+        sum_marginal_likelihood[h] = s;
+    }
+
+    return 0;
+}
+
+void em_run_jobs(em_workspace *ws, em_job *jobs, int start, int step, int njob, int iter_num, double epsilon) {
+
+    int i;
+    em_job *job;
+    for(i = start; i < njob; i += step){
+        job = jobs + i;
+        job->status = em_hypotheses(ws, job->init_allele_freq, job->ind_allele_likelihood, job->weight,
+                                    job->sum_marginal_likelihood, job->expect_allele_prob, job->nhyp,
+                                    job->nsample, iter_num, epsilon);
+    }
+
+    return;
+}
+
+void em(double *init_allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
+        double *expect_allele_prob, int nsample, int ntype, int iter_num, double epsilon) {
+
+    em_workspace *ws = em_workspace_init(nsample, ntype);
+    if (ws == NULL) return;
+
+    em_core(ws, init_allele_freq, ind_allele_likelihood, marginal_likelihood, expect_allele_prob,
+            NULL, nsample, iter_num, epsilon);
+
+    em_workspace_destroy(ws);
+    return;
+}
@@ -1,6 +1,57 @@
 #ifndef EM_H
 #define EM_H
 
+/*
+ * Preallocated scratch memory for EM, could be reused by positions one after another
+ * to avoid calloc/free in every EM iteration.
+ */
+typedef struct {
+    int capacity;                    // max sample size the buffers could hold
+    int ntype;                       // number of base types, 4 for [A, C, G, T]
+    double *likelihood;              // ntype
+    double *allele_freq;             // ntype
+    double *ind_allele_prob;         // capacity * ntype, col major
+    double *marginal_likelihood;     // capacity
+    double *af_marginal_likelihood;  // capacity
+} em_workspace;
+
+em_workspace *em_workspace_init(int nsample, int ntype);
+int em_workspace_reserve(em_workspace *ws, int nsample);
+void em_workspace_destroy(em_workspace *ws);
+
+/*
+ * Run EM for ``nhyp`` hypotheses of initial allele frequencies (``init_allele_freq`` is a nhyp * ntype
+ * row major matrix) over the same nsample * ntype ``ind_allele_likelihood`` matrix. The sum of log marginal
+ * likelihood and the expected allele frequencies of each hypothesis are recorded in
+ * ``sum_marginal_likelihood`` and ``expect_allele_prob`` (nhyp * ntype). Return -1 if fail to allocate memory.
+ *
+ * ``weight`` could be NULL, otherwise row i of ``ind_allele_likelihood`` is a class of ``weight[i]``
+ * samples which have the same likelihood (e.g. the same base and base quality).
+ */
+int em_hypotheses(em_workspace *ws, double *init_allele_freq, double *ind_allele_likelihood,
+                  double *weight, double *sum_marginal_likelihood, double *expect_allele_prob,
+                  int nhyp, int nsample, int iter_num, double epsilon);
+
+/*
+ * All the EM input and output of one position, so that a bunch of positions could be shared by threads.
+ */
+typedef struct {
+    double *init_allele_freq;         // nhyp * ntype
+    double *ind_allele_likelihood;    // nsample * ntype
+    double *weight;                   // nsample or NULL
+    double *sum_marginal_likelihood;  // nhyp
+    double *expect_allele_prob;       // nhyp * ntype
+    int nhyp;
+    int nsample;
+    int status;                       // return value of em_hypotheses
+} em_job;
+
+/*
+ * Run the jobs of index start, start + step, start + 2*step ... < njob with the workspace ``ws``,
+ * one thread should hold one workspace. Do not touch any Python object, could be called without GIL.
+ */
+void em_run_jobs(em_workspace *ws, em_job *jobs, int start, int step, int njob, int iter_num, double epsilon);
+
 void em(double *init_allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
         double *expect_allele_prob, int nsample, int ntype, int iter_num, double epsilon);
 
@@ -15,7 +15,7 @@ static int compare_floats(const void* a, const void* b) {
     return 0;
 }
 
-static double rankR1(double *x, int n1, double *y, int n2) {
+static double rankR1(double *x, int n1, double *y, int n2, double *tie_sum) {
     // merge and store the index of sample1
     int ia = n1 - 1;
     int ib = n2 - 1;
@@ -42,8 +42,9 @@ static double rankR1(double *x, int n1, double *y, int n2) {
             }
         }
     }
-    // average method
+    // average method, sum of (t^3 - t) for the ties of size t is set to ``tie_sum``
     int k = 0, n = 0;
+    *tie_sum = 0;
     for (i = 0; i < n1 + n2; i++){
         if (i + 1 < n1 + n2 && x[i] == x[i+1]) {
             k += i + 1;
@@ -52,6 +53,7 @@ static double rankR1(double *x, int n1, double *y, int n2) {
             if (k > 0) {
                 k += i + 1;
                 double avg = (double)k / (n + 1);
+                *tie_sum += ((double)(n + 1) * (n + 1) - 1) * (n + 1);
                 for (j = i; j >= i - n; j--) {
                     x[j] = avg;
                 }
@@ -80,9 +82,13 @@ double RankSumTest(double *x, int n1, double *y, int n2) {
     qsort(x, n1, sizeof(double), compare_floats);
     qsort(y, n2, sizeof(double), compare_floats);
     memcpy(xx, x, n1 * sizeof(double));
-    double r1 = rankR1(xx, n1, y, n2);
+    double tie_sum;
+    double r1 = rankR1(xx, n1, y, n2, &tie_sum);
     double expected = (double)n1 * (n1 + n2 + 1) / 2.0; // fix an unexpected issue 
-    double z = (r1 - expected) / sqrt((double)n1*n2*(n1+n2+1)/12.0);
+
+    // variance with tie correction, 0 if all the values are the same
+    double variance = (double)n1 * n2 / 12.0 * ((n + 1) - tie_sum / ((double)n * (n - 1)));
+    double z = variance > 0 ? (r1 - expected) / sqrt(variance) : 0.0;
 
     free(xx);
     return z;
@@ -10,17 +10,25 @@ the lord to rule them all, in a word, it's "The Ring".
 import os
 import sys
 import time
+import multiprocessing
 
 from basevar.log import logger
 from basevar import utils
-from basevar.utils cimport generate_regions_by_process_num
+from basevar.utils cimport generate_regions_by_process_num, generate_windows
 
-from basevar.io.bam cimport get_sample_names
-from basevar.caller.do import CallerProcess, process_runner
+from basevar.io.bam cimport get_sample_names, get_window_weights
+from basevar.io.fasta import is_packed_reference_updated, pack_reference
+from basevar.caller.do import CallerProcess, WindowWorker, process_runner, window_runner
 from basevar.caller.basetypeprocess cimport BaseVarProcess
+from basevar.caller.manifest import WindowManifest, parameter_hash
 from basevar.caller.vqsr import vqsr
 
 
+def _temp_file_name(out_file_name, suffix):
+    """``out.cvg.gz`` => ``out.cvg.gz<suffix>.gz``, the temporary file is in BGZF too"""
+    return out_file_name + suffix + ('.gz' if out_file_name.endswith('.gz') else '')
+
+
 class BaseTypeRunner(object):
 
     def __init__(self, args):
@@ -37,15 +45,19 @@ class BaseTypeRunner(object):
         self.outcvg = args.outcvg
         self.options = args
 
+        if args.reference_access == "2bit" and not is_packed_reference_updated(self.reference_file):
+            logger.info("Packing %s into 2 bits for --reference-access 2bit." % self.reference_file)
+            pack_reference(self.reference_file)
+
         # setting the resolution of MAF
         self.options.min_af = utils.set_minaf(len(self.alignfiles)) if (args.min_af is None) else args.min_af
         logger.info("Finish loading arguments and we have %d BAM/CRAM files for "
                     "variants calling." % len(self.alignfiles))
 
         # Loading positions if not been provided we'll load all the genome
-        regions = utils.load_target_position(self.reference_file, args.positions, args.regions)
+        self.regions = utils.load_target_position(self.reference_file, args.positions, args.regions)
         self.regions_for_each_process = generate_regions_by_process_num(
-            regions, process_num=self.nCPU, convert_to_2d=False)
+            self.regions, process_num=self.nCPU, convert_to_2d=False)
 
         # ``samples_id`` has the same size and order as ``aligne_files``
         self.sample_id = get_sample_names(self.alignfiles, True if args.filename_has_samplename else False)
@@ -63,6 +75,8 @@ class BaseTypeRunner(object):
         Run variant caller
         """
         sys.stderr.write('[INFO] Start call variants by BaseType ... %s\n' % time.asctime())
+        if self.options.window_size > 0:
+            return self.basevar_caller_by_windows()
 
         cdef list out_vcf_names = []
         cdef list out_cvg_names = []
@@ -72,12 +86,14 @@ class BaseTypeRunner(object):
         # Always create process manager even if nCPU==1, so that we can
         # listen signals from main thread
         for i in range(self.nCPU):
-            sub_cvg_file = self.outcvg + '.temp_%d_%d' % (i+1, self.nCPU)
+            # Keep the temporary files in BGZF if the final output is, then they could be merged
+            # by concatenating their BGZF blocks.
+            sub_cvg_file = _temp_file_name(self.outcvg, '.temp_%d_%d' % (i+1, self.nCPU))
             out_cvg_names.append(sub_cvg_file)
             successful_marker_files.append(sub_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY")
 
             if self.outvcf:
-                sub_vcf_file = self.outvcf + '.temp_%d_%d' % (i+1, self.nCPU)
+                sub_vcf_file = _temp_file_name(self.outvcf, '.temp_%d_%d' % (i+1, self.nCPU))
                 out_vcf_names.append(sub_vcf_file)
             else:
                 sub_vcf_file = None
@@ -130,7 +146,9 @@ class BaseTypeRunner(object):
 
         # Final output if all the processes are ending successful!
         if all_process_success:
-            utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf)
+            utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf,
+                                     compress_level=self.options.compress_level,
+                                     threads=self.options.write_threads)
             logger.info("All the processes are done successful.")
         else:
             logger.error("The program is fail in [%s] processes. Abort!" % ",".join(map(str, fail_process_num)))
@@ -138,6 +156,72 @@ class BaseTypeRunner(object):
 
         return all_process_success
 
+    def basevar_caller_by_windows(self):
+        """
+        Run variant caller by a work queue of windows, the ``nCPU`` processes take the windows one by one.
+        """
+        cdef list windows = generate_windows(self.regions, self.options.window_size)
+        cdef list weights
+        if self.options.weight_by_index:
+            weights = get_window_weights(self.alignfiles, windows)
+        else:
+            weights = [sum([e - s + 1 for _, s, e in w]) for w in windows]
+
+        # Every window done is recorded in the manifest, a rerun only calls the missing ones.
+        manifest = WindowManifest(self.outcvg + ".manifest",
+                                  parameter_hash(self.options, self.alignfiles, self.sample_id),
+                                  resume=self.options.smartrerun)
+
+        cdef list tasks = []
+        for i, w in enumerate(windows):
+            if i in manifest:
+                continue
+
+            sub_cvg_file = _temp_file_name(self.outcvg, '.window_%d' % i)
+            sub_vcf_file = _temp_file_name(self.outvcf, '.window_%d' % i) if self.outvcf else None
+            tmp_dir, name = os.path.split(os.path.realpath(sub_cvg_file))
+            cache_dir = tmp_dir + "/Batchfiles.%s.WillBeDeletedWhenJobsFinish" % name
+            tasks.append((weights[i], (i, w, sub_cvg_file, sub_vcf_file, cache_dir)))
+
+        logger.info("%d windows of at most %d positions, %d of them are going to be called by %d processes." % (
+            len(windows), self.options.window_size, len(tasks), self.nCPU))
+
+        def add_to_manifest(result):
+            index, _, _, cvg_md5, vcf_md5 = result
+            _, regions, sub_cvg_file, sub_vcf_file, _ = tasks_by_index[index]
+            manifest.add(index, regions, sub_cvg_file, cvg_md5, vcf_file=sub_vcf_file, vcf_md5=vcf_md5)
+
+        tasks_by_index = dict([(t[0], t) for _, t in tasks])
+        work_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        workers = [WindowWorker(work_queue,
+                                result_queue,
+                                BaseVarProcess,
+                                self.sample_id,
+                                self.alignfiles,
+                                self.reference_file,
+                                [],
+                                options=self.options) for _ in range(min(self.nCPU, len(tasks)))]
+        window_runner(workers, tasks, work_queue, result_queue, on_done=add_to_manifest)
+        manifest.close()
+
+        # double check for windows!
+        cdef list fail_window_num = manifest.missing(len(windows))
+        if fail_window_num or any([p.exitcode != 0 for p in workers]):
+            logger.error("The program is fail in [%s] windows. Abort! Rerun with --smart-rerun to call "
+                         "them only." % ",".join(map(str, fail_window_num)))
+            sys.exit(1)
+
+        # The windows are in the order of genome, so the outputs could be merged one after another.
+        out_cvg_names, out_vcf_names = manifest.output_files()
+        utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf,
+                                 compress_level=self.options.compress_level,
+                                 threads=self.options.write_threads)
+        manifest.remove()
+
+        logger.info("All the windows are done successful.")
+        return True
+
     def basevar_caller_singleprocess(self):
         """
         Run variant caller --------- Just for Testting, when we done, please delete this function!!!!!!
@@ -147,11 +231,11 @@ class BaseTypeRunner(object):
         out_vcf_names = []
         out_cvg_names = []
 
-        sub_cvg_file = self.outcvg + '_temp'
+        sub_cvg_file = _temp_file_name(self.outcvg, '_temp')
         out_cvg_names.append(sub_cvg_file)
 
         if self.outvcf:
-            sub_vcf_file = self.outvcf + '_temp'
+            sub_vcf_file = _temp_file_name(self.outvcf, '_temp')
             out_vcf_names.append(sub_vcf_file)
         else:
             sub_vcf_file = None
@@ -185,7 +269,8 @@ class BaseTypeRunner(object):
         # bp.run()
 
         # Final output
-        utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf)
+        utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf,
+                                 compress_level=self.options.compress_level, threads=self.options.write_threads)
         return True
 
 
@@ -222,9 +307,12 @@ class MergeRunner(object):
             self.inputfiles += utils.load_file_list(args.infilelist)
 
         self.outputfile = args.outputfile
+        self.compress_level = args.compress_level
+        self.write_threads = args.write_threads
 
     def run(self):
-        utils.output_file(self.inputfiles, self.outputfile)
+        utils.output_file(self.inputfiles, self.outputfile, compress_level=self.compress_level,
+                          threads=self.write_threads)
         return
 
 # from basevar.io.vcfconcat cimport call_vcfconcat
@@ -0,0 +1,130 @@
+"""Checkpoint manifest of BaseType windows
+
+Every window is recorded in the manifest once it's done, together with the checksum of its
+outputs and the hash of the parameters, so that a rerun only needs to call the missing windows.
+"""
+import hashlib
+import os
+
+from basevar.log import logger
+
+MANIFEST_FORMAT = "BaseVarManifest_v1.0"
+
+# Arguments which have nothing to do with the results
+RUNTIME_ARGUMENTS = set(["nCPU", "calling_threads", "io_threads", "max_open_files", "memory_budget",
+                         "weight_by_index", "compress_level", "write_threads", "smartrerun", "verbosity",
+                         "reference_access"])
+
+
+def parameter_hash(options, *args):
+    """md5 of the arguments in ``options`` which may change the results, together with ``args``."""
+    items = [(k, v) for k, v in sorted(vars(options).items())
+             if k not in RUNTIME_ARGUMENTS and (v is None or isinstance(v, (basestring, int, float, list, tuple)))]
+
+    md5 = hashlib.md5()
+    md5.update(repr(items + list(args)).encode())
+    return md5.hexdigest()
+
+
+def file_md5(file_name, block_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as I:
+        while True:
+            data = I.read(block_size)
+            if not data:
+                break
+
+            md5.update(data)
+
+    return md5.hexdigest()
+
+
+def _region_string(regions):
+    return ",".join(["%s:%d-%d" % (chrid, start, end) for chrid, start, end in regions])
+
+
+class WindowManifest(object):
+    """A manifest of the finished windows, one window per line:
+
+        Index  Region  CVG  CVG_MD5  VCF  VCF_MD5
+
+    The manifest is appended and flushed once a window is done, so it's always up to date even
+    if the program is killed.
+    """
+
+    def __init__(self, file_name, param_hash, resume=False):
+        self.file_name = file_name
+        self.param_hash = param_hash
+        self.windows = {}  # index => [region, cvg_file, cvg_md5, vcf_file, vcf_md5]
+
+        if resume and os.path.exists(file_name):
+            self._load()
+
+        # Rewrite the manifest by the windows which are still valid
+        with open(file_name, "w") as OUT:
+            OUT.write("##fileformat=%s\n" % MANIFEST_FORMAT)
+            OUT.write("##parameters=%s\n" % self.param_hash)
+            OUT.write("#Index\tRegion\tCVG\tCVG_MD5\tVCF\tVCF_MD5\n")
+            for index in sorted(self.windows):
+                OUT.write("%d\t%s\n" % (index, "\t".join(self.windows[index])))
+
+        self.OUT = open(file_name, "a")
+
+    def _load(self):
+        with open(self.file_name) as I:
+            for line in I:
+                if line.startswith("##parameters="):
+                    if line.strip().split("=", 1)[1] != self.param_hash:
+                        logger.warning("The parameters are different from the ones in %s, all the windows "
+                                       "will be called again." % self.file_name)
+                        self.windows = {}
+                        return
+
+                    continue
+
+                if line.startswith("#"):
+                    continue
+
+                col = line.rstrip("\n").split("\t")
+                if len(col) != 6:
+                    # The last line may be broken if the program was killed while writing it.
+                    continue
+
+                self.windows[int(col[0])] = col[1:]
+
+        for index in list(self.windows.keys()):
+            _, cvg_file, cvg_md5, vcf_file, vcf_md5 = self.windows[index]
+            for f, md5 in [(cvg_file, cvg_md5), (vcf_file, vcf_md5)]:
+                if f != "." and (not os.path.isfile(f) or file_md5(f) != md5):
+                    logger.warning("Window %d: %s is missing or changed, it will be called again." % (index, f))
+                    del self.windows[index]
+                    break
+
+        logger.info("%d windows have been done according to %s." % (len(self.windows), self.file_name))
+        return
+
+    def __contains__(self, index):
+        return index in self.windows
+
+    def add(self, index, regions, cvg_file, cvg_md5, vcf_file=None, vcf_md5=None):
+        self.windows[index] = [_region_string(regions), cvg_file, cvg_md5, vcf_file or ".", vcf_md5 or "."]
+        self.OUT.write("%d\t%s\n" % (index, "\t".join(self.windows[index])))
+        self.OUT.flush()
+        os.fsync(self.OUT.fileno())
+
+    def missing(self, window_num):
+        """Return the index of windows which are not done."""
+        return [i for i in range(window_num) if i not in self.windows]
+
+    def output_files(self):
+        """Return the CVG and VCF files of all the windows in the order of index."""
+        cvg_files = [self.windows[i][1] for i in sorted(self.windows)]
+        vcf_files = [self.windows[i][3] for i in sorted(self.windows) if self.windows[i][3] != "."]
+        return cvg_files, vcf_files
+
+    def close(self):
+        self.OUT.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.file_name)
@@ -9,9 +9,11 @@ cdef extern from "string.h" nogil:
     char *strsep(char ** string_ptr, const char *delimiter)
 
 from basevar.io.fasta cimport FastaFile
+from basevar.io.bam cimport AlignmentReaderPool
+from basevar.caller.basetype cimport BaseTypeEngine, PopGroupEngine
 
-cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float min_af,
-                             cvg_file_handle, vcf_file_handle)
+cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float min_af, int thread_num,
+                             cvg_file_handle, vcf_file_handle, bint sites_only=*)
 cdef bint variant_discovery_in_regions(FastaFile fa,
                                        list align_files,
                                        list regions,
@@ -19,5 +21,8 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
                                        dict popgroup,
                                        basestring out_cvg_file_name,
                                        basestring out_vcf_file_name,
-                                       object options)
+                                       object options,
+                                       AlignmentReaderPool reader_pool=*)
 
+cdef int _basetypeprocess(list batchinfos, PopGroupEngine group_engine, float min_af, BaseTypeEngine engine,
+                          cvg_file_handle, vcf_file_handle, bint sites_only) except -1
@@ -4,25 +4,77 @@
 import sys
 import time
 
+from libc.math cimport NAN
+
 from basevar.log import logger
 from basevar.utils import vcf_header_define, cvg_header_define
 
 from basevar.io.fasta cimport FastaFile
 from basevar.io.openfile import Open
-from basevar.io.bam cimport load_data_from_bamfile
+from basevar.io.bam cimport AlignmentReaderPool, merge_regions, load_data_from_bamfile_in_regions
 from basevar.io.htslibWrapper cimport Samfile
+from basevar.io.batchfile cimport BatchFileReader
+from basevar.io.htslibWrapper cimport bcf_gt_missing, bcf_gt_unphased
+from basevar.io.bcf cimport BCFWriter
 
-from basevar.caller.algorithm cimport strand_bias
-from basevar.caller.algorithm cimport ref_vs_alt_ranksumtest
+from basevar.caller.algorithm cimport StrandCache, allele_table, cached_fisher_strand_and_sor
+from basevar.caller.algorithm cimport ranksumtests_by_alleles, strand_counts_by_alleles
 
-from basevar.caller.basetype cimport BaseType
+from basevar.caller.basetype cimport BaseType, BaseTypeEngine, PopGroupEngine
+from basevar.caller.cvg cimport CVGWriter, CVGStats, cvg_stats
 from basevar.caller.batch cimport BatchGenerator, BatchInfo, PositionBatchCigarArray
 
 cdef int INITIAL_CIGAR_ARRAY_SIZE = 10000
+cdef int CALLING_CHUNK_SIZE = 1000  # positions for each round of calling by the threads
 cdef int QUAL_THRESHOLD = 60
-cdef list BASE = ['A', 'C', 'G', 'T']
 
-def output_header(fa_file_name, sample_ids, pop_group_sample_dict, out_cvg_handle, out_vcf_handle=None):
+# Rough memory cost (bytes) of a sample in a position, for tiling regions into windows by memory budget.
+cdef int BATCHINFO_BYTES_PER_SAMPLE = 64  # ``BatchInfo`` in ``BatchGenerator``, uncompressed
+cdef int CIGAR_BYTES_PER_SAMPLE = 16      # ``PositionBatchCigarArray``, run-length compressed
+
+# The statistics of a position for the CVG and VCF records, which are counted by ``_site_kernel``
+# without GIL. The arrays point to the ``BatchInfo`` of the position.
+cdef struct SiteJob:
+    char **bases
+    char *strands
+    int *mapqs
+    int *read_pos_rank
+    int *base_quals
+    int size
+    const char *ref_base  # => upper case
+    int *allele  # => REF/ALT table by ``allele_table``, NULL if the position is not a variant
+
+    CVGStats cvg
+    double rank_sums[3]  # => [MQRankSum, ReadPosRankSum, BaseQRankSum]
+    int strand_counts[4]  # => [ref_fwd, ref_rev, alt_fwd, alt_rev]
+    double fs
+    double sor
+    int status  # => 0, -1 if out of memory, or 1 + the index of the base with a strange strand symbol
+
+cdef struct SiteKernelContext:
+    SiteJob *sites
+    StrandCache **strand_caches
+
+def open_vcf_file(file_name, options):
+    """Open the VCF output of BaseType by ``options.vcf_mode``, which is BCF or (BGZF) text.
+
+    The tabix index of a BGZF file is built while writing, ``concat_bgzf_files`` merges the
+    indexes of the temporary files instead of indexing the final one again.
+    """
+    if "bcf" in options.vcf_mode:
+        return BCFWriter(file_name, compress_level=options.compress_level, threads=options.write_threads)
+
+    return Open(file_name, "wb", isbgz=True, tabix=True, compress_level=options.compress_level,
+                threads=options.write_threads) if file_name.endswith(".gz") else open(file_name, "w")
+
+def open_cvg_file(file_name, options):
+    """Open the CVG output of BaseType, the records are written by ``CVGWriter`` in bulk and
+    indexed as ``open_vcf_file``."""
+    return CVGWriter(Open(file_name, "wb", isbgz=True, tabix=True, compress_level=options.compress_level,
+                          threads=options.write_threads) if file_name.endswith(".gz") else open(file_name, "w"))
+
+def output_header(fa_file_name, sample_ids, pop_group_sample_dict, out_cvg_handle, out_vcf_handle=None,
+                  sites_only=False):
     info, group = [], []
     if pop_group_sample_dict:
         for g in pop_group_sample_dict.keys():
@@ -32,150 +84,97 @@ def output_header(fa_file_name, sample_ids, pop_group_sample_dict, out_cvg_handl
                         'populations calculated base on LRT, in the range (0,1)">' % (g_id, g_id))
 
     if out_vcf_handle:
-        vcf_header = vcf_header_define(fa_file_name, info="\n".join(info), samples=sample_ids)
+        vcf_header = vcf_header_define(fa_file_name, info="\n".join(info), samples=sample_ids,
+                                       sites_only=sites_only)
         out_vcf_handle.write("%s\n" % "\n".join(vcf_header))
 
     out_cvg_handle.write('%s\n' % "\n".join(cvg_header_define(group)))
 
     return
 
-cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float min_af,
-                             cvg_file_handle, vcf_file_handle):
+cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float min_af, int thread_num,
+                             cvg_file_handle, vcf_file_handle, bint sites_only=False):
     """Function for variants discovery.
     """
-    cdef list sampleinfos = []
-    cdef list batch_files_hd = [Open(f, 'rb') for f in batchfiles]
+    cdef list readers = [BatchFileReader(f) for f in batchfiles]
+    cdef BatchFileReader reader, first = readers[0]
+    cdef list has_record
     cdef bint is_empty = True
-    cdef bint eof = False
     cdef bint is_error = False
 
-    cdef int *batch_count = <int*> (calloc(len(batchfiles), sizeof(int)))
-
-    cdef int total_sample_num = 0
+    cdef int total_sample_num = sum([reader.sample_num for reader in readers])
     cdef BatchInfo batchinfo
+    cdef BaseTypeEngine engine = BaseTypeEngine(thread_num=thread_num)
+    cdef PopGroupEngine group_engine = PopGroupEngine(popgroup, total_sample_num)
+
+    # The other bases of ``BatchInfo`` point to ``reader.extra``, keep them until the chunk is done.
+    cdef list chunk = []
+    cdef list chunk_extras = []
 
-    cdef int n = 0, i = 0
-    cdef bint is_first = True
+    cdef int n = 0, offset = 0, depth = 0
     while True:
-        # [CHROM POS REF Depth MappingQuality Readbases ReadbasesQuality ReadPositionRank Strand]
-        sampleinfos = []
-        for i, fh in enumerate(batch_files_hd):
-            line = fh.readline()
-            if line:
-                if line.startswith("#"):
-                    if line.startswith("##SampleIDs="):
-                        batch_count[i] = len(line.strip().split("=")[-1].split(","))
-                        total_sample_num += batch_count[i]
-
-                    continue
-
-                elif is_first:
-                    is_first = False
-                    # initial here
-                    batchinfo = BatchInfo(chrid, size=total_sample_num)
-
-                sampleinfos.append(line.strip().split())
-            else:
-                sampleinfos.append(None)
-                eof = True
+        has_record = [reader.read_record() for reader in readers]
 
         # hit the end of files
-        if eof:
-            is_error = True if any(sampleinfos) else False
+        if not all(has_record):
+            is_error = any(has_record)
             if is_error:
                 logger.warning(
                     "%s\n[ERROR]Error happen when 'variants_discovery', they don't have the same "
                     "positions in above files." % "\n".join(batchfiles))
             break
 
-        # Empty!! Just get header information.
-        if not sampleinfos:
-            continue
+        depth = 0
+        for reader in readers:
+            if reader.chrom != chrid or reader.position != first.position or reader.ref_base != first.ref_base:
+                logger.error("Chromosome [%s and %s] or position [%d and %d] or ref-base [%s and %s] "
+                             "in batchfiles not match with each other: %s and %s\n" %
+                             (reader.chrom, chrid, reader.position, first.position, reader.ref_base,
+                              first.ref_base, reader.filename, first.filename))
+                sys.exit(1)
 
-        # reset position and ref_base
-        batchinfo.position = int(sampleinfos[0][1])
-        batchinfo.ref_base = sampleinfos[0][2]
+            depth += reader.depth
 
         if n % 10000 == 0:
             logger.info("Have been loading %d lines when hit position %s:%d" %
-                        (n if n > 0 else 1, chrid, batchinfo.position))
+                        (n if n > 0 else 1, chrid, first.position))
         n += 1
 
-        # data in ``batchinfo`` will been updated automatically in this funcion
-        _fetch_baseinfo_by_position_from_batchfiles(sampleinfos, batch_count, batchinfo)
-
         # ignore if coverage=0
-        if batchinfo.depth == 0:
+        if depth == 0:
             continue
 
         # Not empty
         is_empty = False
 
-        # Calling varaints position one by one and output files.
-        _basetypeprocess(batchinfo, popgroup, min_af, cvg_file_handle, vcf_file_handle)
-
-    for fh in batch_files_hd:
-        fh.close()
-
-    free(batch_count)
-
-    return is_empty
-
-
-cdef void _fetch_baseinfo_by_position_from_batchfiles(list infolines, int *batch_count, BatchInfo batchinfo):
-
-    # reset depth
-    batchinfo.depth = 0
+        # A new BatchInfo for each position, which will be kept in the chunk
+        batchinfo = BatchInfo(chrid, position=first.position, ref_base=first.ref_base, size=total_sample_num)
+        batchinfo.depth = depth
 
-    cdef char *c_t4
-    cdef char *c_t5
-    cdef char *c_t6
-    cdef char *c_t7
-    cdef char *c_t8
+        offset = 0
+        for reader in readers:
+            reader.fill(batchinfo, offset)
+            offset += reader.sample_num
+            if reader.extra:
+                chunk_extras.append(reader.extra)
 
-    cdef int n = 0, index = 0
-    for i, col in enumerate(infolines):
-        # <CHROM POS REF Depth MappingQuality Readbases ReadbasesQuality ReadPositionRank Strand>
-        if len(col) == 0:
-            logger.error(" %d lines happen to be empty in batchfiles!" % (i + 1))
-            sys.exit(1)
+        # Calling varaints chunk by chunk and output files.
+        chunk.append(batchinfo)
+        if len(chunk) == CALLING_CHUNK_SIZE:
+            _basetypeprocess(chunk, group_engine, min_af, engine, cvg_file_handle, vcf_file_handle, sites_only)
+            chunk, chunk_extras = [], []
 
-        col[1], col[3] = map(int, [col[1], col[3]])
-        if col[0] != batchinfo.chrid or col[1] != batchinfo.position or col[2] != batchinfo.ref_base:
-            logger.error("%d lines, chromosome [%s and %s] or position [%d and %s] "
-                         "or ref-base [%s and %s] in batchfiles not match with each other!\n" %
-                         (i + 1, col[0], batchinfo.chrid, col[1], batchinfo.position, col[2], batchinfo.ref_base))
-            sys.exit(1)
+    if chunk:
+        _basetypeprocess(chunk, group_engine, min_af, engine, cvg_file_handle, vcf_file_handle, sites_only)
 
-        batchinfo.depth += col[3]
-        if col[3] > 0:
-
-            c_t4, c_t5, c_t6, c_t7, c_t8 = col[4:9]
-            for n in range(batch_count[i]):
-
-                # if catch segmentation fault then the problem would probably be here!
-                batchinfo.mapqs[index] = atoi(strsep(&c_t4, ","))
-                batchinfo.sample_bases[index] = strsep(&c_t5, ",")  # must all be all upper charater in batchfile!
-                batchinfo.sample_base_quals[index] = atoi(strsep(&c_t6, ","))
-                batchinfo.read_pos_rank[index] = atoi(strsep(&c_t7, ","))
-                batchinfo.strands[index] = strsep(&c_t8, ",")[0] # It's char not string
-
-                # move to the next
-                index += 1
-        else:
-            for n in range(batch_count[i]):
-
-                batchinfo.mapqs[index] = 0
-                batchinfo.sample_bases[index] = "N"
-                batchinfo.sample_base_quals[index] = 0
-                batchinfo.read_pos_rank[index] = 0
-                batchinfo.strands[index] = "."
-
-                # move to the next
-                index += 1
+    for reader in readers:
+        reader.close()
 
-    return
+    engine.close()
+    if vcf_file_handle:
+        _log_prescreen(engine)
 
+    return is_empty
 
 
 #####################################################################################################################
@@ -211,16 +210,110 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
                                        dict popgroup,
                                        basestring out_cvg_file_name,
                                        basestring out_vcf_file_name,
-                                       object options):
+                                       object options,
+                                       AlignmentReaderPool reader_pool=None):
     """
     ``regions`` is a 2-D array, 1-base system
         [[chr1, start1, end1], [chr1, start2, end2], ...]
+
+    ``regions`` are tiled into windows which fit ``options.memory_budget``, all the samples are
+    loaded and called window by window, so the peak memory does not grow with the length of
+    ``regions``. Nearby regions are loaded by one fetch for each alignment file, and the files
+    are got from ``reader_pool`` if it's provided, so that they could be kept opened for the
+    next window.
         
     ``samples``: The sample id of align_files
     ``fa``:
         # get sequence of chrom_name from reference fasta
         fa = self.ref_file_hd.fetch(chrid)
     """
+    cdef int sample_size = len(samples)
+    cdef long int window_size = _window_size_by_memory(options.memory_budget, options.batch_count,
+                                                       sample_size, options.r_len)
+    cdef list windows = _tile_regions(regions, window_size)
+    logger.info("%d regions are tiled into %d windows of at most %d positions by memory budget %dM." % (
+        len(regions), len(windows), window_size, options.memory_budget))
+
+    VCF = open_vcf_file(out_vcf_file_name, options) if out_vcf_file_name else None
+    cdef bint sites_only = "sites" in options.vcf_mode
+
+    CVG = open_cvg_file(out_cvg_file_name, options)
+
+    output_header(fa.filename, samples, popgroup, CVG, out_vcf_handle=VCF, sites_only=sites_only)
+
+    cdef BaseTypeEngine engine = BaseTypeEngine(thread_num=options.calling_threads)
+    cdef list regions_batch_cigar
+    cdef list window_regions
+    cdef bint is_empty = True
+    cdef int w = 0
+    for w, window_regions in enumerate(windows):
+        regions_batch_cigar = _load_regions_batch_cigar(fa, align_files, window_regions, samples, options,
+                                                        reader_pool)
+
+        # All the samples have been read past this window, call and output it before loading the next one.
+        if not _variants_discovery(regions_batch_cigar, popgroup, options.min_af, engine, CVG, VCF, sites_only):
+            is_empty = False
+
+        logger.info("Done for window %d/%d, the last region is %s:%s-%s" % (
+            w + 1, len(windows), window_regions[-1][0], window_regions[-1][1], window_regions[-1][2]))
+
+    engine.close()
+    if VCF:
+        _log_prescreen(engine)
+
+    CVG.close()
+    if VCF:
+        VCF.close()
+
+    return is_empty
+
+
+cdef long int _window_size_by_memory(long int memory_budget, int batch_count, int sample_size, int r_len):
+    """Return the number of positions could be loaded at the same time in ``memory_budget`` MB.
+
+    The main memory cost of a position is a ``BatchInfo`` of ``batch_count`` samples in
+    ``BatchGenerator`` and the run-length compressed ``PositionBatchCigarArray`` of all the samples.
+    """
+    cdef long int bytes_per_position = (batch_count * BATCHINFO_BYTES_PER_SAMPLE +
+                                        sample_size * CIGAR_BYTES_PER_SAMPLE)
+    cdef long int window_size = memory_budget * 1024 * 1024 / max(1, bytes_per_position)
+
+    # A window should be at least as long as a read, or a read will be loaded by too many windows.
+    return max(window_size, r_len)
+
+
+cdef list _tile_regions(list regions, long int window_size):
+    """Tile ``regions`` ([[chrom, start, end], ...], 1-base) into windows, each of them is a list of
+    regions and contains at most ``window_size`` positions.
+    """
+    cdef list windows = []
+    cdef list window = []
+    cdef long int window_len = 0
+    cdef long int start, end, sub_end
+    for chrom, start, end in regions:
+
+        while start <= end:
+            if window_len == window_size:
+                windows.append(window)
+                window = []
+                window_len = 0
+
+            sub_end = min(end, start + window_size - window_len - 1)
+            window.append([chrom, start, sub_end])
+            window_len += sub_end - start + 1
+            start = sub_end + 1
+
+    if window:
+        windows.append(window)
+
+    return windows
+
+
+cdef list _load_regions_batch_cigar(FastaFile fa, list align_files, list regions, list samples, object options,
+                                    AlignmentReaderPool reader_pool):
+    """Load all the samples in ``regions`` and return the ``PositionBatchCigarArray`` of each position,
+    which is a 2-D list of the same shape as ``regions``.
+    """
     cdef bytes chrom
     cdef long int start, end
 
@@ -256,23 +349,36 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
     cdef int buffer_sample_index = 0
     cdef int size_of_batch_heap
 
+    # ``regions`` is sorted, load the nearby regions by one fetch.
+    cdef list merged_regions = merge_regions(regions, options.r_len)
+    cdef list sub_regions, sub_batch_generators
+    logger.info("%d regions are merged into %d fetches for each alignment file." % (
+        region_size, len(merged_regions)))
+
     start_time = time.time()
     for i in range(sample_size):
 
-        reader = Samfile(align_files[i])  # Match samples[i]
-        reader.open("r", True)
-        for k ,(chrom, start, end) in enumerate(regions):
+        if reader_pool is not None:
+            reader = reader_pool.get(align_files[i])  # Match samples[i]
+        else:
+            reader = Samfile(align_files[i])  # Match samples[i]
+            reader.open("r", True)
+
+        for chrom, start, end, region_indexes in merged_regions:
+            sub_regions = [regions[k][1:] for k in region_indexes]
+            sub_batch_generators = [batch_generators[k] for k in region_indexes]
 
             try:
-                # load the whole mapping reads to ``be_generator`` in [chrom_name, start, end]
-                load_data_from_bamfile(reader, samples[i], chrom, start, end, batch_generators[k],
-                                       buffer_sample_index, options)
+                # load the whole mapping reads to ``batch_generators`` in [chrom_name, start, end]
+                load_data_from_bamfile_in_regions(reader, samples[i], chrom, sub_regions,
+                                                  sub_batch_generators, buffer_sample_index, options)
 
             except Exception, e:
                 logger.error("Exception in region %s:%s-%s. Error: %s" % (chrom, start, end, e))
                 sys.exit(1)
 
-        reader.close()
+        if reader_pool is None:
+            reader.close()
 
         if buffer_sample_index + 1 == options.batch_count:
             # Compress a batch data into ``PositionBatchCigarArray`` will rest depth to be 0
@@ -293,37 +399,25 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
     if buffer_sample_index > 0:
         push_data_into_position_cigar_array(regions_batch_cigar, batch_generators, buffer_sample_index)
 
-    if out_vcf_file_name:
-        VCF = Open(out_vcf_file_name, "wb", isbgz=True) if out_vcf_file_name.endswith(".gz") else \
-            open(out_vcf_file_name, "w")
-    else:
-        VCF = None
+    return regions_batch_cigar
 
-    CVG = Open(out_cvg_file_name, "wb", isbgz=True) if out_cvg_file_name.endswith(".gz") else \
-        open(out_cvg_file_name, "w")
 
-    output_header(fa.filename, samples, popgroup, CVG, out_vcf_handle=VCF)
-    cdef bint is_empty = _variants_discovery(regions_batch_cigar, popgroup, options.min_af, CVG, VCF)
-
-    CVG.close()
-    if VCF:
-        VCF.close()
-
-    return is_empty
-
-
-cdef bint _variants_discovery(list regions_batch_cigar, dict popgroup, float min_af, CVG, VCF):
+cdef bint _variants_discovery(list regions_batch_cigar, dict popgroup, float min_af, BaseTypeEngine engine,
+                              CVG, VCF, bint sites_only):
     """Function for variants discovery.
     
     Parameter:
         ``start``: 1-base system
         ``end``: 1-base system
+        ``engine``: shared by all the windows and closed by the caller
     """
     cdef int how_many_regions = len(regions_batch_cigar)
     cdef int how_many_pos
 
     cdef PositionBatchCigarArray position_batch_cigar_array
     cdef BatchInfo batch_info
+    cdef PopGroupEngine group_engine = None
+    cdef list chunk = []
     cdef bint is_empty = True
     cdef int n = 0, i = 0, j = 0
     for i in range(how_many_regions):
@@ -343,184 +437,218 @@ cdef bint _variants_discovery(list regions_batch_cigar, dict popgroup, float min
             # Not empty
             is_empty = False
 
-            # Calling varaints position one by one and output files.
-            _basetypeprocess(batch_info, popgroup, min_af, CVG, VCF)
+            if group_engine is None:
+                group_engine = PopGroupEngine(popgroup, batch_info.size)
+
+            # Calling varaints chunk by chunk and output files.
+            chunk.append(batch_info)
+            if len(chunk) == CALLING_CHUNK_SIZE:
+                _basetypeprocess(chunk, group_engine, min_af, engine, CVG, VCF, sites_only)
+                chunk = []
+
+    if chunk:
+        _basetypeprocess(chunk, group_engine, min_af, engine, CVG, VCF, sites_only)
 
     return is_empty
 
-cdef void _basetypeprocess(BatchInfo batchinfo, dict popgroup, float min_af, cvg_file_handle, vcf_file_handle):
-    """
-    
-    :param batchinfo: 
-    :param popgroup: 
+cdef void _log_prescreen(BaseTypeEngine engine):
+    """Report how many positions have been skipped by the pre-screen of ``engine``"""
+    logger.info("Pre-screen skipped %d of %d positions without calling LRT: %d by min_af, "
+                "%d by error bound." % (engine.skip_by_min_af + engine.skip_by_error_bound,
+                                       engine.prescreen_site_num,
+                                       engine.skip_by_min_af,
+                                       engine.skip_by_error_bound))
+    return
+
+cdef int _basetypeprocess(list batchinfos, PopGroupEngine group_engine, float min_af, BaseTypeEngine engine,
+                          cvg_file_handle, vcf_file_handle, bint sites_only) except -1:
+    """Calling variants for a chunk of positions.
+
+    The EM of all the positions in ``batchinfos`` are run by the threads of ``engine`` at once,
+    and so are the CVG statistics, rank sum tests and strand bias by ``_site_kernel``, then the
+    result are output in the same order of ``batchinfos``.
+
+    :param batchinfos: a list of BatchInfo
+    :param group_engine: PopGroupEngine, the population groups
     :param min_af: 
-    :param cvg_file_handle: 
-    :param vcf_file_handle: 
+    :param engine: BaseTypeEngine, share the EM workspace with all the positions
+    :param cvg_file_handle: CVGWriter
+    :param vcf_file_handle: a text file or ``BCFWriter``
+    :param sites_only: do not output the FORMAT of samples
     :return: 
     """
-    _out_cvg_file(batchinfo, popgroup, cvg_file_handle)
-
-    cdef dict popgroup_bt = {}
-    cdef bint is_variant = True
+    cdef list groups = group_engine.groups
+    cdef list variant_sites = []  # [(index of batchinfos, BaseType), ...]
+    cdef list group_bts = []
+    cdef list group_base_combs = []
+    cdef list bts = []
+    cdef list bt_index = []
+    cdef list is_variants
 
-    cdef BaseType bt, group_bt
-    cdef char ** group_sample_bases
-    cdef int *group_sample_base_quals
-    cdef int group_sample_size
-    cdef int i = 0
+    cdef BatchInfo batchinfo
+    cdef BaseType bt
+    cdef int i = 0, j = 0
     if vcf_file_handle:
 
-        bt = BaseType()
-        bt.cinit(batchinfo.ref_base.upper(), batchinfo.sample_bases, batchinfo.sample_base_quals,
-                 batchinfo.size, min_af)
-
-        is_variant = bt.lrt(None)  # do not need to set specific_base_combination
-        if is_variant:
+        for i, batchinfo in enumerate(batchinfos):
 
-            popgroup_bt = {}
-            for group, index in popgroup.items():
-
-                group_sample_size = len(index)
-                group_sample_bases = <char**> (calloc(group_sample_size, sizeof(char*)))
-                if group_sample_bases == NULL:
-                    logger.error("Fail allocate memory for ``group_sample_bases`` in _basetypeprocess.")
-                    sys.exit(1)
-
-                group_sample_base_quals = <int*> (calloc(group_sample_size, sizeof(int)))
-                if group_sample_base_quals == NULL:
-                    logger.error("Fail allocate memory for ``group_sample_base_quals`` in _basetypeprocess.")
-                    sys.exit(1)
+            # Only the positions pass the pre-screen could be variants.
+            if engine.is_non_variant(batchinfo.ref_base.upper(), batchinfo.sample_bases,
+                                     batchinfo.sample_base_quals, batchinfo.size, min_af):
+                continue
 
-                # for i in index:
-                for i in range(group_sample_size):
-                    group_sample_bases[i] = batchinfo.sample_bases[index[i]]
-                    group_sample_base_quals[i] = batchinfo.sample_base_quals[index[i]]
+            bt = BaseType()
+            # Run EM over the (base, quality) classes of samples instead of each sample.
+            bt.cinit(batchinfo.ref_base.upper(), batchinfo.sample_bases, batchinfo.sample_base_quals,
+                     batchinfo.size, min_af, compress=True)
 
-                group_bt = BaseType()
-                group_bt.cinit(batchinfo.ref_base.upper(), group_sample_bases, group_sample_base_quals,
-                               group_sample_size, min_af)
+            bts.append(bt)
+            bt_index.append(i)
 
-                group_bt.lrt([batchinfo.ref_base.upper()] + bt.alt_bases)
-                popgroup_bt[group] = group_bt
+        is_variants = engine.lrt_block(bts, None)  # do not need to set specific_base_combination
+        for i, bt, is_variant in zip(bt_index, bts, is_variants):
+            if not is_variant:
+                continue
 
-                free(group_sample_bases)
-                free(group_sample_base_quals)
+            variant_sites.append((i, bt))
+            batchinfo = batchinfos[i]
+            group_bts.extend(group_engine.basetypes(batchinfo.ref_base.upper(), batchinfo.sample_bases,
+                                                    batchinfo.sample_base_quals, min_af))
+            group_base_combs.extend([[batchinfo.ref_base.upper()] + bt.alt_bases] * len(groups))
+
+        engine.lrt_block(group_bts, group_base_combs)
+
+    # The CVG statistics of all the positions and the rank sum tests and strand bias of the variants
+    # are also run by the threads, then the records are output in the same order of ``batchinfos``.
+    cdef int site_num = len(batchinfos)
+    cdef SiteJob *sites = <SiteJob*>(calloc(max(1, site_num), sizeof(SiteJob)))
+    cdef int *alleles = <int*>(calloc(max(1, len(variant_sites)) * 256, sizeof(int)))
+    if sites == NULL or alleles == NULL:
+        free(sites)
+        free(alleles)
+        raise MemoryError("Could not allocate memory for the sites in _basetypeprocess.")
+
+    cdef list ref_bases = []  # keep ``SiteJob.ref_base`` until the chunk is done
+    cdef bytes ref_base
+    cdef SiteJob *site
+    cdef SiteKernelContext context
+    cdef CVGWriter cvg_writer = cvg_file_handle
+    cdef dict popgroup_bt
+    cdef int k = 0
+    try:
+        for i, batchinfo in enumerate(batchinfos):
+            ref_base = batchinfo.ref_base.upper()
+            ref_bases.append(ref_base)
+
+            site = sites + i
+            site.bases = batchinfo.sample_bases
+            site.strands = batchinfo.strands
+            site.mapqs = batchinfo.mapqs
+            site.read_pos_rank = batchinfo.read_pos_rank
+            site.base_quals = batchinfo.sample_base_quals
+            site.size = batchinfo.size
+            site.ref_base = ref_base
+            site.allele = NULL
+            if k < len(variant_sites) and variant_sites[k][0] == i:
+                site.allele = alleles + k * 256
+                allele_table(ref_base, variant_sites[k][1].alt_bases, site.allele)
+                k += 1
+
+        context.sites = sites
+        context.strand_caches = engine.strand_caches
+        engine.run_parallel(_site_kernel, &context, site_num)
+
+        k = 0
+        for i, batchinfo in enumerate(batchinfos):
+            site = sites + i
+            if site.status < 0:
+                raise MemoryError("Could not allocate memory for the rank sum tests in _basetypeprocess.")
+            elif site.status > 0:
+                raise ValueError('[ERROR] Get strange strand symbol: "%s"' % chr(batchinfo.strands[site.status - 1]))
+
+            cvg_writer.write_record(batchinfo, group_engine, &site.cvg)
+
+            if k < len(variant_sites) and variant_sites[k][0] == i:
+                popgroup_bt = {group: group_bts[k * len(groups) + j] for j, group in enumerate(groups)}
+                _out_vcf_line(batchinfo, variant_sites[k][1], popgroup_bt, vcf_file_handle, sites_only, site)
+                k += 1
+    finally:
+        free(sites)
+        free(alleles)
+
+    return 0
+
+cdef void _site_kernel(void *context, int thread_index, int thread_num, int job_num) nogil:
+    """The CVG statistics of the positions of ``thread_index``, and the rank sum tests and strand bias
+    if it's a variant, with the FS/SOR cache of the thread.
+    """
+    cdef SiteKernelContext *ctx = <SiteKernelContext*> context
+    cdef StrandCache *cache = ctx.strand_caches[thread_index]
+    cdef SiteJob *site
+    cdef int i = thread_index, k
+    while i < job_num:
+        site = ctx.sites + i
+        i += thread_num
+
+        k = cvg_stats(site.bases, site.strands, site.size, site.ref_base, &site.cvg)
+        if k >= 0:
+            site.status = k + 1
+            continue
 
-            _out_vcf_line(batchinfo, bt, popgroup_bt, vcf_file_handle)
-    return
+        if site.cvg.depth[0] + site.cvg.depth[1] + site.cvg.depth[2] + site.cvg.depth[3] > 0:
+            cached_fisher_strand_and_sor(cache, site.cvg.ref_fwd, site.cvg.ref_rev, site.cvg.alt_fwd,
+                                         site.cvg.alt_rev, &site.cvg.fs, &site.cvg.sor)
 
-cdef list _base_depth_and_indel(char ** bases, int size):
-    # coverage info for each position
-    cdef dict base_depth = {b: 0 for b in BASE}
-    cdef dict indel_depth = {}
+        if site.allele == NULL:
+            continue
 
-    cdef int i = 0
-    for i in range(size):
+        if ranksumtests_by_alleles(site.allele, site.bases, site.mapqs, site.read_pos_rank, site.base_quals,
+                                   site.size, site.rank_sums) < 0:
+            site.status = -1
+            continue
 
-        # The size of `base[i]` would be 1 except indel!
-        if bases[i][0] == 'N':
+        k = strand_counts_by_alleles(site.allele, site.bases, site.strands, site.size, site.strand_counts)
+        if k >= 0:
+            site.status = k + 1
             continue
 
-        if bases[i] in base_depth:
-            # ignore all bases('*') which not match ``cmm.BASE``
-            base_depth[bases[i]] += 1
-        else:
-            # Indel
-            indel_depth[bases[i]] = indel_depth.get(bases[i], 0) + 1
-
-    cdef bytes indels = bytes(','.join(
-        [k + '|' + str(v) for k, v in indel_depth.items()]
-    ) if indel_depth else ".")
-
-    return [base_depth, indels]
-
-cdef void _out_cvg_file(BatchInfo batchinfo, dict popgroup, out_file_handle):
-    """output coverage information into `out_file_handle`"""
-    # coverage info for each position
-    cdef dict base_depth
-    cdef bytes indels
-    base_depth, indels = _base_depth_and_indel(batchinfo.sample_bases, batchinfo.size)
-
-    # base depth and indels for each subgroup
-    cdef char ** group_sample_bases
-    cdef int group_sample_size
-    cdef dict group_cvg = {}
-    cdef bytes group
-    cdef list index
-
-    # Here is one of the two parts which most time consuming!
-    cdef int i = 0
-    cdef dict sub_bd
-    cdef bytes sub_inds
-    for group, index in popgroup.items():
-
-        group_sample_size = len(index)
-        group_sample_bases = <char**> (calloc(group_sample_size, sizeof(char*)))
-        if group_sample_bases == NULL:
-            logger.error("Fail allocate memory for ``group_sample_bases`` in _out_cvg_file.")
-            sys.exit(1)
-
-        for i in range(group_sample_size):
-            group_sample_bases[i] = batchinfo.sample_bases[index[i]]
-
-        sub_bd, sub_inds = _base_depth_and_indel(group_sample_bases, group_sample_size)
-        group_cvg[group] = [sub_bd, sub_inds]
-
-        free(group_sample_bases)
-
-    cdef double fs, sor
-    cdef int ref_fwd, ref_rev, alt_fwd, alt_rev
-    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = 0, -1, 0, 0, 0, 0
-
-    # Here is the other part which most time consuming!
-    cdef bytes ref_base = batchinfo.ref_base
-    cdef bytes b1, b2
-    if sum(base_depth.values()) > 0:
-        # could we stop sorting ?
-        base_sorted = sorted(base_depth.items(), key=lambda x: x[1], reverse=True)
-        b1, b2 = base_sorted[0][0], base_sorted[1][0]
-
-        # This is very efficient.
-        fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = strand_bias(
-            ref_base.upper(),  # reference
-            [b1 if b1 != ref_base.upper() else b2],  # alt-allele
-            batchinfo.sample_bases,
-            batchinfo.strands,
-            batchinfo.size
-        )
-
-    cdef list group_info
-    if sum(base_depth.values()):
-
-        group_info = []
-        if group_cvg:
-            for k in group_cvg.keys():
-                depth, indel = group_cvg[k]
-                indel = [indel] if indel != "." else []
-                s = ':'.join(map(str, [depth[b] for b in BASE]) + indel)
-                group_info.append(s)
-
-        out_file_handle.write(
-            '\t'.join(
-                [batchinfo.chrid, str(batchinfo.position), ref_base, str(sum(base_depth.values()))] +
-                [str(base_depth[b]) for b in BASE] +
-                [indels] +
-                [str("%.3f" % fs), str("%.3f" % sor), ','.join(map(str, [ref_fwd, ref_rev, alt_fwd, alt_rev]))] +
-                group_info
-            ) + '\n'
-        )
+        cached_fisher_strand_and_sor(cache, site.strand_counts[0], site.strand_counts[1], site.strand_counts[2],
+                                     site.strand_counts[3], &site.fs, &site.sor)
 
     return
 
-cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out_file_handle):
-    """output vcf lines into `out_file_handle`"""
-
-    cdef dict alt_gt = {b: './' + str(k + 1) for k, b in enumerate(bt.alt_bases)}
+cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out_file_handle, bint sites_only,
+                        SiteJob *site):
+    """output vcf lines into `out_file_handle`, which is a text file or ``BCFWriter``, ``site`` is
+    the statistics of the position by ``_site_kernel``"""
+    cdef dict alt_gt
     cdef list samples = []
     cdef int k
     cdef char *b
+
+    # Rank Sum Test for mapping qualities, variant appear position among read and base quality
+    # of REF versus ALT reads
+    mq_rank_sum, read_pos_rank_sum, base_q_rank_sum = site.rank_sums[0], site.rank_sums[1], site.rank_sums[2]
+
+    # Variant call confidence normalized by depth of sample reads
+    # supporting a variant.
+    ad_sum = sum([bt.depth[b] for b in bt.alt_bases])
+    qd = round(float(bt.var_qual / ad_sum), 3)
+
+    # Strand bias by fisher exact test and Strand bias estimated by the
+    # Symmetric Odds Ratio test
+    fs, sor = site.fs, site.sor
+    ref_fwd, ref_rev = site.strand_counts[0], site.strand_counts[1]
+    alt_fwd, alt_rev = site.strand_counts[2], site.strand_counts[3]
+
+    if isinstance(out_file_handle, BCFWriter):
+        _out_bcf_record(batchinfo, bt, pop_group_bt, <BCFWriter> out_file_handle, mq_rank_sum, read_pos_rank_sum,
+                        base_q_rank_sum, qd, fs, sor, [ref_fwd, ref_rev], [alt_fwd, alt_rev])
+        return
+
+    alt_gt = {b: './' + str(k + 1) for k, b in enumerate(bt.alt_bases)}
     # for k, b in enumerate(bases):
-    for k in range(batchinfo.size):
+    for k in range(0 if sites_only else batchinfo.size):
 
         b = batchinfo.sample_bases[k]
         # For sample FORMAT
@@ -536,33 +664,6 @@ cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out
         else:
             samples.append('./.')  # 'N' base or indel
 
-    # Rank Sum Test for mapping qualities of REF versus ALT reads
-    mq_rank_sum = ref_vs_alt_ranksumtest(batchinfo.ref_base.upper(), bt.alt_bases, batchinfo.sample_bases,
-                                         batchinfo.mapqs, batchinfo.size)
-
-    # Rank Sum Test for variant appear position among read of REF versus ALT
-    read_pos_rank_sum = ref_vs_alt_ranksumtest(batchinfo.ref_base.upper(), bt.alt_bases, batchinfo.sample_bases,
-                                               batchinfo.read_pos_rank, batchinfo.size)
-
-    # Rank Sum Test for base quality of REF versus ALT
-    base_q_rank_sum = ref_vs_alt_ranksumtest(batchinfo.ref_base.upper(), bt.alt_bases, batchinfo.sample_bases,
-                                             batchinfo.sample_base_quals, batchinfo.size)
-
-    # Variant call confidence normalized by depth of sample reads
-    # supporting a variant.
-    ad_sum = sum([bt.depth[b] for b in bt.alt_bases])
-    qd = round(float(bt.var_qual / ad_sum), 3)
-
-    # Strand bias by fisher exact test and Strand bias estimated by the
-    # Symmetric Odds Ratio test
-    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = strand_bias(
-        batchinfo.ref_base.upper(),
-        bt.alt_bases,
-        batchinfo.sample_bases,
-        batchinfo.strands,
-        batchinfo.size
-    )
-
     # base=>[CAF, allele depth], CAF = Allele frequency by read count
     caf = {b: ['%f' % round(bt.depth[b] / float(bt.total_depth), 6),
                bt.depth[b]] for b in bt.alt_bases}
@@ -593,6 +694,67 @@ cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out
                                      ','.join(bt.alt_bases), str(bt.var_qual),
                                      '.' if bt.var_qual > QUAL_THRESHOLD else 'LowQual',
                                      ';'.join([kk + '=' + vv for kk, vv in sorted(
-                                         info.items(), key=lambda x: x[0])]),
-                                     'GT:AB:SO:BP'] + samples) + '\n')
+                                         info.items(), key=lambda x: x[0])])] +
+                                    ([] if sites_only else ['GT:AB:SO:BP'] + samples)) + '\n')
+    return
+
+cdef void _out_bcf_record(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, BCFWriter writer,
+                          double mq_rank_sum, double read_pos_rank_sum, double base_q_rank_sum, double qd,
+                          double fs, double sor, list sb_ref, list sb_alt):
+    """The same record as ``_out_vcf_line`` but in BCF, the FORMAT of samples are set into the
+    typed arrays of ``writer`` directly.
+    """
+    cdef bytes ref_base = batchinfo.ref_base.upper()
+
+    # allele index of each base, -1 for the base which is neither REF nor ALT
+    cdef int allele_index[256]
+    cdef int k
+    for k in range(256):
+        allele_index[k] = -1
+
+    cdef bytes alt
+    allele_index[<unsigned char> ref_base[0]] = 0
+    for k, alt in enumerate(bt.alt_bases):
+        allele_index[<unsigned char> alt[0]] = k + 1
+
+    cdef char *b
+    cdef int a
+    for k in range(writer.sample_num):
+        b = batchinfo.sample_bases[k]
+        if b[0] in b'N-+' or b[1] != 0:
+            # 'N' base or indel
+            writer.set_missing_sample(k)
+            continue
+
+        # The same as '0/.', './1' and './.' in VCF
+        a = allele_index[<unsigned char> b[0]]
+        writer.gts[2 * k] = bcf_gt_unphased(0) if a == 0 else bcf_gt_missing
+        writer.gts[2 * k + 1] = bcf_gt_unphased(a) if a > 0 else bcf_gt_missing
+        writer.bases[k] = b[0]
+        writer.strands[k] = batchinfo.strands[k]
+        writer.probs[k] = bt.qual_pvalue[k]
+
+    cdef list float_info = [
+        # ``af_by_lrt`` are the text of VCF
+        ('CM_AF', [float(bt.af_by_lrt[alt]) for alt in bt.alt_bases]),
+        ('CM_CAF', [bt.depth[alt] / float(bt.total_depth) for alt in bt.alt_bases]),
+        ('MQRankSum', [mq_rank_sum if mq_rank_sum != -1 else NAN]),
+        ('ReadPosRankSum', [read_pos_rank_sum if read_pos_rank_sum != -1 else NAN]),
+        ('BaseQRankSum', [base_q_rank_sum if base_q_rank_sum != -1 else NAN]),
+        ('QD', [qd]),
+        ('SOR', [sor]),
+        ('FS', [fs])
+    ]
+
+    cdef BaseType g_bt
+    if pop_group_bt:
+        for group, g_bt in pop_group_bt.items():
+            float_info.append((group, [float(g_bt.af_by_lrt[alt]) if alt in g_bt.af_by_lrt else 0.0
+                                       for alt in bt.alt_bases]))
+
+    writer.write_variant(batchinfo.chrid, batchinfo.position, b','.join([batchinfo.ref_base] + bt.alt_bases),
+                         bt.var_qual, bt.var_qual <= QUAL_THRESHOLD,
+                         [('CM_DP', [int(bt.total_depth)]), ('CM_AC', [bt.depth[alt] for alt in bt.alt_bases]),
+                          ('SB_REF', sb_ref), ('SB_ALT', sb_alt)],
+                         float_info)
     return
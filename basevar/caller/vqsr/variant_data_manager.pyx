@@ -7,11 +7,13 @@ Author: Shujia Huang
 Date: 2017-08-02
 
 """
-import re
-
 import numpy as np
 from sklearn.metrics import roc_curve
 
+from libc.math cimport round as c_round
+from libc.stdlib cimport strtod
+from libc.string cimport strncmp
+
 from basevar.log import logger
 from basevar.io.openfile import Open
 
@@ -19,6 +21,18 @@ from basevar.caller.vqsr import variant_recalibrator_argument_collection as VRAC
 from basevar.caller.vqsr import variant_datum as vd
 from basevar.caller.vqsr import vcfutils
 
+DEF ANNOTATION_NUM = 6
+
+# The same order as ``variant_datum.ANNOTATION_NAMES``
+cdef char *ANNOTATION_KEYS[ANNOTATION_NUM]
+ANNOTATION_KEYS[:] = [b"QD", b"FS", b"BaseQRankSum", b"SOR", b"MQRankSum", b"ReadPosRankSum"]
+
+cdef int ANNOTATION_KEY_LENGTHS[ANNOTATION_NUM]
+ANNOTATION_KEY_LENGTHS[:] = [2, 2, 12, 3, 9, 14]
+
+# The value of "nan" annotations
+DEF MISSING_ANNOTATION = 10000.0
+
 
 class VariantDataManager(object):
 
@@ -27,32 +41,28 @@ class VariantDataManager(object):
         self.annotation_mean = None
         self.annotation_STD = None
 
-        self.data = []  # list <VariantDatum>
-        if data:  # data is not None
-            if not isinstance(data[0], vd.VariantDatum):
-                raise ValueError('[ERROR] The data type should be "VariantDatum" in VariantDataManager(), '
-                                 'but found %s' % type(data[0]))
-            self.data = data
-            for i, d in enumerate(self.data):
-                self.data[i].annotations = np.array(self.data[i].annotations)
+        self.data = None  # VariantDataSet
+        if data is not None:
+            self.set_data(data)
 
     def set_data(self, data):
 
-        if not isinstance(data[0], vd.VariantDatum):
-            raise ValueError('[ERROR] The data type should be "VariantDatum" in VariantDataManager(),'
-                             'but found %s' % type(data[0]))
+        if not isinstance(data, vd.VariantDataSet):
+            raise ValueError('[ERROR] The data type should be "VariantDataSet" in VariantDataManager(),'
+                             'but found %s' % type(data))
         self.data = data
-        for i, d in enumerate(self.data):
-            self.data[i].annotations = np.array(d.annotations)
 
-    def normalization(self):
-        # data normalization
+    def normalization(self, mean=None, std=None):
+        # data normalization, by the given ``mean`` and ``std`` (e.g. of all the variants while
+        # ``data`` is a sample of them) or of ``data``
 
-        data = np.array([d.annotations for d in self.data], dtype=float)
-        mean = data.mean(axis=0)
+        data = self.data.annotations
+        if mean is None:
+            mean = data.mean(axis=0)
         self.annotation_mean = mean
 
-        std = data.std(axis=0)
+        if std is None:
+            std = data.std(axis=0)
         self.annotation_STD = std
 
         # foundZeroVarianceAnnotation
@@ -61,19 +71,16 @@ class VariantDataManager(object):
                              'They must be excluded before proceeding.')
 
         # Each data now is (x - mean)/std
-        for i, d in enumerate(data):
-
-            self.data[i].annotations = (d - mean) / std
+        data -= mean
+        data /= std
 
-            # trim data by standard deviation threshold and mark failing data 
-            # for exclusion later
-            self.data[i].failing_STD_threshold = False
-            if any(np.abs(self.data[i].annotations) > self.VRAC.STD_THRESHOLD):
-                self.data[i].failing_STD_threshold = True
+        # trim data by standard deviation threshold and mark failing data
+        # for exclusion later
+        self.data.failing_STD_threshold = (np.abs(data) > self.VRAC.STD_THRESHOLD).any(axis=1)
 
     def get_training_data(self):
 
-        training_data = [d for d in self.data if ((not d.failing_STD_threshold) and d.at_training_site)]
+        training_data = self.data.annotations[(~self.data.failing_STD_threshold) & self.data.at_training_site]
         logger.info(('Training with %d variants after standard '
                      'deviation thresholding.\n' % len(training_data)))
 
@@ -88,18 +95,15 @@ class VariantDataManager(object):
                            self.VRAC.MAX_NUM_TRAINING_DATA)
 
             np.random.shuffle(training_data)  # Random shuffling
-            return list([training_data[i] for i in range(self.VRAC.MAX_NUM_TRAINING_DATA)])
+            return training_data[:self.VRAC.MAX_NUM_TRAINING_DATA]
 
         return training_data
 
     def select_worst_variants(self, bad_lod):
 
-        training_data = []
-        for i, d in enumerate(self.data):
-            if (d.lod < bad_lod) and (not d.failing_STD_threshold):
-                training_data.append(d)
-                # I do need: i order to be the same as self.data
-                self.data[i].at_anti_training_site = True
+        # I do need: i order to be the same as self.data
+        self.data.at_anti_training_site |= (self.data.lod < bad_lod) & (~self.data.failing_STD_threshold)
+        training_data = self.data.annotations[self.data.at_anti_training_site]
 
         logger.info('Training with worst %d scoring variants --> variants with LOD < %.2f.\n' %
                     (len(training_data), bad_lod))
@@ -110,7 +114,7 @@ class VariantDataManager(object):
                            self.VRAC.MAX_NUM_TRAINING_DATA)
 
             np.random.shuffle(training_data)  # Random shuffling
-            return list(training_data[i] for i in range(self.VRAC.MAX_NUM_TRAINING_DATA))
+            return training_data[:self.VRAC.MAX_NUM_TRAINING_DATA]
 
         return training_data
 
@@ -118,15 +122,14 @@ class VariantDataManager(object):
 
         lod_threshold, lod_cum = None, []
         if len(self.data) > 0:
-            lod_dist = np.array([[d.at_training_site, d.lod]
-                                 for d in self.data if (not d.failing_STD_threshold)])
+            passing = ~self.data.failing_STD_threshold
 
-            # I just use the 'roc_curve' function to calculate the worst 
-            # LOD threshold, not use it to draw ROC curve And 'roc_curve' 
-            # function will output the increse order, so that I don't 
+            # I just use the 'roc_curve' function to calculate the worst
+            # LOD threshold, not use it to draw ROC curve And 'roc_curve'
+            # function will output the increse order, so that I don't
             # have to sort it again
 
-            _, tpr, thresholds = roc_curve(lod_dist[:, 0], lod_dist[:, 1])
+            _, tpr, thresholds = roc_curve(self.data.at_training_site[passing], self.data.lod[passing])
             lod_cum = [[thresholds[i], 1.0 - r] for i, r in enumerate(tpr)]
 
             for i, r in enumerate(tpr):
@@ -151,69 +154,238 @@ def load_training_site_from_VCF(vcf_file):
             if n % 100000 == 0:
                 logger.info("Loading lines %d" % n)
 
-            if re.search(r'^#', line):
+            if line.startswith('#'):
                 continue
 
-            col = line.strip().split()
+            col = line.split(None, 2)
             data_set.add(col[0] + ':' + col[1])  # just get the positions
 
     logger.info('[INFO] Finish loading training set %d lines.' % n)
 
     return data_set
 
-def load_data_set(vcf_infile, training_set):
-    if len(training_set) == 0:
-        raise ValueError('[ERROR] No Training Data found')
 
-    I = Open(vcf_infile, 'r')
-    logger.info('Loading data set from VCF %s' % vcf_infile)
+cdef int parse_annotations(const char *info, double *values) except -1:
+    """Get the values of ANNOTATION_KEYS from the INFO field of VCF into ``values`` in one pass,
+    return the bit flags of the annotations which are found.
+
+    "nan" is MISSING_ANNOTATION, and the values are rounded to 3 decimals as in the VCF of BaseType.
+    """
+    cdef int found = 0, k, key_length
+    cdef const char *key = info
+    cdef const char *value
+    cdef char *end
+    while key[0] != 0:
+        # The key ends by "=", ";" or the end of INFO
+        key_length = 0
+        while key[key_length] != 0 and key[key_length] != b'=' and key[key_length] != b';':
+            key_length += 1
+
+        if key[key_length] == b'=':
+            value = key + key_length + 1
+            for k in range(ANNOTATION_NUM):
+                if (found >> k) & 1 or key_length != ANNOTATION_KEY_LENGTHS[k] or \
+                        strncmp(key, ANNOTATION_KEYS[k], key_length) != 0:
+                    continue
+
+                if strncmp(value, b"nan", 3) == 0 and (value[3] == 0 or value[3] == b';' or value[3] == b'\n'):
+                    values[k] = MISSING_ANNOTATION
+                else:
+                    values[k] = strtod(value, &end)
+                    if end == value:
+                        raise ValueError("[ERROR] Bad value of %s in INFO: %s" % (ANNOTATION_KEYS[k], info))
+                    values[k] = c_round(values[k] * 1000.0) / 1000.0
+
+                found |= 1 << k
+                break
+
+        # Next key
+        while key[0] != 0 and key[0] != b';':
+            key += 1
+        if key[0] == b';':
+            key += 1
+
+    return found
+
+
+def load_data_chunks(vcf_infile, training_set, long int chunk_size=100000, h_info=None, bint keep_records=False):
+    """Load the annotations of the variants in ``vcf_infile`` in one pass and yield them in
+    ``VariantDataSet`` of at most ``chunk_size`` variants, the variants which lack any of the
+    annotations or with 'N' REF are skipped.
+
+    The ``offsets`` are the offsets of the records in the uncompressed ``vcf_infile``, the header
+    is recorded into ``h_info`` if it's given and the records are kept in ``records`` of each chunk
+    if ``keep_records``.
+    """
+    annotations = np.empty((chunk_size, ANNOTATION_NUM), dtype=float)
+    at_training_site = np.zeros(chunk_size, dtype=np.uint8)
+    offsets = np.empty(chunk_size, dtype=np.int64)
+
+    cdef double[:, ::1] annotation_view = annotations
+    cdef unsigned char[::1] training_view = at_training_site
+    cdef long long[::1] offset_view = offsets
+    cdef int all_found = (1 << ANNOTATION_NUM) - 1
+    cdef long int size = 0, n = 0, offset = 0
+    cdef bytes info
+    cdef list records = []
 
-    n, data, h_info = 0, [], vcfutils.Header()
     with Open(vcf_infile, 'r') as I:
         for line in I:
             # VCF format
             n += 1
-            if n % 10000 == 0:
+            if n % 100000 == 0:
                 logger.info('Loading lines %d' % n)
 
+            offset += len(line)
+
             # Record the header information
             if line.startswith("#"):
-                h_info.record(line.strip())
+                if h_info is not None:
+                    h_info.record(line.strip())
                 continue
 
-            col = line.strip().split()
+            col = line.split('\t', 8)
             if col[3] in ['N', 'n']:
                 continue
 
-            qd = re.search(r';?QD=([^;]+)', col[7])
-            fs = re.search(r';?FS=([^;]+)', col[7])
-            base_q_ranksum = re.search(r';?BaseQRankSum=([^;]+)', col[7])
-            sor = re.search(r';?SOR=([^;]+)', col[7])
-            mq_ranksum = re.search(r';?MQRankSum=([^;]+)', col[7])
-            read_pos_ranksum = re.search(r';?ReadPosRankSum=([^;]+)', col[7])
-
-            if any([not qd, not fs, not base_q_ranksum, not sor, not mq_ranksum, not read_pos_ranksum]):
+            info = col[7]
+            if parse_annotations(info, &annotation_view[size, 0]) != all_found:
                 continue
 
-            qd = round(float(qd.group(1)), 3) if qd.group(1) != "nan" else 10000
-            fs = round(float(fs.group(1)), 3) if fs.group(1) != "nan" else 10000
-            base_q_ranksum = round(float(base_q_ranksum.group(1)), 3) if base_q_ranksum.group(1) != "nan" else 10000
-            sor = round(float(sor.group(1)), 3) if sor.group(1) != "nan" else 10000
-            mq_ranksum = round(float(mq_ranksum.group(1)), 3) if mq_ranksum.group(1) != "nan" else 10000
-            read_pos_ranksum = round(float(read_pos_ranksum.group(1)), 3) \
-                if read_pos_ranksum.group(1) != "nan" else 10000
-
-            if fs >= 10000.0:
-                fs = 10000.0
+            # FS
+            if annotation_view[size, 1] >= MISSING_ANNOTATION:
+                annotation_view[size, 1] = MISSING_ANNOTATION
 
-            datum = vd.VariantDatum()
-            datum.annotations = [qd, fs, base_q_ranksum, sor, mq_ranksum, read_pos_ranksum]
+            training_view[size] = (col[0] + ':' + col[1]) in training_set
+            offset_view[size] = offset - len(line)
+            if keep_records:
+                records.append(line)
 
-            datum.variant_order = col[0] + ':' + col[1]
-            if datum.variant_order in training_set:
-                datum.at_training_site = True
+            size += 1
+            if size == chunk_size:
+                yield _data_chunk(annotations, at_training_site, offsets, size, records)
+                size = 0
+                records = []
 
-            data.append(datum)
+    if size > 0:
+        yield _data_chunk(annotations, at_training_site, offsets, size, records)
 
     logger.info('Finish loading data set %d lines.' % n)
-    return h_info, np.array(data)
+
+
+def _data_chunk(annotations, at_training_site, offsets, size, records):
+    data = vd.VariantDataSet(annotations[:size].copy(), at_training_site[:size].astype(bool), offsets[:size].copy())
+    data.records = records
+    return data
+
+
+def load_data_set(vcf_infile, training_set):
+    """Load the annotations of all the variants in ``vcf_infile`` in one pass, the variants which
+    lack any of the annotations or with 'N' REF are skipped.
+
+    Return the header and a ``VariantDataSet``, whose ``offsets`` are the offsets of the records
+    in the uncompressed ``vcf_infile``.
+    """
+    if len(training_set) == 0:
+        raise ValueError('[ERROR] No Training Data found')
+
+    logger.info('Loading data set from VCF %s' % vcf_infile)
+
+    h_info = vcfutils.Header()
+    cdef list chunks = list(load_data_chunks(vcf_infile, training_set, chunk_size=1 << 20, h_info=h_info))
+    if not chunks:
+        return h_info, vd.VariantDataSet(np.empty((0, ANNOTATION_NUM)), np.zeros(0, dtype=bool),
+                                         np.zeros(0, dtype=np.int64))
+
+    return h_info, vd.VariantDataSet(np.concatenate([d.annotations for d in chunks]),
+                                     np.concatenate([d.at_training_site for d in chunks]),
+                                     np.concatenate([d.offsets for d in chunks]))
+
+
+class OnlineMoments(object):
+    """Mean and (population) standard deviation of the annotations, updated chunk by chunk by
+    merging the moments of the chunk (Chan et al.), which is numerically stable.
+    """
+    def __init__(self, dim):
+        self.n = 0
+        self.mean = np.zeros(dim)
+        self.m2 = np.zeros(dim)  # Sum of squares of differences from the mean
+
+    def update(self, data):
+        cdef long int n = len(data)
+        if n == 0:
+            return
+
+        mean = data.mean(axis=0)
+        m2 = ((data - mean) ** 2).sum(axis=0)
+        delta = mean - self.mean
+        total = self.n + n
+
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * (float(self.n) * n / total)
+        self.n = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n) if self.n > 0 else np.zeros(len(self.m2))
+
+
+class ReservoirSample(object):
+    """A uniform sample of at most ``capacity`` variants of a stream (reservoir sampling)."""
+    def __init__(self, capacity, dim, rng):
+        self.capacity = capacity
+        self.rng = rng
+        self.seen = 0
+        self.size = 0
+        self.annotations = np.empty((capacity, dim))
+        self.at_training_site = np.zeros(capacity, dtype=bool)
+
+    def add(self, annotations, at_training_site):
+        cdef long int n = len(annotations)
+        cdef long int free = min(self.capacity - self.size, n)
+        if free > 0:
+            self.annotations[self.size:self.size + free] = annotations[:free]
+            self.at_training_site[self.size:self.size + free] = at_training_site[:free]
+            self.size += free
+
+        if n > free:
+            # The i-th variant of the stream replaces a random one if randint(0, i) < capacity, the
+            # later ones win if they pick the same slot, just as one by one.
+            seen = self.seen + free + np.arange(n - free)
+            slot = (self.rng.random_sample(n - free) * (seen + 1)).astype(np.int64)
+            keep = slot < self.capacity
+            self.annotations[slot[keep]] = annotations[free:][keep]
+            self.at_training_site[slot[keep]] = at_training_site[free:][keep]
+
+        self.seen += n
+
+    def to_data_set(self):
+        return vd.VariantDataSet(self.annotations[:self.size].copy(), self.at_training_site[:self.size].copy(),
+                                 np.zeros(self.size, dtype=np.int64))
+
+
+def sample_data_set(vcf_infile, training_set, training_capacity, variant_capacity, chunk_size=100000, seed=None):
+    """Stream ``vcf_infile`` once in bounded memory: the moments of the annotations of all the
+    variants, a sample of the training sites (they are kept preferentially, up to
+    ``training_capacity``) and a uniform sample of all the variants (up to ``variant_capacity``).
+
+    Return the header, the moments and the two samples as ``VariantDataSet``.
+    """
+    if len(training_set) == 0:
+        raise ValueError('[ERROR] No Training Data found')
+
+    logger.info('Sampling data set from VCF %s' % vcf_infile)
+
+    rng = np.random.RandomState(seed)
+    h_info = vcfutils.Header()
+    moments = OnlineMoments(ANNOTATION_NUM)
+    training_sample = ReservoirSample(training_capacity, ANNOTATION_NUM, rng)
+    variant_sample = ReservoirSample(variant_capacity, ANNOTATION_NUM, rng)
+    for data in load_data_chunks(vcf_infile, training_set, chunk_size=chunk_size, h_info=h_info):
+        moments.update(data.annotations)
+        training_sample.add(data.annotations[data.at_training_site], data.at_training_site[data.at_training_site])
+        variant_sample.add(data.annotations, data.at_training_site)
+
+    logger.info('Sampled %d of %d training sites and %d of %d variants.' % (
+        training_sample.size, training_sample.seen, variant_sample.size, variant_sample.seen))
+    return h_info, moments, training_sample.to_data_set(), variant_sample.to_data_set()
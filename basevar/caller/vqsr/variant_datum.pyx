@@ -2,16 +2,27 @@
 Author : Shujia Huang
 Date   : 2014-05-20 17:49:27
 """
+import numpy as np
 
+# The annotations for VQSR, which are the columns of ``VariantDataSet.annotations``
+ANNOTATION_NAMES = ['QD', 'FS', 'BaseQRankSum', 'SOR', 'MQRankSum', 'ReadPosRankSum']
 
-class VariantDatum(object):
 
-    def __init__(self):
-        self.annotations = []  # Will be normalize and use for VQSR
-        self.lod = None
+class VariantDataSet(object):
+    """The variants for VQSR in columns, one row for each variant in the order of VCF.
+    """
+    def __init__(self, annotations, at_training_site, offsets):
+        self.annotations = annotations  # Will be normalize and use for VQSR, float array of n x annotations
+        self.at_training_site = at_training_site  # bool array
+        self.offsets = offsets  # Offset of each record in the (uncompressed) VCF
+        self.records = None  # The VCF records if they are kept while loading
+
+        cdef long int n = len(offsets)
+        self.lod = np.zeros(n, dtype=float)
         self.prior = 2.0
-        self.at_training_site = False
-        self.at_anti_training_site = False
-        self.failing_STD_threshold = False
-        self.worst_annotation = None
-        self.variant_order = None
+        self.at_anti_training_site = np.zeros(n, dtype=bool)
+        self.failing_STD_threshold = np.zeros(n, dtype=bool)
+        self.worst_annotation = np.zeros(n, dtype=int)
+
+    def __len__(self):
+        return len(self.offsets)
@@ -10,13 +10,18 @@ from basevar.caller.vqsr import variant_recalibrator_argument_collection as VRAC
 
 class VariantRecalibrator(object):
 
-    def __init__(self):
-        self.VRAC = VRAC.VariantRecalibratorArgumentCollection()
+    def __init__(self, vrac=None):
+        self.VRAC = vrac if vrac else VRAC.VariantRecalibratorArgumentCollection()
         self.data_manager = vdm.VariantDataManager()
+        self.data_manager.VRAC = self.VRAC
         self.engine = vre.VariantRecalibratorEngine(self.VRAC)
         self.bad_lod_cutoff = None
         self.lod_cum_in_train = []
 
+        # The models trained by ``on_sampling_done`` for scoring the variants chunk by chunk
+        self.good_model = None
+        self.bad_model = None
+
     def on_traversal_done(self, data):
         self.data_manager.set_data(data)
         self.data_manager.normalization()
@@ -59,6 +64,57 @@ class VariantRecalibrator(object):
         # tranches of calls requested by the user
         self.engine.calculate_worst_performing_annotation(self.data_manager.data, good_model, bad_model)
 
+    def on_sampling_done(self, moments, training_sample, variant_sample):
+        """Train the models by the samples of ``variant_data_manager.sample_data_set``, the data
+        are normalized by the ``moments`` of all the variants. The variants are then scored by
+        ``evaluate_chunk``.
+        """
+        # Generate the positive model using the sample of training sites
+        self.data_manager.set_data(training_sample)
+        self.data_manager.normalization(moments.mean, moments.std)
+        positive_training_data = self.data_manager.get_training_data()
+        logger.info('\nTraining the goodModel ...')
+
+        self.good_model = self.engine.generate_model(positive_training_data, self.VRAC.MAX_GAUSSIANS)
+        logger.info('The converged information of goodModel is: %s.' % self.good_model.converged_)
+        logger.info('The means of gaussion of goodModel is:\n%s.' % self.good_model.means_)
+
+        # Find the bad LOD cutoff and the worst performing variants in the uniform sample
+        self.data_manager.set_data(variant_sample)
+        self.data_manager.normalization(moments.mean, moments.std)
+        self.engine.evaluate_data(variant_sample, self.good_model, False)
+        self.bad_lod_cutoff, self.lod_cum_in_train = self.data_manager.calculate_worst_lod_cutoff()
+
+        logger.info('\nTraining the badModel ...')
+        negative_training_data = self.data_manager.select_worst_variants(self.bad_lod_cutoff)
+        self.bad_model = self.engine.generate_model(
+            negative_training_data,
+            min(self.VRAC.MAX_GAUSSIANS_FOR_NEGATIVE_MODEL, self.VRAC.MAX_GAUSSIANS)
+        )
+
+        logger.info('The converged information of badModel is: %s.' % self.bad_model.converged_)
+        logger.info('The means of gaussion of badModel is:\n%s.' % self.bad_model.means_)
+
+    def evaluate_chunk(self, data):
+        """Score a chunk of variants by the models of ``on_sampling_done``, the same as
+        ``on_traversal_done`` does for all the variants."""
+        self.data_manager.set_data(data)
+        self.data_manager.normalization(self.data_manager.annotation_mean, self.data_manager.annotation_STD)
+
+        self.engine.evaluate_data(data, self.good_model, False)
+        data.at_anti_training_site = (data.lod < self.bad_lod_cutoff) & (~data.failing_STD_threshold)
+        self.engine.evaluate_data(data, self.bad_model, True)
+
+        if (not self.good_model.converged_) or (not self.bad_model.converged_):
+            raise ValueError('[ERROR] NaN LOD value assigned. Clustering '
+                             'with these variants and these annotations is '
+                             'unsafe. Please consider raising the number of '
+                             'variants used to train the negative model or '
+                             'lowering the maximum number of gaussians allowed '
+                             'for use in the model.')
+
+        self.engine.calculate_worst_performing_annotation(data, self.good_model, self.bad_model)
+
     def visualization_lod_VS_training_set(self, fig_name):
         import matplotlib.pyplot as plt
 
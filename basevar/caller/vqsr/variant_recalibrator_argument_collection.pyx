@@ -23,3 +23,9 @@ class VariantRecalibratorArgumentCollection(object):
         # The threshold that the positive trainingset -> negative
         self.POSITIVE_TO_NEGATIVE_RATE = 0.05
         self.MAX_GAUSSIANS_FOR_NEGATIVE_MODEL = 6
+
+        self.NPROC = 1  # Processes for fitting the GMM of different number of gaussians
+        self.SELECTION_SUBSAMPLE = 0  # Select the number of gaussians on a subsample of this size, 0 for all data
+        self.SEED = None  # Random seed for fitting GMM and subsampling
+        self.EVALUATE_CHUNK_SIZE = 100000  # Variants evaluated together by the models
+        self.RESERVOIR_SIZE = 2000000  # Uniform sample of all the variants for the bad model in streaming mode
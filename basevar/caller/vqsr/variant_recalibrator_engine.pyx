@@ -2,6 +2,9 @@
 Author: Shujia Huang & Siyang Liu
 Date  : 2014-05-20 08:50:06
 """
+import time
+import multiprocessing
+
 import numpy as np
 from scipy.misc import logsumexp
 from sklearn.mixture import GaussianMixture
@@ -50,107 +53,153 @@ class VariantRecalibratorEngine(object):
         if len(data) == 0:
             raise ValueError('[ERROR] No data found. The size is %d\n' % len(data))
 
-        if not isinstance(data[0], vd.VariantDatum):
-            raise ValueError('[ERROR] The data type should be "VariantDatum" '
+        if not isinstance(data, np.ndarray) or data.ndim != 2:
+            raise ValueError('[ERROR] The data should be a 2-d array of annotations '
                              'in GenerateModel() of class VariantRecalibrato-'
-                             'rEngine(), but found %s\n' % str(type(data[0])))
+                             'rEngine(), but found %s\n' % str(type(data)))
 
         if max_gaussians <= 0:
             raise ValueError('[ERROR] maxGaussians must be a positive integer '
                              'but found: %d\n' % max_gaussians)
 
-        gmms = [GaussianMixture(n_components=n + 1,
-                                covariance_type='full',
-                                tol=self.MIN_PROB_CONVERGENCE,
-                                max_iter=self.VRAC.NITER,
-                                n_init=self.VRAC.NINIT) for n in range(max_gaussians)]
-
-        training_data = np.array([d.annotations for d in data])
+        training_data = data
+        if 0 < self.VRAC.SELECTION_SUBSAMPLE < len(data):
+            training_data = self.stratified_subsample(data, self.VRAC.SELECTION_SUBSAMPLE)
+            logger.info('Selecting the number of gaussians on a subsample of %d variants.' % len(training_data))
+
+        # The candidates are independent and have the same seed, so they are the same no matter
+        # which process fits them.
+        tasks = [(self.new_gmm(n + 1), training_data) for n in range(max_gaussians)]
+        nproc = min(self.VRAC.NPROC, max_gaussians)
+        logger.info('Trying 1-%d gaussian in GMM process training with %d processes ...' % (max_gaussians, nproc))
+        if nproc > 1:
+            pool = multiprocessing.Pool(nproc)
+            try:
+                results = pool.map(_fit_gmm, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_fit_gmm(t) for t in tasks]
 
         # find a best components for GMM model
         min_bic, bics = np.inf, []
-        for g in gmms:
-            logger.info('Trying %d gaussian in GMM process training ...' % g.n_components)
-
-            g.fit(training_data)
-
-            bic = g.bic(training_data)
+        for g, bic, elapsed in results:
+            logger.info('  -- %d gaussian: BIC %f, converged: %s, %.1f seconds elapsed.' % (
+                g.n_components, bic, g.converged_, elapsed))
             bics.append(bic)
 
             if bic == float('inf') or (bic < min_bic and g.converged_):
                 best_gmm, min_bic = g, bic
 
-            logger.info('  -- Converge information of training process: %s' % g.converged_)
-
         logger.info('[INFO] All the BIC: %s' % bics)
+        if training_data is not data:
+            logger.info('Refitting the model with %d gaussians on all the %d variants ...' % (
+                best_gmm.n_components, len(data)))
+            best_gmm, min_bic, elapsed = _fit_gmm((self.new_gmm(best_gmm.n_components), data))
+            logger.info('  -- BIC %f, converged: %s, %.1f seconds elapsed.' % (min_bic, best_gmm.converged_, elapsed))
+
         logger.info('[INFO] Model Training Done. And take the model '
                     'with %d gaussiones which with BIC %f.\n' %
                     (len(best_gmm.means_), min_bic))
 
         return best_gmm
 
+    def new_gmm(self, n_components):
+        return GaussianMixture(n_components=n_components,
+                               covariance_type='full',
+                               tol=self.MIN_PROB_CONVERGENCE,
+                               max_iter=self.VRAC.NITER,
+                               n_init=self.VRAC.NINIT,
+                               random_state=self.VRAC.SEED)
+
+    def stratified_subsample(self, data, size, strata_num=10):
+        """Subsample ``size`` rows of ``data`` proportionally from the strata of the distance to the
+        center, so that the tails, which decide the extra gaussians, are kept as much as the core.
+        """
+        rng = np.random.RandomState(self.VRAC.SEED)
+        order = np.argsort(np.sqrt((data ** 2).sum(axis=1)), kind='mergesort')
+
+        index = []
+        for stratum in np.array_split(order, strata_num):
+            n = int(round(float(size) * len(stratum) / len(data)))
+            index.append(rng.choice(stratum, min(n, len(stratum)), replace=False))
+
+        return data[np.sort(np.concatenate(index))]
+
     def evaluate_data(self, data, gmm, evaluate_contrastively=False):
 
-        if not isinstance(data[0], vd.VariantDatum):
-            raise ValueError('[ERROR] The data type should be "VariantDatum" '
+        if not isinstance(data, vd.VariantDataSet):
+            raise ValueError('[ERROR] The data type should be "VariantDataSet" '
                              'in EvaluateData() of class VariantRecalibrator-'
-                             'Engine(), but found %s' % str(type(data[0])))
+                             'Engine(), but found %s' % str(type(data)))
 
         logger.info('Evaluating full set of %d variants ...' % len(data))
 
-        for i, _ in enumerate(data):
+        cdef long int start, end, chunk_size = self.VRAC.EVALUATE_CHUNK_SIZE
+        for start in range(0, len(data), chunk_size):
+            end = min(start + chunk_size, len(data))
 
             # log likelihood and the base is 10
-            this_lod = gmm.score(data[i].annotations[np.newaxis, :]) / np.log(10)
-            if np.math.isnan(this_lod):
+            this_lod = gmm.score_samples(data.annotations[start:end]) / np.log(10)
+            if np.isnan(this_lod).any():
                 gmm.converged_ = False
                 return
 
             if evaluate_contrastively:
-                # data[i].lod must has been assigned by good model.
+                # data.lod must has been assigned by good model.
                 # contrastive evaluation: (prior + positive model - negative model)
-                data[i].lod = data[i].prior + data[i].lod - this_lod
-                if this_lod == float('inf'):
-                    data[i].lod = self.MIN_ACCEPTABLE_LOD_SCORE * (1.0 + np.random.rand(1)[0])
+                lod = data.prior + data.lod[start:end] - this_lod
+                is_inf = this_lod == float('inf')
+                lod[is_inf] = self.MIN_ACCEPTABLE_LOD_SCORE * (1.0 + np.random.rand(is_inf.sum()))
+                data.lod[start:end] = lod
             else:
-                # positive model only so set the lod and return 
-                data[i].lod = this_lod
+                # positive model only so set the lod and return
+                data.lod[start:end] = this_lod
 
         return self
 
     def calculate_worst_performing_annotation(self, data, good_model, bad_model):
 
-        for i, d in enumerate(data):
-            prob_diff = [self.evaluate_datum_in_one_dimension(good_model, d, k) -
-                         self.evaluate_datum_in_one_dimension(bad_model, d, k)
-                         for k in range(len(d.annotations))]
+        cdef long int start, end, chunk_size = self.VRAC.EVALUATE_CHUNK_SIZE
+        for start in range(0, len(data), chunk_size):
+            end = min(start + chunk_size, len(data))
+            annotations = data.annotations[start:end]
+            prob_diff = (self.evaluate_data_in_each_dimension(good_model, annotations) -
+                         self.evaluate_data_in_each_dimension(bad_model, annotations))
 
             # Get the index of the worst annotations
-            data[i].worst_annotation = np.argsort(prob_diff)[0]
+            data.worst_annotation[start:end] = np.argmin(prob_diff, axis=1)
 
         return self
 
-    def evaluate_datum_in_one_dimension(self, gmm, datum, iii):
+    def evaluate_data_in_each_dimension(self, gmm, annotations):
+        """log10(Sum(pi_k * p(v|n,k))) of each annotation by itself, ``annotations`` is an array of
+        n x annotations and so is the return.
+        """
+        # n x gaussians x annotations
+        p_var_in_gaussian_loge = np.log(gmm.weights_)[np.newaxis, :, np.newaxis] + normal_distribution_Loge(
+            gmm.means_[np.newaxis, :, :],
+            np.diagonal(gmm.covariances_, axis1=1, axis2=2)[np.newaxis, :, :],
+            annotations[:, np.newaxis, :])
+
+        return logsumexp(p_var_in_gaussian_loge, axis=1) / np.log(10)
 
-        p_var_in_gaussian_loge = [
-            np.log(w) + normal_distribution_Loge(
-                gmm.means_[k][iii],
-                gmm.covariances_[k][iii][iii],  # gmm.covars_[k][iii][iii],
-                datum.annotations[iii])
-            for k, w in enumerate(gmm.weights_)
-        ]
 
-        # np.log10(Sum(pi_k * p(v|n,k)))
-        return logsumexp(np.array(p_var_in_gaussian_loge)) / np.log(10)
+def _fit_gmm(task):
+    """Fit the GMM in a process of the pool, return the GMM, its BIC and the seconds elapsed."""
+    gmm, data = task
+    start_time = time.time()
+    gmm.fit(data)
+    return gmm, gmm.bic(data), time.time() - start_time
 
 
 def normal_distribution_Loge(mu, sigma, x):
-    if sigma <= 0:
+    """The natural log of normal density, element-wise for arrays."""
+    if np.any(sigma <= 0):
         raise ValueError('[ERROR] sd: Standard deviation of normal must '
-                         'be > 0 but found: %f\n' % sigma)
-    if (mu == float('inf') or mu == float('-inf') or
-            sigma == float('inf') or sigma == float('-inf') or
-            x == float('inf') or x == float('-inf')):
+                         'be > 0 but found: %s\n' % np.min(sigma))
+    if np.isinf(mu).any() or np.isinf(sigma).any() or np.isinf(x).any():
         raise ValueError('[ERROR] mean, sd, or, x: Normal parameters must '
                          'be well formatted (non-INF, non-NAN)')
 
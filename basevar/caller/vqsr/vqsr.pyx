@@ -5,32 +5,65 @@ Variant quality score recalibrator (VQSR)
 Author: Shujia Huang & Siyang Liu
 Date  : 2014-05-23 11:21:53
 """
-import sys
+import os
 import re
 import time
+import multiprocessing
+
+import numpy as np
 
 from basevar.log import logger
 from basevar.caller.vqsr import variant_data_manager as vdm
+from basevar.caller.vqsr import variant_datum as vd
 from basevar.caller.vqsr import variant_recalibrator as vror
+from basevar.caller.vqsr import variant_recalibrator_argument_collection as VRAC
+
+from basevar.io.openfile import Open, read_range
+from basevar.io.BGZF.bgzf import is_bgzf, bgzf_block_offsets
 
-from basevar.io.openfile import Open
-from basevar.io.BGZF.tabix import tabix_index
+# The sidecar of the VCF by VQSR, which keeps the VQSLOD of the training sites for ApplyVQSR
+VQSLOD_SUFFIX = ".vqslod"
+VQSLOD_MAGIC = b"BVVQSLOD1\n"
+VQSLOD_DTYPE = np.dtype([("vqslod", "<f8"), ("flag", "u1")])
+POSITIVE_TRAIN_FLAG = 1
+NEGATIVE_TRAIN_FLAG = 2
+
+# Compressed bytes of the input VCF filtered by a process of ApplyVQSR at a time
+APPLY_CHUNK_BYTES = 16 << 20
 
 def run_VQSR(opt):
     # Just record the sites of training data
     training_set = vdm.load_training_site_from_VCF(opt.train_data)
 
-    # Identify the training sites
-    start_time = time.time()
-    h_info, data_set = vdm.load_data_set(opt.vcf_infile, training_set)
-    logger.info('Data loading is done, %d seconds elapsed.\n' % (time.time() - start_time))
-
     # init VariantRecalibrator object
-    vr = vror.VariantRecalibrator()
+    vrac = VRAC.VariantRecalibratorArgumentCollection()
+    vrac.NPROC = opt.nCPU
+    vrac.SELECTION_SUBSAMPLE = opt.selection_subsample
+    vrac.SEED = opt.seed
+    vrac.RESERVOIR_SIZE = opt.reservoir_size
+    vr = vror.VariantRecalibrator(vrac)
 
-    # Training model and calculate the VQ for all data_set
-    vr.on_traversal_done(data_set)
-    # vr.visualization_lod_VS_training_set('VQSR.Training.BadLodSelectInTraining.png')
+    start_time = time.time()
+    if opt.streaming:
+        # Train the models by the samples of variants, then score the variants chunk by chunk
+        # while outputting, the memory is bounded by the samples and the chunk.
+        h_info, moments, training_sample, variant_sample = vdm.sample_data_set(
+            opt.vcf_infile, training_set, vrac.MAX_NUM_TRAINING_DATA, vrac.RESERVOIR_SIZE,
+            chunk_size=vrac.EVALUATE_CHUNK_SIZE, seed=vrac.SEED)
+        logger.info('Data sampling is done, %d seconds elapsed.\n' % (time.time() - start_time))
+
+        vr.on_sampling_done(moments, training_sample, variant_sample)
+        records = _scored_records_by_chunks(opt.vcf_infile, training_set, vr)
+
+    else:
+        # Identify the training sites
+        h_info, data_set = vdm.load_data_set(opt.vcf_infile, training_set)
+        logger.info('Data loading is done, %d seconds elapsed.\n' % (time.time() - start_time))
+
+        # Training model and calculate the VQ for all data_set
+        vr.on_traversal_done(data_set)
+        # vr.visualization_lod_VS_training_set('VQSR.Training.BadLodSelectInTraining.png')
+        records = _scored_records_by_offsets(opt.vcf_infile, data_set)
 
     # Outputting the result as VCF format
     h_info.add('INFO', 'VQSLOD', 1, 'Float', 'Variant quality calculate by VQSR')
@@ -43,85 +76,68 @@ def run_VQSR(opt):
                'This variant was used to build the positive training set of good variants')
 
     logger.info("Outputting to %s ..." % opt.output_vcf_file_name)
-    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True) if opt.output_vcf_file_name.endswith(".gz") else \
-        open(opt.output_vcf_file_name, "w")
+    # The tabix index is built while writing if output is BGZF
+    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True, tabix=True, compress_level=opt.compress_level,
+               threads=opt.write_threads) \
+        if opt.output_vcf_file_name.endswith(".gz") else open(opt.output_vcf_file_name, "w")
 
     for k, h in sorted(h_info.header.items(), key=lambda d: d[0]):
         OUT.write("\n".join(h) + "\n")
 
     culprit, good, tot = {}, {}, 0.0
-    anno_texts = ['QD', 'FS', 'BaseQRankSum', 'SOR', 'MQRankSum', 'ReadPosRankSum']
+    anno_texts = vd.ANNOTATION_NAMES
+    train_vqslod, train_flags = [], []
 
-    cdef int n = 0, j = 0
+    cdef long int n = 0
     cdef bint monitor = True
-    with Open(opt.vcf_infile, 'r') as I:
-        for line in I:
-            n += 1
-            if n % 100000 == 0:
-                logger.info("** Output lines %d." % n)
-
-            if line.startswith('#'):
-                continue
-
-            col = line.strip().split()
-            if col[3] in ['N', 'n']:
-                continue
+    for line, lod, worst_annotation, at_training_site, at_anti_training_site in records:
+        n += 1
+        if n % 100000 == 0:
+            logger.info("** Output lines %d." % n)
 
-            qd = re.search(r';?QD=([^;]+)', col[7])
-            fs = re.search(r';?FS=([^;]+)', col[7])
-            base_q_ranksum = re.search(r';?BaseQRankSum=([^;]+)', col[7])
-            sor = re.search(r';?SOR=([^;]+)', col[7])
-            mq_ranksum = re.search(r';?MQRankSum=([^;]+)', col[7])
-            read_pos_ranksum = re.search(r';?ReadPosRankSum=([^;]+)', col[7])
+        col = line.strip().split()
 
-            if any([not qd, not fs, not base_q_ranksum, not sor, not mq_ranksum, not read_pos_ranksum]):
-                continue
+        # get INFO
+        vcf_info = {}
+        for info in col[7].split(';'):
+            k = info.split('=')[0]
 
-            order = col[0] + ':' + col[1]
-            d = data_set[j]
-            j += 1  # increase the index of data_set for the next cycle.
-            if d.variant_order != order:
-                raise ValueError('[BUG] The order(%s) must be the same as '
-                                 'dataSet(%s)' % (order, d.variant_order))
+            if monitor and k in vcf_info:
+                monitor = False
+                logger.warning('The tag: %s double hits in the INFO column at %s.' %
+                               (k, opt.vcf_infile))
+            vcf_info[k] = info
 
-            # get INFO
-            vcf_info = {}
-            for info in col[7].split(';'):
-                k = info.split('=')[0]
-
-                if monitor and k in vcf_info:
-                    monitor = False
-                    logger.warning('The tag: %s double hits in the INFO column at %s.' %
-                                   (k, opt.vcf_infile))
-                vcf_info[k] = info
+        tot += 1.0  # Record For summary
+        culprit[anno_texts[worst_annotation]] = culprit.get(
+            anno_texts[worst_annotation], 0.0) + 1.0  # For summary
 
-            tot += 1.0  # Record For summary
-            culprit[anno_texts[d.worst_annotation]] = culprit.get(
-                anno_texts[d.worst_annotation], 0.0) + 1.0  # For summary
+        lod = round(float(lod) * 10, 2)
+        for cutoff in [0, 1, 2, 3, 4, 5, 10, 20, 25, 30, 35, 40, 45, 50]:
+            if lod >= cutoff:
+                good[cutoff] = good.get(cutoff, 0.0) + 1.0
 
-            d.lod = round(d.lod * 10, 2)
-            for lod in [0, 1, 2, 3, 4, 5, 10, 20, 25, 30, 35, 40, 45, 50]:
-                if d.lod >= lod:
-                    good[lod] = good.get(lod, 0.0) + 1.0
+        if at_training_site:
+            vcf_info['POSITIVE_TRAIN_SITE'] = 'POSITIVE_TRAIN_SITE'
 
-            if d.at_training_site:
-                vcf_info['POSITIVE_TRAIN_SITE'] = 'POSITIVE_TRAIN_SITE'
+        if at_anti_training_site:
+            vcf_info['NEGATIVE_TRAIN_SITE'] = 'NEGATIVE_TRAIN_SITE'
 
-            if d.at_anti_training_site:
-                vcf_info['NEGATIVE_TRAIN_SITE'] = 'NEGATIVE_TRAIN_SITE'
+        if at_training_site or at_anti_training_site:
+            train_vqslod.append(lod)
+            train_flags.append((POSITIVE_TRAIN_FLAG if at_training_site else 0) |
+                               (NEGATIVE_TRAIN_FLAG if at_anti_training_site else 0))
 
-            vcf_info['CU'] = 'CU=' + anno_texts[d.worst_annotation]
-            vcf_info['VQSLOD'] = 'VQSLOD=' + str(d.lod)
+        vcf_info['CU'] = 'CU=' + anno_texts[worst_annotation]
+        vcf_info['VQSLOD'] = 'VQSLOD=' + str(lod)
 
-            col[7] = ';'.join(sorted(vcf_info.values()))
-            OUT.write('\t'.join(col) + "\n")
+        col[7] = ';'.join(sorted(vcf_info.values()))
+        OUT.write('\t'.join(col) + "\n")
 
     OUT.close()
 
-    if opt.output_vcf_file_name.endswith(".gz"):
-        # create tabix index
-        tabix_index(opt.output_vcf_file_name, force=True, seq_col=0, start_col=1, end_col=1)
-
+    # Written after the VCF, so that it's newer than the VCF
+    write_vqslod_sidecar(opt.output_vcf_file_name + VQSLOD_SUFFIX, train_vqslod, train_flags)
     logger.info('Finish Outputting %d lines.\n' % n)
 
     ## Output Summary
@@ -133,21 +149,67 @@ def run_VQSR(opt):
     for k, v in sorted(culprit.items(), key=lambda k: k[0]):
         logger.info(('  ** Culprit by %s: %d\t%.2f' % (k, v, v * 100.0 / tot)))
 
-def apply_VQSR(opt):
-    """Apply a score cutoff to filter variants."""
 
-    logger.info("Find a VQSLOD cutoff base on %.2f truth set sensitivity level "
-                "... ..." % opt.truth_sensitivity_level)
+def _scored_records_by_offsets(vcf_infile, data_set):
+    """Stream through the records of ``data_set`` by their offsets in ``vcf_infile``, yield each
+    record with its LOD, worst annotation and training flags, the others are not output.
+    """
+    cdef long long[::1] offsets = data_set.offsets
+    cdef long int j = 0, data_size = len(data_set), offset = 0
+    with Open(vcf_infile, 'r') as I:
+        for line in I:
+            offset += len(line)
+            if j == data_size or offset - len(line) != offsets[j]:
+                continue
+
+            yield (line, data_set.lod[j], data_set.worst_annotation[j], data_set.at_training_site[j],
+                   data_set.at_anti_training_site[j])
+            j += 1  # increase the index of data_set for the next cycle.
+
+
+def _scored_records_by_chunks(vcf_infile, training_set, vr):
+    """Load and score the variants of ``vcf_infile`` chunk by chunk, yield the same as
+    ``_scored_records_by_offsets``.
+    """
+    for data in vdm.load_data_chunks(vcf_infile, training_set, chunk_size=vr.VRAC.EVALUATE_CHUNK_SIZE,
+                                     keep_records=True):
+        vr.evaluate_chunk(data)
+        for j, line in enumerate(data.records):
+            yield (line, data.lod[j], data.worst_annotation[j], data.at_training_site[j],
+                   data.at_anti_training_site[j])
+
+
+def write_vqslod_sidecar(file_name, vqslod, flags):
+    records = np.empty(len(vqslod), dtype=VQSLOD_DTYPE)
+    records["vqslod"] = vqslod
+    records["flag"] = flags
+    with open(file_name, "wb") as OUT:
+        OUT.write(VQSLOD_MAGIC)
+        records.tofile(OUT)
+
+
+def load_training_vqslod(vcf_file):
+    """The VQSLOD of the positive and negative training sites in ``vcf_file``, from the sidecar of
+    VQSR if it's newer than ``vcf_file`` or else by reading ``vcf_file``.
+    """
+    sidecar = vcf_file + VQSLOD_SUFFIX
+    if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(vcf_file):
+        with open(sidecar, "rb") as I:
+            if I.read(len(VQSLOD_MAGIC)) == VQSLOD_MAGIC:
+                logger.info("Loading the VQSLOD of training sites from %s" % sidecar)
+                records = np.fromfile(I, dtype=VQSLOD_DTYPE)
+                return (records["vqslod"][(records["flag"] & POSITIVE_TRAIN_FLAG) > 0].tolist(),
+                        records["vqslod"][(records["flag"] & NEGATIVE_TRAIN_FLAG) > 0].tolist())
+
+        logger.warning("%s is not a VQSLOD sidecar, ignore it." % sidecar)
 
-    cdef int total_variant_num = 0
     truth_set_vqlod = []
     false_set_vqlod = []
-    with Open(opt.vcf_infile, 'r') as I:
+    with Open(vcf_file, 'r') as I:
         for line in I:
             if line.startswith('#'):
                 continue
 
-            total_variant_num += 1
             col = line.strip().split()
 
             # get INFO
@@ -165,6 +227,17 @@ def apply_VQSR(opt):
             if 'NEGATIVE_TRAIN_SITE' in vcf_info:
                 false_set_vqlod.append(float(vcf_info['VQSLOD']))
 
+    return truth_set_vqlod, false_set_vqlod
+
+
+def apply_VQSR(opt):
+    """Apply a score cutoff to filter variants."""
+
+    logger.info("Find a VQSLOD cutoff base on %.2f truth set sensitivity level "
+                "... ..." % opt.truth_sensitivity_level)
+
+    truth_set_vqlod, false_set_vqlod = load_training_vqslod(opt.vcf_infile)
+
     # reverse sorted
     truth_set_vqlod.sort(reverse=True)
     truth_set_num = len(truth_set_vqlod)
@@ -189,34 +262,126 @@ def apply_VQSR(opt):
                 "bad variants. " % (vqlod_cutoff, opt.truth_sensitivity_level, float(false_num) / false_set_num))
 
     logger.info("Outputting to %s ..." % opt.output_vcf_file_name)
-    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True) if opt.output_vcf_file_name.endswith(".gz") else \
-        open(opt.output_vcf_file_name, "w")
+    # The tabix index is built while writing if output is BGZF
+    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True, tabix=True, compress_level=opt.compress_level,
+               threads=opt.write_threads) \
+        if opt.output_vcf_file_name.endswith(".gz") else open(opt.output_vcf_file_name, "w")
 
-    cdef int pass_variant_num = 0
-    with Open(opt.vcf_infile, 'r') as I:
-        for line in I:
-
-            if line.startswith('#'):
-                OUT.write(line.strip() + "\n")
-                continue
-
-            col = line.strip().split()
-
-            qd = re.search(r';?VQSLOD=([^;]+)', col[7])
-            vqslod = float(qd.group(1))
-
-            if vqslod >= vqlod_cutoff:
-                col[6] = "PASS"
-                pass_variant_num += 1
-
-            OUT.write('\t'.join(col) + "\n")
+    cdef long int total_variant_num = 0, pass_variant_num = 0
+    for text, variant_num, pass_num in _filter_vcf(opt.vcf_infile, vqlod_cutoff, opt.nCPU):
+        OUT.write(text)
+        total_variant_num += variant_num
+        pass_variant_num += pass_num
 
     OUT.close()
     logger.info("There are a total of %d variants, %d of which are PASS base on the VQSLOD "
                 "cutoff." % (total_variant_num, pass_variant_num))
 
-    if opt.output_vcf_file_name.endswith(".gz"):
-        # create tabix index
-        tabix_index(opt.output_vcf_file_name, force=True, seq_col=0, start_col=1, end_col=1)
-
     return
+
+
+def _filter_lines(lines, vqlod_cutoff):
+    """Set FILTER to be PASS if VQSLOD >= ``vqlod_cutoff``, return the text of ``lines`` after
+    filtering, the number of variants and PASS variants in them.
+    """
+    out = []
+    cdef long int variant_num = 0, pass_num = 0
+    for line in lines:
+        if line.startswith('#'):
+            out.append(line.strip())
+            continue
+
+        col = line.strip().split()
+        variant_num += 1
+
+        qd = re.search(r';?VQSLOD=([^;]+)', col[7])
+        vqslod = float(qd.group(1))
+
+        if vqslod >= vqlod_cutoff:
+            col[6] = "PASS"
+            pass_num += 1
+
+        out.append('\t'.join(col))
+
+    return ("\n".join(out) + "\n") if out else "", variant_num, pass_num
+
+
+def _filter_chunk(task):
+    """Filter the lines of a chunk of the VCF in a process. The lines which cross the chunks are
+    returned as they are, the head (up to the first newline) and the tail (after the last
+    newline), for the caller to join them with the neighbour chunks.
+    """
+    file_name, start, end, bgzf, vqlod_cutoff, is_first = task
+    data = read_range(file_name, start, end, bgzf)
+
+    cdef long int body_start = 0
+    head = b""
+    if not is_first:
+        body_start = data.find(b"\n") + 1
+        if body_start == 0:
+            # No newline in the chunk, all of it is in the middle of a line
+            return data, "", b"", 0, 0
+        head = data[:body_start]
+
+    cdef long int body_end = data.rfind(b"\n") + 1
+    if body_end <= body_start:
+        return head, "", data[body_start:], 0, 0
+
+    text, variant_num, pass_num = _filter_lines(data[body_start:body_end].splitlines(), vqlod_cutoff)
+    return head, text, data[body_end:], variant_num, pass_num
+
+
+def _filter_vcf(vcf_file, vqlod_cutoff, nproc):
+    """Filter ``vcf_file`` in chunks by ``nproc`` processes if it's BGZF or plain text, yield the text
+    of the chunks in order with the number of variants and PASS variants in each.
+    """
+    if vcf_file.endswith(".gz") and not is_bgzf(vcf_file):
+        # gzip can't be split, filtering it line by line.
+        with Open(vcf_file, 'r') as I:
+            lines = []
+            for line in I:
+                lines.append(line)
+                if len(lines) == 100000:
+                    yield _filter_lines(lines, vqlod_cutoff)
+                    lines = []
+
+            yield _filter_lines(lines, vqlod_cutoff)
+        return
+
+    cdef long int file_size = os.path.getsize(vcf_file)
+    cdef bint bgzf = vcf_file.endswith(".gz")
+    offsets = bgzf_block_offsets(vcf_file) if bgzf else range(0, file_size, APPLY_CHUNK_BYTES)
+
+    # Group the blocks into chunks of about APPLY_CHUNK_BYTES
+    boundaries = [0]
+    for offset in offsets:
+        if offset - boundaries[-1] >= APPLY_CHUNK_BYTES:
+            boundaries.append(offset)
+    boundaries.append(file_size)
+
+    tasks = [(vcf_file, boundaries[i], boundaries[i + 1], bgzf, vqlod_cutoff, i == 0)
+             for i in range(len(boundaries) - 1) if boundaries[i + 1] > boundaries[i]]
+    logger.info("Filtering %d chunks of %s by %d processes." % (len(tasks), vcf_file, nproc))
+
+    pool = multiprocessing.Pool(nproc) if nproc > 1 and len(tasks) > 1 else None
+    try:
+        results = pool.imap(_filter_chunk, tasks) if pool else (_filter_chunk(t) for t in tasks)
+
+        # The line crossing the chunks
+        line = b""
+        for head, text, tail, variant_num, pass_num in results:
+            line += head
+            if line.endswith(b"\n"):
+                yield _filter_lines([line], vqlod_cutoff)
+                line = b""
+
+            yield text, variant_num, pass_num
+            line += tail
+
+        if line:
+            yield _filter_lines([line], vqlod_cutoff)
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
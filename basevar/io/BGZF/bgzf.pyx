@@ -2,12 +2,17 @@
 # cython: profile=True
 # adds doc-strings for sphinx
 import io
+import os
+import struct
+import zlib
 from cpython cimport PyBytes_FromStringAndSize
 
 
 from basevar.io.htslibWrapper cimport BGZF, bgzf_open, bgzf_close, bgzf_write, bgzf_read, \
-    bgzf_index_build_init, bgzf_flush, bgzf_index_dump, bgzf_seek, bgzf_tell, bgzf_getline, \
-    int64_t, kstring_t, free
+    bgzf_index_build_init, bgzf_flush, bgzf_index_dump, bgzf_seek, bgzf_tell, bgzf_getline, bgzf_mt, \
+    int32_t, int64_t, uint8_t, kstring_t, free, hts_idx_t, hts_idx_init, hts_idx_destroy, \
+    hts_idx_finish, hts_idx_save_as, hts_idx_set_meta, HTS_FMT_TBI, HTS_FMT_CSI, TBX_UCSC, bgzf_idx_push, \
+    hts_idx_amend_last
 
 
 from basevar.io.libcutils cimport force_bytes
@@ -19,7 +24,11 @@ DEF SEEK_SET = 0
 DEF SEEK_CUR = 1
 DEF SEEK_END = 2
 
-__all__ = ["BGZFile"]
+# The same as htslib/tbx.h
+DEF TBX_MAX_SHIFT = 31
+
+__all__ = ["BGZFile", "TabixBGZFile", "concat_tabix_indexes", "is_bgzf", "read_bgzf_block", "bgzf_block_offsets",
+           "inflate_bgzf_blocks", "deflate_bgzf_blocks"]
 
 BUFFER_SIZE = io.DEFAULT_BUFFER_SIZE
 
@@ -34,7 +43,7 @@ cdef class BGZFile(object):
     cdef BGZF* bgzf
     cdef readonly object name, index
 
-    def __init__(self, filename, mode=None, index=None):
+    def __init__(self, filename, mode=None, index=None, compress_level=None, int threads=0):
         """Constructor for the BGZFile class.
 
         The mode argument can be any of 'r', 'rb', 'a', 'ab', 'w', 'wb', 'x', or
@@ -42,6 +51,10 @@ cdef class BGZFile(object):
         is the mode of fileobj if discernible; otherwise, the default is 'rb'.
         A mode of 'r' is equivalent to one of 'rb', and similarly for 'w' and
         'wb', 'a' and 'ab', and 'x' and 'xb'.
+
+        ``compress_level`` (0-9) is for writing, None for the default level of htslib.
+        Blocks are compressed by ``threads`` background threads of htslib in writing
+        if ``threads`` > 0, and ``write`` only has to copy the data into the queue of blocks.
         """
         if mode and ('t' in mode or 'U' in mode):
             raise ValueError("Invalid mode: {!r}".format(mode))
@@ -50,6 +63,11 @@ cdef class BGZFile(object):
         elif mode and 'b' not in mode:
             mode += 'b'
 
+        if compress_level is not None and ('w' in mode or 'a' in mode or 'x' in mode):
+            if not 0 <= compress_level <= 9:
+                raise ValueError("Invalid compress level: %r" % compress_level)
+            mode += str(compress_level)
+
         mode = force_bytes(mode)
 
         self.name = encode_filename(filename)
@@ -57,9 +75,16 @@ cdef class BGZFile(object):
 
         self.bgzf = bgzf_open(self.name, mode)
 
+        if self.bgzf == NULL:
+            raise IOError("Could not open %s" % filename)
+
         if self.bgzf.is_write and index is not None and bgzf_index_build_init(self.bgzf) < 0:
             raise IOError('Error building bgzf index')
 
+        # The number of blocks for each thread in the queue is the same as bgzip
+        if self.bgzf.is_write and threads > 0 and bgzf_mt(self.bgzf, threads, 256) < 0:
+            raise IOError('Error setting %d threads for compression' % threads)
+
     def __dealloc__(self):
         self.close()
 
@@ -234,4 +259,442 @@ cdef class BGZFile(object):
         line = self.readline()
         if not line:
             raise StopIteration()
-        return line
\ No newline at end of file
+        return line
+
+
+cdef class TabixBGZFile(BGZFile):
+    """A BGZFile for writing which builds the tabix index while the lines are written and
+    saves it when closed, so we don't have to read the whole file again by ``tabix_index``.
+
+    The arguments are the same as ``tabix_index`` (column indices are 0-based) and the index
+    is exactly the same as the one created by ``tabix_index``, the lines must be sorted.
+
+    The header ends at the end of a BGZF block and the records start from a new one, so that the
+    blocks of records could be concatenated with the index by ``concat_tabix_indexes``.
+
+    The virtual offsets are unknown until the blocks have been compressed by the threads if
+    ``threads`` > 0, the index entries are buffered by ``bgzf_idx_push`` and pushed into the
+    index when their blocks are written, as the multithreaded writers of htslib do.
+    """
+    cdef hts_idx_t *tbx_idx
+    cdef readonly object index_filename
+    cdef int32_t conf[6]   # preset, seq col, beg col, end col (1-based, 0 if missing), meta char, line skip
+    cdef int min_shift, n_lvls, fmt
+    cdef int64_t last_offset
+    cdef long int line_num
+    cdef dict tids
+    cdef list seq_names
+    cdef bytes partial_line  # The last line which has not been ended by '\n'
+    cdef bint in_header
+
+    def __init__(self, filename, mode="wb", seq_col=0, start_col=1, end_col=1, meta_char="#",
+                 int line_skip=0, zerobased=False, int min_shift=-1, index=None, csi=False,
+                 compress_level=None, int threads=0):
+
+        if mode and 'w' not in mode:
+            raise ValueError("TabixBGZFile is only for writing: %r" % mode)
+
+        BGZFile.__init__(self, filename, mode, compress_level=compress_level, threads=threads)
+
+        self.tbx_idx = NULL
+        self.index_filename = encode_filename(index or (filename + (".csi" if csi else ".tbi")))
+
+        self.conf[0] = TBX_UCSC if zerobased else 0
+        self.conf[1] = seq_col + 1
+        self.conf[2] = start_col + 1
+        self.conf[3] = (end_col if end_col is not None else -1) + 1
+        self.conf[4] = ord(meta_char)
+        self.conf[5] = line_skip
+
+        # The same as ``tbx_index`` in htslib
+        if min_shift > 0:
+            self.min_shift = min_shift
+            self.n_lvls = (TBX_MAX_SHIFT - min_shift + 2) / 3
+            self.fmt = HTS_FMT_CSI
+        else:
+            self.min_shift = 14
+            self.n_lvls = 5
+            self.fmt = HTS_FMT_TBI
+
+        self.last_offset = 0
+        self.line_num = 0
+        self.tids = {}
+        self.seq_names = []
+        self.partial_line = b""
+        self.in_header = True
+
+    def __dealloc__(self):
+        # Close here rather than in ``BGZFile.__dealloc__``, which is called after the index is gone.
+        if self.bgzf != NULL:
+            self.close()
+
+        if self.tbx_idx != NULL:
+            hts_idx_destroy(self.tbx_idx)
+            self.tbx_idx = NULL
+
+    cdef int _write(self, const char *data, size_t length) except -1:
+        if length > 0 and bgzf_write(self.bgzf, data, length) < 0:
+            raise IOError('BGZFile write failed')
+        return 0
+
+    cdef int _start_line(self, char c) except -1:
+        """Start the records from a new block before writing the first one, ``c`` is the first
+        character of the next line."""
+        if self.in_header and self.line_num >= self.conf[5] and c != self.conf[4]:
+            if bgzf_flush(self.bgzf) < 0:
+                raise IOError('Error flushing BGZFile object')
+
+            self.last_offset = bgzf_tell(self.bgzf)
+            self.in_header = False
+
+        return 0
+
+    cdef int _push(self, bytes line) except -1:
+        """Add a line which has been written into the index, the same as ``tbx_index``."""
+        self.line_num += 1
+        cdef const char *s = line
+        if self.line_num <= self.conf[5] or s[0] == self.conf[4]:
+            self.last_offset = bgzf_tell(self.bgzf)
+            return 0
+
+        if self.tbx_idx == NULL:
+            self.tbx_idx = hts_idx_init(0, self.fmt, self.last_offset, self.min_shift, self.n_lvls)
+            if self.tbx_idx == NULL:
+                raise MemoryError("Could not allocate memory for tabix index of %s" % self.name)
+
+        cdef list cols = line.split(b"\t")
+        cdef int sc = self.conf[1], bc = self.conf[2], ec = self.conf[3]
+        cdef bint is_generic = (self.conf[0] & 0xffff) == 0
+        cdef long int beg = -1, end = -1
+        try:
+            # Columns are parsed from left to right as ``tbx_parse1``
+            if is_generic and 0 < ec < bc:
+                end = int(cols[ec - 1])
+
+            beg = int(cols[bc - 1])
+            if bc <= ec:
+                end = beg
+
+            if not (self.conf[0] & TBX_UCSC):
+                beg -= 1
+            elif bc <= ec:
+                end += 1
+
+            if beg < 0:
+                beg = 0
+            if end < 1:
+                end = 1
+
+            if is_generic and ec > bc:
+                end = int(cols[ec - 1])
+
+            name = cols[sc - 1]
+        except (IndexError, ValueError):
+            raise ValueError("Failed to parse line %d of %s for tabix index: %s" % (self.line_num, self.name, line))
+
+        tid = self.tids.get(name)
+        if tid is None:
+            tid = len(self.seq_names)
+            self.tids[name] = tid
+            self.seq_names.append(name)
+
+        if end < beg:
+            end = beg + 1
+
+        if bgzf_idx_push(self.bgzf, self.tbx_idx, tid, beg, end, bgzf_tell(self.bgzf), 1) < 0:
+            raise ValueError("The lines of %s are not sorted, failed to build tabix index at line %d: %s" % (
+                self.name, self.line_num, line))
+
+        return 0
+
+    def write(self, data):
+        if not self.bgzf:
+            raise ValueError("write() on closed BGZFile object")
+
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        cdef const char *s = data
+        cdef long int length = len(data)
+        cdef long int start = 0, end
+        while start < length:
+            if not self.partial_line:
+                self._start_line(s[start])
+
+            end = data.find(b"\n", start)
+            if end < 0:
+                self._write(s + start, length - start)
+                self.partial_line += data[start:]
+                break
+
+            # Write line by line, the virtual offset after each line goes to the index
+            self._write(s + start, end + 1 - start)
+            if self.partial_line:
+                self._push(self.partial_line + data[start:end])
+                self.partial_line = b""
+            else:
+                self._push(data[start:end])
+
+            start = end + 1
+
+        return length
+
+    def close(self):
+        if not self.bgzf:
+            return
+
+        # Push the last line before flushing, its block must be written after it
+        if self.partial_line:
+            self._push(self.partial_line)
+            self.partial_line = b""
+
+        # All the blocks are written and the buffered index entries are pushed by the threads
+        if bgzf_flush(self.bgzf) < 0:
+            raise IOError('Error flushing BGZFile object %s, or its lines are not sorted for '
+                          'the tabix index' % self.name)
+
+        if self.tbx_idx == NULL:  # No record
+            self.tbx_idx = hts_idx_init(0, self.fmt, bgzf_tell(self.bgzf), self.min_shift, self.n_lvls)
+            if self.tbx_idx == NULL:
+                raise MemoryError("Could not allocate memory for tabix index of %s" % self.name)
+
+        # The same as ``sam_idx_save`` of htslib
+        hts_idx_amend_last(self.tbx_idx, bgzf_tell(self.bgzf))
+        hts_idx_finish(self.tbx_idx, bgzf_tell(self.bgzf))
+
+        # Meta data of tabix: tbx_conf_t, l_nm and the '\0' ended sequence names, as ``tbx_set_meta``
+        names = b"".join([n + b"\0" for n in self.seq_names])
+        cdef bytes meta = struct.pack("<7i", self.conf[0], self.conf[1], self.conf[2], self.conf[3],
+                                      self.conf[4], self.conf[5], len(names)) + names
+        hts_idx_set_meta(self.tbx_idx, len(meta), <uint8_t*> (<char*> meta), 1)
+
+        BGZFile.close(self)
+
+        cdef int ret = hts_idx_save_as(self.tbx_idx, self.name, self.index_filename, self.fmt)
+        hts_idx_destroy(self.tbx_idx)
+        self.tbx_idx = NULL
+        if ret < 0:
+            raise IOError("Could not save tabix index %s" % self.index_filename)
+
+        return
+
+
+# gzip magic, deflate, FEXTRA, then XLEN = 6 and the "BC" subfield of BSIZE at 12 of the header
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_HEADER_SIZE = 18
+BGZF_EMPTY_BLOCK_SIZE = 28
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03" \
+           b"\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+BGZF_BLOCK_DATA_SIZE = 0xff00  # The same as htslib, keep the compressed block < 64KB
+
+
+def _bgzf_block_size(header):
+    """The size of the BGZF block by its header, 0 if it's not a BGZF header."""
+    if (len(header) != BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC or header[10:12] != b"\x06\x00" or
+            header[12:16] != b"BC\x02\x00"):
+        return 0
+
+    return struct.unpack("<H", header[16:18])[0] + 1  # BSIZE is the block size - 1
+
+
+def is_bgzf(file_name):
+    """The file is compressed in BGZF."""
+    with open(file_name, "rb") as I:
+        return _bgzf_block_size(I.read(BGZF_HEADER_SIZE)) > 0
+
+
+def read_bgzf_block(fh, skip=False):
+    """Read the next BGZF block from ``fh``, return (block size, raw block or None if ``skip``).
+    Return (0, None) at the end of file and raise ValueError if it's not a BGZF block.
+    """
+    header = fh.read(BGZF_HEADER_SIZE)
+    if not header:
+        return 0, None
+
+    cdef long int size = _bgzf_block_size(header)
+    if size == 0:
+        raise ValueError("Not a BGZF block at offset %d of %s" % (fh.tell() - len(header), fh.name))
+
+    if skip:
+        fh.seek(size - BGZF_HEADER_SIZE, os.SEEK_CUR)
+        return size, None
+
+    return size, header + fh.read(size - BGZF_HEADER_SIZE)
+
+
+def bgzf_block_offsets(file_name):
+    """The offsets of all the BGZF blocks in ``file_name`` by their headers, without decompression."""
+    offsets = []
+    cdef long int offset = 0, size
+    with open(file_name, "rb") as I:
+        while True:
+            size, _ = read_bgzf_block(I, skip=True)
+            if size == 0:
+                break
+
+            offsets.append(offset)
+            offset += size
+
+    return offsets
+
+
+def inflate_bgzf_blocks(data):
+    """Decompress ``data`` of whole BGZF blocks."""
+    blocks = []
+    cdef long int offset = 0, size
+    while offset < len(data):
+        size = _bgzf_block_size(data[offset:offset + BGZF_HEADER_SIZE])
+        if size == 0:
+            raise ValueError("Not a BGZF block at offset %d of the data" % offset)
+
+        blocks.append(zlib.decompress(data[offset + BGZF_HEADER_SIZE:offset + size - 8], -15))
+        offset += size
+
+    return b"".join(blocks)
+
+
+def deflate_bgzf_blocks(data, level=-1):
+    """Compress ``data`` into BGZF blocks."""
+    blocks = []
+    cdef long int i
+    for i in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+        chunk = data[i:i + BGZF_BLOCK_DATA_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(chunk) + compressor.flush()
+        blocks.append(b"".join([BGZF_MAGIC, b"\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00",
+                                struct.pack("<H", len(cdata) + 25), cdata,
+                                struct.pack("<II", zlib.crc32(chunk) & 0xffffffff, len(chunk))]))
+
+    return b"".join(blocks)
+
+
+TBI_MAGIC = b"TBI\x01"
+TBI_META_BIN = 37450  # ``META_BIN`` of htslib for the 5 levels of TBI, the chunks are offsets and counts
+
+
+def _load_tbi(index_file):
+    """Load a TBI index into (conf: the 6 int32 of ``tbx_conf_t``, sequence names, bins: a dict of
+    {bin: [[beg, end], ...]} and the linear index for each sequence, number of unplaced records)."""
+    with BGZFile(index_file, "rb") as I:
+        data = I.read()
+
+    if data[:4] != TBI_MAGIC:
+        raise ValueError("%s is not a TBI index" % index_file)
+
+    cdef int n_ref = struct.unpack_from("<i", data, 4)[0]
+    conf = struct.unpack_from("<6i", data, 8)
+    cdef long int l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36:36 + l_nm].split(b"\0")[:n_ref]
+
+    cdef long int p = 36 + l_nm
+    cdef int i, j, n_bin, n_chunk, n_intv
+    bins, ioffs = [], []
+    for i in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, p)[0]
+        p += 4
+
+        ref_bins = {}
+        for j in range(n_bin):
+            b, n_chunk = struct.unpack_from("<Ii", data, p)
+            chunks = struct.unpack_from("<%dQ" % (2 * n_chunk), data, p + 8)
+            ref_bins[b] = [list(chunks[k:k + 2]) for k in range(0, 2 * n_chunk, 2)]
+            p += 8 + 16 * n_chunk
+
+        n_intv = struct.unpack_from("<i", data, p)[0]
+        ioffs.append(list(struct.unpack_from("<%dQ" % n_intv, data, p + 4)))
+        bins.append(ref_bins)
+        p += 4 + 8 * n_intv
+
+    n_no_coor = struct.unpack_from("<Q", data, p)[0] if len(data) >= p + 8 else None
+    return conf, names, bins, ioffs, n_no_coor
+
+
+def concat_tabix_indexes(index_files, shifts, out_index):
+    """Merge the TBI indexes of BGZF files which have been concatenated into one file, so the
+    concatenated file doesn't have to be read again by ``tabix_index``.
+
+    ``shifts`` are the number of bytes that the BGZF blocks of each file have been moved by in the
+    concatenated file, the virtual offsets in the index of each file are shifted by it. The files
+    must be in order and not overlap with each other as ``concat_bgzf_files`` requires.
+    """
+    conf, names, bins, ioffs = None, [], [], []
+    n_no_coor = None
+    for index_file, shift in zip(index_files, shifts):
+        sub_conf, sub_names, sub_bins, sub_ioffs, sub_n_no_coor = _load_tbi(index_file)
+        if conf is None:
+            conf = sub_conf
+        elif conf != sub_conf:
+            raise ValueError("%s is not the same type of tabix index as %s" % (index_file, index_files[0]))
+
+        if sub_n_no_coor is not None:
+            n_no_coor = (n_no_coor or 0) + sub_n_no_coor
+
+        shift <<= 16
+        for name, ref_bins, ref_ioffs in zip(sub_names, sub_bins, sub_ioffs):
+            for b, chunks in ref_bins.items():
+                if b == TBI_META_BIN:  # [[off_beg, off_end], [n_mapped, n_unmapped]]
+                    chunks[0] = [chunks[0][0] + shift, chunks[0][1] + shift]
+                else:
+                    ref_bins[b] = [[beg + shift, end + shift] for beg, end in chunks]
+
+            ref_ioffs = [off + shift for off in ref_ioffs]
+            if not names or names[-1] != name:
+                if name in names:
+                    raise ValueError("%s is not in order with the indexes before it" % index_file)
+
+                names.append(name)
+                bins.append(ref_bins)
+                ioffs.append(ref_ioffs)
+                continue
+
+            # The sequence is continued from the last file
+            for b, chunks in ref_bins.items():
+                if b not in bins[-1]:
+                    bins[-1][b] = chunks
+                elif b == TBI_META_BIN:
+                    meta = bins[-1][b]
+                    meta[0][1] = chunks[0][1]
+                    meta[1] = [meta[1][0] + chunks[1][0], meta[1][1] + chunks[1][1]]
+                else:
+                    bins[-1][b].extend(chunks)
+
+            # The windows covered by the last file have their smaller offsets already
+            ioffs[-1].extend(ref_ioffs[len(ioffs[-1]):])
+
+    if conf is None:
+        raise ValueError("No tabix index to merge")
+
+    names_data = b"".join([n + b"\0" for n in names])
+    data = [TBI_MAGIC, struct.pack("<i6ii", len(names), *(conf + (len(names_data),))), names_data]
+    for ref_bins, ref_ioffs in zip(bins, ioffs):
+        data.append(struct.pack("<i", len(ref_bins)))
+        for b in sorted(ref_bins):
+            chunks = ref_bins[b]
+            if b != TBI_META_BIN:
+                chunks = _merge_chunks(chunks)
+
+            data.append(struct.pack("<Ii", b, len(chunks)))
+            data.append(struct.pack("<%dQ" % (2 * len(chunks)), *[x for c in chunks for x in c]))
+
+        data.append(struct.pack("<i%dQ" % len(ref_ioffs), len(ref_ioffs), *ref_ioffs))
+
+    if n_no_coor is not None:
+        data.append(struct.pack("<Q", n_no_coor))
+
+    with BGZFile(out_index, "wb") as OUT:
+        OUT.write(b"".join(data))
+
+    return
+
+
+def _merge_chunks(chunks):
+    """Merge the chunks which end in the block where the next one starts, as ``hts_idx_finish``."""
+    chunks = sorted(chunks)
+    merged = [chunks[0]]
+    for beg, end in chunks[1:]:
+        if merged[-1][1] >> 16 >= beg >> 16:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([beg, end])
+
+    return merged
@@ -6,9 +6,22 @@ Date: 2019-06-03 00:28:50
 from basevar.io.htslibWrapper cimport Samfile
 from basevar.caller.batch cimport BatchGenerator
 
+cdef class AlignmentReaderPool:
+    cdef int max_open
+    cdef object readers  # filename => opened Samfile, from least to most recently used
+    cdef public long int hit_num
+    cdef public long int miss_num
+    cdef public long int evict_num
+
+    cdef Samfile get(self, basestring filename)
+    cdef void close(self)
+    cdef basestring stats(self)
+
 cdef list get_sample_names(list bamfiles, bint filename_has_samplename)
+cdef list get_window_weights(list align_files, list windows, int max_file_num=*)
+cdef list merge_regions(list regions, long int max_gap)
 cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start, long int end,
-                       char* refseq, options)
+                       char* refseq, options, AlignmentReaderPool reader_pool=*)
 cdef bint load_data_from_bamfile(Samfile bam_reader,
                                  bytes sample_id,
                                  bytes chrom,
@@ -17,3 +30,10 @@ cdef bint load_data_from_bamfile(Samfile bam_reader,
                                  BatchGenerator sample_batch_buffers,
                                  int sample_index,
                                  options)
+cdef bint load_data_from_bamfile_in_regions(Samfile bam_reader,
+                                            bytes sample_id,
+                                            bytes chrom,
+                                            list regions,  # [[start, end], ...] 1-base
+                                            list sample_batch_buffers,
+                                            int sample_index,
+                                            options)
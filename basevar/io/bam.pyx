@@ -3,17 +3,69 @@
 """
 import os
 import sys
+from collections import OrderedDict
 
 from basevar.log import logger
 from basevar.utils cimport c_max
 from basevar.io.read cimport BamReadBuffer
 from basevar.io.htslibWrapper cimport Samfile, ReadIterator, cAlignedRead
+from basevar.io.htslibWrapper cimport hts_itr_t, sam_itr_queryi, hts_itr_destroy, bam_name2id
 from basevar.caller.batch cimport BatchGenerator
 
 cdef bint is_indexable(filename):
     return filename.lower().endswith((".bam", ".cram"))
 
 
+cdef class AlignmentReaderPool:
+    """Keep at most ``max_open`` alignment files opened (together with their index), so that
+    the same file could be reused by regions one after another without re-opening it and
+    re-loading the index. The least recently used one will be closed when the pool is full.
+    """
+    def __cinit__(self, int max_open=512):
+        self.max_open = max(1, max_open)
+        self.readers = OrderedDict()
+
+        self.hit_num = 0
+        self.miss_num = 0
+        self.evict_num = 0
+
+    cdef Samfile get(self, basestring filename):
+        """Return an opened Samfile with index of ``filename``."""
+        cdef Samfile reader = self.readers.pop(filename, None)
+        if reader is not None:
+            # move to the end, which is the most recently used one.
+            self.readers[filename] = reader
+            self.hit_num += 1
+            return reader
+
+        self.miss_num += 1
+        while len(self.readers) >= self.max_open:
+            _, reader = self.readers.popitem(last=False)
+            reader.close()
+            self.evict_num += 1
+
+        reader = Samfile(filename)
+        reader.open("r", True)
+        self.readers[filename] = reader
+
+        return reader
+
+    cdef void close(self):
+        """Close all the opened files."""
+        cdef Samfile reader
+        for reader in self.readers.values():
+            reader.close()
+
+        self.readers.clear()
+        return
+
+    cdef basestring stats(self):
+        cdef long int total = self.hit_num + self.miss_num
+        return "%d hits, %d misses (hit rate %.2f%%), %d evictions with at most %d opened files" % (
+            self.hit_num, self.miss_num, 100.0 * self.hit_num / total if total else 0.0,
+            self.evict_num, self.max_open)
+
+
 cdef list get_sample_names(list bamfiles, bint filename_has_samplename):
     """Getting sample name in BAM/CRMA files from RG tag and return."""
 
@@ -74,8 +126,99 @@ cdef list get_sample_names(list bamfiles, bint filename_has_samplename):
     logger.info("Finish loading all %d samples' names\n" % file_num)
     return sample_names
 
+cdef long int _indexed_bytes(Samfile reader, bytes chrom, long int start, long int end):
+    """Return the compressed bytes of ``reader`` in ``chrom:start-end`` (1-base) according to the
+    chunks of its BAM index, or -1 if the chromosome is not in the file.
+    """
+    cdef int tid = bam_name2id(reader.the_header, chrom)
+    if tid < 0:
+        return -1
+
+    cdef hts_itr_t *itr = sam_itr_queryi(reader.index, tid, start - 1, end)
+    if itr == NULL:
+        return -1
+
+    # The high 48 bits of a virtual offset is the offset of the BGZF block in the file
+    cdef long int size = 0
+    cdef int i
+    for i in range(itr.n_off):
+        size += (itr.off[i].v >> 16) - (itr.off[i].u >> 16)
+
+    hts_itr_destroy(itr)
+    return size
+
+
+cdef list get_window_weights(list align_files, list windows, int max_file_num=16):
+    """Estimate the amount of reads in each window ([[chrom, start, end], ...] 1-base) by the
+    BAM index of at most ``max_file_num`` evenly sampled files, which is the sum of compressed
+    bytes of the index chunks overlapping the window. Return the length of each window instead if
+    none of the files is an indexed BAM (e.g. CRAM, whose index does not record BGZF offsets).
+    """
+    cdef list weights = [sum([e - s + 1 for _, s, e in w]) for w in windows]
+
+    cdef list bamfiles = [f for f in align_files if f.lower().endswith(".bam")]
+    if not bamfiles:
+        return weights
+
+    cdef int step = max(1, len(bamfiles) // max_file_num)
+    cdef list index_weights = [0] * len(windows)
+    cdef Samfile reader
+    cdef long int size
+    cdef int i
+    cdef bint is_indexed = False
+    for f in bamfiles[::step][:max_file_num]:
+        reader = Samfile(f)
+        reader.open("r", True)
+        if not reader._has_index():
+            reader.close()
+            continue
+
+        is_indexed = True
+        for i, w in enumerate(windows):
+            for chrom, start, end in w:
+                size = _indexed_bytes(reader, chrom, start, end)
+                if size > 0:
+                    index_weights[i] += size
+
+        reader.close()
+
+    if not is_indexed:
+        logger.warning("No BAM index could be used to weight the windows, weight them by length.")
+        return weights
+
+    return index_weights
+
+
+cdef list merge_regions(list regions, long int max_gap):
+    """Merge the neighbouring ``regions`` ([[chrom, start, end], ...], sorted by position) which are
+    on the same chromosome and not further than ``max_gap`` from each other, so that they could be
+    loaded by one fetch.
+
+    Return [[chrom, start, end, [index of regions]], ...]
+    """
+    cdef list merged = []
+    cdef list last = None
+    cdef long int start, end
+    cdef int i
+    for i, (chrom, start, end) in enumerate(regions):
+        if (last is not None and last[0] == chrom and
+                last[1] - max_gap - 1 <= end and start <= last[2] + max_gap + 1):
+            if start < last[1]:
+                last[1] = start
+
+            if end > last[2]:
+                last[2] = end
+
+            last[3].append(i)
+        else:
+            last = [chrom, start, end, [i]]
+            merged.append(last)
+
+    return merged
+
+
 cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start, long int end,
-                       char* refseq, options):
+                       char* refseq, options, AlignmentReaderPool reader_pool=None):
     """
     Take a list of BAM files, and a genomic region, and reuturn a list of buffers, containing the
     reads for each BAM file in that region.
@@ -89,6 +232,9 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
     
     This function could just work for unique sample with only one BAM file. You should merge your 
     bamfiles first if there are multiple BAM files for one sample.
+
+    Files are got from ``reader_pool`` and kept opened if it's provided, otherwise they will be
+    opened and closed here.
     """
 
     cdef Samfile reader
@@ -105,13 +251,18 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
 
     cdef list population_read_buffers = []
 
-    region = "%s:%s-%s" % (chrom, start, end)
+    # ``start`` and ``end`` are 0-base, fetch from ``r_len`` bases ahead as
+    # ``load_data_from_bamfile_in_regions`` does.
+    region = "%s:%s-%s" % (chrom, c_max(0, start-options.r_len)+1, end+1)
     cdef int i
     for i in range(sample_num):
         # assuming the sample is already unique in ``samples``
 
-        reader = Samfile(bamfiles[samples[i]])
-        reader.open("r", True)
+        if reader_pool is not None:
+            reader = reader_pool.get(bamfiles[samples[i]])
+        else:
+            reader = Samfile(bamfiles[samples[i]])
+            reader.open("r", True)
 
         # set initial size for BamReadBuffer
         sample_read_buffer = BamReadBuffer(chrom, start, end, options)
@@ -129,7 +280,7 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
 
         while reader_iter.cnext():
 
-            the_read = reader_iter.get(0, NULL)
+            the_read = reader_iter.get(0, NULL, sample_read_buffer.arena)
             # if is_compress_read:
             #     compress_read(the_read, refseq, start, end, qual_bin_size)
 
@@ -145,7 +296,8 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
 
             # Todo: we skip all the broken mate reads here, it's that necessary or we should keep them for assembler?
 
-        reader.close()
+        if reader_pool is None:
+            reader.close()
 
         # ``population_read_buffers`` will keep the same order as ``samples``,
         # which means will keep the same order as input.
@@ -166,22 +318,41 @@ cdef bint load_data_from_bamfile(Samfile bam_reader,
     This function could just work for unique sample with only one BAM file. You should merge your 
     bamfiles first if there are multiple BAM files for one sample.
     """
-    # sample_index is a index label
-    if sample_index >= sample_batch_buffers.sample_size:
-        logger.error("Index overflow! Index (%d) is lager or equal to sample_size(%d)" % (
-            sample_index, sample_batch_buffers.sample_size))
-        sys.exit(1)
+    return load_data_from_bamfile_in_regions(bam_reader, sample_id, chrom, [[start, end]],
+                                             [sample_batch_buffers], sample_index, options)
+
+cdef bint load_data_from_bamfile_in_regions(Samfile bam_reader,
+                                            bytes sample_id,
+                                            bytes chrom,
+                                            list regions,  # [[start, end], ...] 1-base
+                                            list sample_batch_buffers,
+                                            int sample_index,
+                                            options):
+    """Load reads of one sample in all the ``regions`` by one fetch which covers all of them and create batch in each region for the ``BatchGenerator`` of the same index
+    in ``sample_batch_buffers``. The gap between regions should be small, or we'll buffer a lot
+    of reads which are useless.
+    """
+    cdef BatchGenerator batch_buffer
+    for batch_buffer in sample_batch_buffers:
+        # sample_index is a index label
+        if sample_index >= batch_buffer.sample_size:
+            logger.error("Index overflow! Index (%d) is lager or equal to sample_size(%d)" % (
+                sample_index, batch_buffer.sample_size))
+            sys.exit(1)
 
-    cdef Samfile reader
     cdef ReadIterator reader_iter
     cdef cAlignedRead *the_read
 
     cdef int total_reads = 0
     cdef BamReadBuffer sample_read_buffer
 
-    cdef long int r_start = c_max(0, start-1)  # make 0-base
-    cdef long int r_end = c_max(0, end-1)      # make 0-base
-    cdef basestring region = "%s:%s-%s" % (chrom, r_start, r_end)
+    cdef long int start = min([s for s, _ in regions])
+    cdef long int end = max([e for _, e in regions])
+    # Fetch ``r_len`` bases ahead of ``start``, so that the duplicate and overlapping checks of
+    # the first reads in a window see the same preceding read as a run without windows.
+    cdef long int r_start = c_max(0, start-1-options.r_len)  # make 0-base
+    cdef long int r_end = c_max(0, end-1)                    # make 0-base
+    cdef basestring region = "%s:%s-%s" % (chrom, r_start+1, r_end+1)  # 1-base for fetch
 
     # set initial size for BamReadBuffer
     sample_read_buffer = BamReadBuffer(chrom, r_start, r_end, options)
@@ -198,21 +369,26 @@ cdef bint load_data_from_bamfile(Samfile bam_reader,
 
     while reader_iter.cnext():
         # loading data for one sample in target region
-        the_read = reader_iter.get(0, NULL)
+        the_read = reader_iter.get(0, NULL, sample_read_buffer.arena)
         sample_read_buffer.add_read_to_buffer(the_read)
         total_reads += 1
 
     is_empty = False
-    # get batch information for each sample in [start, end]
-    sample_batch_buffers.create_batch_in_region(
-        (chrom, start, end),
-        sample_read_buffer.reads.array,  # this start pointer will move automatically
-        sample_read_buffer.reads.array + sample_read_buffer.reads.get_size(),
-        sample_index  # ``sample_index`` is sample_index of ``BatchGenerator``
-    )
+    cdef int k
+    for k in range(len(regions)):
+        start, end = regions[k]
+        batch_buffer = sample_batch_buffers[k]
+
+        # get batch information for each sample in [start, end], reads before ``start``
+        # will be skipped by ``create_batch_in_region``
+        batch_buffer.create_batch_in_region(
+            (chrom, start, end),
+            sample_read_buffer.reads.array,
+            sample_read_buffer.reads.array + sample_read_buffer.reads.get_size(),
+            sample_index  # ``sample_index`` is sample_index of ``BatchGenerator``
+        )
 
     if options.verbosity > 1:
         logger.info("We get %d good reads for %s from %s" % (total_reads, region, bam_reader.filename))
 
     return is_empty
-
@@ -0,0 +1,42 @@
+"""Header for binary columnar batchfile
+"""
+from libc.stdint cimport int32_t, int64_t, uint8_t
+
+from basevar.io.htslibWrapper cimport BGZF
+from basevar.caller.batch cimport BatchInfo
+
+
+cdef class BatchFileWriter:
+    cdef BGZF *bgzf
+    cdef readonly bytes filename
+    cdef readonly bytes chrom
+    cdef readonly int sample_num
+
+    cdef uint8_t *columns    # 8 * sample_num bytes for the columns of one record
+    cdef bint is_index
+    cdef list index          # [(position, virtual offset), ...] of every INDEX_INTERVAL records
+    cdef long int record_num
+
+    cdef int _write(self, const void *data, size_t size) except -1
+    cdef int write(self, BatchInfo batchinfo) except -1
+    cdef int write_raw(self, int32_t position, char ref_base, int32_t depth, const uint8_t *columns,
+                       const char *extra, int32_t l_extra) except -1
+
+
+cdef class BatchFileReader:
+    cdef BGZF *bgzf
+    cdef readonly bytes filename
+    cdef readonly bytes chrom
+    cdef readonly list sample_ids
+    cdef readonly int sample_num
+
+    # The current record
+    cdef readonly long int position
+    cdef readonly bytes ref_base
+    cdef readonly int depth
+    cdef uint8_t *columns    # 8 * sample_num bytes, only valid if depth > 0
+    cdef readonly bytes extra  # Other bases (e.g. indels) of the current record, '\0' terminated one by one
+
+    cdef int _read(self, void *data, size_t size) except -1
+    cdef bint read_record(self) except -1
+    cdef int fill(self, BatchInfo batchinfo, int offset) except -1
@@ -0,0 +1,510 @@
+# cython: profile=True
+"""Binary columnar batchfile (BaseVarBatchFile_v2.0)
+
+A batchfile keeps the bases of a batch of samples in a list of positions on one chromosome.
+The whole file is BGZF compressed, all the integers are in the byte order of the machine:
+
+    magic          char[4]   "BVB\\2"
+    sample_num     int32
+    l_sample_ids   int32     then sample ids joined by ","
+    l_chrom        int32     then the chromosome name
+
+    and one record for each position:
+
+    position       int32     1-base
+    ref_base       char
+    depth          int32
+    # columns, only if depth > 0
+    mapq           uint8[sample_num]
+    base_code      uint8[sample_num]  0-4 for A, C, G, T, N and 5 for the other bases in ``extra``
+    base_qual      uint8[sample_num]
+    read_pos_rank  int32[sample_num]
+    strand         char[sample_num]
+    l_extra        int32     then the other bases (e.g. indels) '\\0' terminated, in the order of samples
+
+The position index is in ``filename + INDEX_SUFFIX``, it records the virtual offset of every
+``INDEX_INTERVAL`` records:
+
+    magic          char[4]   "BVI\\2"
+    interval       int32
+    (position int32, virtual offset int64) ...
+"""
+import os
+import struct
+
+from cpython cimport PyBytes_FromStringAndSize
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy, memset, strlen
+
+from basevar.log import logger
+from basevar.io.htslibWrapper cimport bgzf_open, bgzf_close, bgzf_write, bgzf_read, bgzf_tell, \
+    bgzf_seek, bgzf_flush
+
+
+BATCHFILE_SUFFIX = ".bvb"
+INDEX_SUFFIX = ".bvi"
+
+cdef bytes MAGIC = b"BVB\2"
+cdef bytes INDEX_MAGIC = b"BVI\2"
+cdef int INDEX_INTERVAL = 1024
+
+# Bytes of the columns per sample: mapq, base_code, base_qual, read_pos_rank and strand
+cdef int COLUMN_BYTES = 8
+
+DEF EXTRA_BASE_CODE = 5
+cdef char *CODE_BASES[5]
+CODE_BASES[0] = "A"
+CODE_BASES[1] = "C"
+CODE_BASES[2] = "G"
+CODE_BASES[3] = "T"
+CODE_BASES[4] = "N"
+
+cdef list TEXT_HEADER = ["#CHROM", "POS", "REF", "Depth(CoveredSample)", "MappingQuality", "Readbases",
+                         "ReadbasesQuality", "ReadPositionRank", "Strand"]
+
+
+cdef inline uint8_t _base_code(const char *b):
+    if b[0] == 0 or b[1] != 0:
+        return EXTRA_BASE_CODE
+
+    if b[0] == 'A':
+        return 0
+    elif b[0] == 'C':
+        return 1
+    elif b[0] == 'G':
+        return 2
+    elif b[0] == 'T':
+        return 3
+    elif b[0] == 'N':
+        return 4
+    else:
+        return EXTRA_BASE_CODE
+
+
+cdef inline void _empty_columns(uint8_t *columns, int offset, int n, int total):
+    """Set the columns of the ``n`` samples from ``offset`` to be empty, there are ``total`` samples."""
+    memset(columns + offset, 0, n)                         # mapq
+    memset(columns + total + offset, 4, n)                 # 'N'
+    memset(columns + 2 * total + offset, 0, n)             # base_qual
+    memset(columns + 3 * total + 4 * offset, 0, 4 * n)     # read_pos_rank
+    memset(columns + 7 * total + offset, ord('.'), n)      # strand
+
+
+cdef class BatchFileWriter:
+    """Write ``BatchInfo`` of positions one by one into a binary batchfile."""
+
+    def __cinit__(self, filename, bytes chrom, list sample_ids, bint is_index=True):
+        self.filename = filename
+        self.chrom = chrom
+        self.sample_num = len(sample_ids)
+        self.is_index = is_index
+        self.index = []
+        self.record_num = 0
+
+        self.columns = <uint8_t*> malloc(COLUMN_BYTES * self.sample_num + 1)
+        assert self.columns != NULL, "Could not allocate memory for BatchFileWriter"
+
+        self.bgzf = bgzf_open(self.filename, "wb")
+        if self.bgzf == NULL:
+            raise IOError("Could not open batchfile %s for writing" % filename)
+
+        cdef bytes ids = b",".join(sample_ids)
+        cdef int32_t header[3]
+        self._write(<char*> MAGIC, 4)
+        header[0] = self.sample_num
+        header[1] = len(ids)
+        self._write(header, 2 * sizeof(int32_t))
+        self._write(<char*> ids, len(ids))
+        header[2] = len(chrom)
+        self._write(&header[2], sizeof(int32_t))
+        self._write(<char*> chrom, len(chrom))
+
+    def __dealloc__(self):
+        if self.bgzf != NULL:
+            bgzf_close(self.bgzf)
+            self.bgzf = NULL
+
+        if self.columns != NULL:
+            free(self.columns)
+            self.columns = NULL
+
+    cdef int _write(self, const void *data, size_t size) except -1:
+        if size > 0 and bgzf_write(self.bgzf, data, size) < 0:
+            raise IOError("Error in writing batchfile %s" % self.filename)
+        return 0
+
+    cdef int write(self, BatchInfo batchinfo) except -1:
+        """Write a position, the size of ``batchinfo`` must be the same as ``sample_num``."""
+        if batchinfo.size != self.sample_num:
+            raise ValueError("The size of BatchInfo (%d) is not equal to the sample number (%d) of %s" % (
+                batchinfo.size, self.sample_num, self.filename))
+
+        if batchinfo.depth == 0:
+            return self.write_raw(batchinfo.position, batchinfo.ref_base[0], 0, NULL, NULL, 0)
+
+        cdef int n = self.sample_num
+        cdef int32_t *read_pos_rank = <int32_t*> (self.columns + 3 * n)
+        cdef list extras = []
+        cdef uint8_t code
+        cdef int i
+        for i in range(n):
+            self.columns[i] = <uint8_t> batchinfo.mapqs[i]
+            code = _base_code(batchinfo.sample_bases[i])
+            if code == EXTRA_BASE_CODE:
+                extras.append(<bytes> batchinfo.sample_bases[i])
+
+            self.columns[n + i] = code
+            self.columns[2 * n + i] = <uint8_t> batchinfo.sample_base_quals[i]
+            read_pos_rank[i] = batchinfo.read_pos_rank[i]
+            self.columns[7 * n + i] = batchinfo.strands[i]
+
+        cdef bytes extra = b"\0".join(extras) + b"\0" if extras else b""
+        return self.write_raw(batchinfo.position, batchinfo.ref_base[0], batchinfo.depth, self.columns,
+                              extra, len(extra))
+
+    cdef int write_raw(self, int32_t position, char ref_base, int32_t depth, const uint8_t *columns,
+                       const char *extra, int32_t l_extra) except -1:
+        """Write a record of which ``columns`` and ``extra`` are already in the format of batchfile."""
+        if self.is_index and self.record_num % INDEX_INTERVAL == 0:
+            self.index.append((position, bgzf_tell(self.bgzf)))
+        self.record_num += 1
+
+        self._write(&position, sizeof(int32_t))
+        self._write(&ref_base, 1)
+        self._write(&depth, sizeof(int32_t))
+        if depth > 0:
+            self._write(columns, COLUMN_BYTES * self.sample_num)
+            self._write(&l_extra, sizeof(int32_t))
+            self._write(extra, l_extra)
+
+        return 0
+
+    def close(self):
+        if self.bgzf == NULL:
+            return
+
+        if bgzf_flush(self.bgzf) < 0 or bgzf_close(self.bgzf) < 0:
+            self.bgzf = NULL
+            raise IOError("Error in closing batchfile %s" % self.filename)
+        self.bgzf = NULL
+
+        if self.is_index:
+            with open(self.filename + INDEX_SUFFIX, "wb") as I:
+                I.write(INDEX_MAGIC + struct.pack("=i", INDEX_INTERVAL))
+                for position, offset in self.index:
+                    I.write(struct.pack("=iq", position, offset))
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+cdef class BatchFileReader:
+    """Read a binary batchfile record by record, the columns are copied into ``BatchInfo``
+    directly without any string parsing.
+    """
+    def __cinit__(self, filename):
+        self.filename = filename
+        self.columns = NULL
+        self.position = 0
+        self.ref_base = b"N"
+        self.depth = 0
+        self.extra = b""
+
+        self.bgzf = bgzf_open(self.filename, "rb")
+        if self.bgzf == NULL:
+            raise IOError("Could not open batchfile %s" % filename)
+
+        cdef char magic[4]
+        cdef int32_t size
+        if self._read(magic, 4) == 0 or PyBytes_FromStringAndSize(magic, 4) != MAGIC:
+            raise IOError("%s is not a BaseVar binary batchfile" % filename)
+
+        self._read(&size, sizeof(int32_t))
+        self.sample_num = size
+        self.columns = <uint8_t*> malloc(COLUMN_BYTES * self.sample_num + 1)
+        assert self.columns != NULL, "Could not allocate memory for BatchFileReader"
+
+        self._read(&size, sizeof(int32_t))
+        cdef bytes ids = PyBytes_FromStringAndSize(NULL, size)
+        self._read(<char*> ids, size)
+        self.sample_ids = ids.split(",") if size > 0 else []
+
+        self._read(&size, sizeof(int32_t))
+        self.chrom = PyBytes_FromStringAndSize(NULL, size)
+        self._read(<char*> self.chrom, size)
+
+    def __dealloc__(self):
+        if self.bgzf != NULL:
+            bgzf_close(self.bgzf)
+            self.bgzf = NULL
+
+        if self.columns != NULL:
+            free(self.columns)
+            self.columns = NULL
+
+    cdef int _read(self, void *data, size_t size) except -1:
+        """Return 0 if hit the end of file before reading anything, or 1."""
+        if size == 0:
+            return 1
+
+        cdef ssize_t n = bgzf_read(self.bgzf, data, size)
+        if n == 0:
+            return 0
+
+        if n != <ssize_t> size:
+            raise IOError("Truncated batchfile %s" % self.filename)
+
+        return 1
+
+    cdef bint read_record(self) except -1:
+        """Read the next record, return False if hit the end of file."""
+        cdef int32_t value
+        cdef char ref_base
+        if self._read(&value, sizeof(int32_t)) == 0:
+            return False
+
+        self.position = value
+        self._read(&ref_base, 1)
+        self.ref_base = PyBytes_FromStringAndSize(&ref_base, 1)
+        self._read(&value, sizeof(int32_t))
+        self.depth = value
+
+        self.extra = b""
+        if self.depth > 0:
+            self._read(self.columns, COLUMN_BYTES * self.sample_num)
+            self._read(&value, sizeof(int32_t))
+            if value > 0:
+                self.extra = PyBytes_FromStringAndSize(NULL, value)
+                self._read(<char*> self.extra, value)
+
+        return True
+
+    cdef int fill(self, BatchInfo batchinfo, int offset) except -1:
+        """Copy the current record into ``batchinfo`` from index ``offset``, ``batchinfo.depth`` is
+        not changed. The other bases point to ``self.extra``, keep it until ``batchinfo`` is done.
+        """
+        cdef int n = self.sample_num
+        cdef int i
+        if self.depth == 0:
+            for i in range(offset, offset + n):
+                batchinfo.mapqs[i] = 0
+                batchinfo.sample_bases[i] = "N"
+                batchinfo.sample_base_quals[i] = 0
+                batchinfo.read_pos_rank[i] = 0
+                batchinfo.strands[i] = "."
+            return 0
+
+        cdef int32_t *read_pos_rank = <int32_t*> (self.columns + 3 * n)
+        cdef char *extra = self.extra
+        cdef uint8_t code
+        for i in range(n):
+            batchinfo.mapqs[offset + i] = self.columns[i]
+
+            code = self.columns[n + i]
+            if code == EXTRA_BASE_CODE:
+                batchinfo.sample_bases[offset + i] = extra
+                extra += strlen(extra) + 1
+            else:
+                batchinfo.sample_bases[offset + i] = CODE_BASES[code]
+
+            batchinfo.sample_base_quals[offset + i] = self.columns[2 * n + i]
+            batchinfo.read_pos_rank[offset + i] = read_pos_rank[i]
+            batchinfo.strands[offset + i] = self.columns[7 * n + i]
+
+        return 0
+
+    def seek_position(self, long int position):
+        """Move to the record right before ``position`` by the index, so that the next record
+        read by ``read_record`` is the first one >= ``position``.
+        """
+        cdef int64_t offset = -1
+        cdef int pos
+        cdef int64_t off
+        with open(self.filename + INDEX_SUFFIX, "rb") as I:
+            data = I.read()
+
+        if data[:4] != INDEX_MAGIC:
+            raise IOError("%s is not a BaseVar batchfile index" % (self.filename + INDEX_SUFFIX))
+
+        # data[4:8] is the index interval
+        cdef int k
+        for k in range(8, len(data), 12):
+            pos, off = struct.unpack("=iq", data[k:k+12])
+            if pos > position:
+                break
+            offset = off
+
+        if offset < 0:
+            return
+
+        if bgzf_seek(self.bgzf, offset, 0) < 0:
+            raise IOError("Error in seeking batchfile %s" % self.filename)
+
+        # Skip the records in front of ``position`` within an index interval
+        cdef int64_t last = offset
+        while True:
+            last = bgzf_tell(self.bgzf)
+            if not self.read_record():
+                break
+
+            if self.position >= position:
+                bgzf_seek(self.bgzf, last, 0)
+                break
+
+        return
+
+    def close(self):
+        if self.bgzf != NULL:
+            bgzf_close(self.bgzf)
+            self.bgzf = NULL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+def merge_batchfiles(list in_files, out_file, bint is_del_raw_file=False):
+    """Merge batchfiles of the same positions but different samples by concatenating their columns."""
+    cdef list readers = [BatchFileReader(f) for f in in_files]
+    cdef BatchFileReader reader, first = readers[0]
+
+    cdef list sample_ids = []
+    for reader in readers:
+        if reader.chrom != first.chrom:
+            raise ValueError("Batchfiles are not in the same chromosome: %s and %s" % (
+                first.filename, reader.filename))
+        sample_ids.extend(reader.sample_ids)
+
+    cdef BatchFileWriter writer = BatchFileWriter(out_file, first.chrom, sample_ids)
+    cdef int total = writer.sample_num
+    cdef uint8_t *columns = writer.columns
+    cdef list extras
+    cdef int depth, offset, n, w
+    cdef int widths[5]
+    widths[0], widths[1], widths[2], widths[3], widths[4] = 1, 1, 1, 4, 1
+
+    cdef list has_record
+    while True:
+        has_record = [reader.read_record() for reader in readers]
+        if not all(has_record):
+            if any(has_record):
+                raise ValueError("Batchfiles don't have the same positions: %s" % ", ".join(in_files))
+            break
+
+        depth = 0
+        for reader in readers:
+            if reader.position != first.position or reader.ref_base != first.ref_base:
+                raise ValueError("Position [%s:%d and %d] or ref-base [%s and %s] not match in %s and %s" % (
+                    first.chrom, first.position, reader.position, first.ref_base, reader.ref_base,
+                    first.filename, reader.filename))
+            depth += reader.depth
+
+        if depth == 0:
+            writer.write_raw(first.position, first.ref_base[0], 0, NULL, NULL, 0)
+            continue
+
+        extras = []
+        offset = 0
+        for reader in readers:
+            n = reader.sample_num
+            if reader.depth == 0:
+                _empty_columns(columns, offset, n, total)
+            else:
+                # Each column of this batch goes to [offset, offset + n) of the same column
+                for w in range(5):
+                    memcpy(columns + (w if w < 4 else 7) * total + widths[w] * offset,
+                           reader.columns + (w if w < 4 else 7) * n, widths[w] * n)
+                if reader.extra:
+                    extras.append(reader.extra)
+
+            offset += n
+
+        extra = b"".join(extras)
+        writer.write_raw(first.position, first.ref_base[0], depth, columns, extra, len(extra))
+
+    writer.close()
+    for reader in readers:
+        reader.close()
+
+        if is_del_raw_file:
+            os.remove(reader.filename)
+            if os.path.exists(reader.filename + INDEX_SUFFIX):
+                os.remove(reader.filename + INDEX_SUFFIX)
+
+    return
+
+
+def convert_text_to_batchfile(text_file, out_file):
+    """Convert a text batchfile (BaseVarBatchFile_v1.0) into the binary one."""
+    from basevar.io.openfile import Open
+
+    cdef BatchFileWriter writer = None
+    cdef BatchInfo batchinfo
+    cdef list sample_ids = None
+    cdef list mapqs, bases, quals, ranks, strands
+    cdef int n, i
+    with Open(text_file, "rb") as I:
+        for line in I:
+            if line.startswith("##SampleIDs="):
+                sample_ids = line.strip().split("=", 1)[1].split(",")
+                continue
+            elif line.startswith("#"):
+                continue
+
+            col = line.strip().split()
+            if sample_ids is None:
+                raise ValueError("Missing ##SampleIDs in %s" % text_file)
+
+            n = len(sample_ids)
+            if writer is None:
+                writer = BatchFileWriter(out_file, col[0], sample_ids)
+            elif col[0] != writer.chrom:
+                raise ValueError("More than one chromosome in %s: %s and %s" % (text_file, writer.chrom, col[0]))
+
+            batchinfo = BatchInfo(col[0], position=int(col[1]), ref_base=col[2], size=n)
+            batchinfo.depth = int(col[3])
+            if batchinfo.depth > 0:
+                mapqs, bases, quals, ranks, strands = [c.split(",") for c in col[4:9]]
+                for i in range(n):
+                    batchinfo.mapqs[i] = int(mapqs[i])
+                    batchinfo.sample_bases[i] = bases[i]
+                    batchinfo.sample_base_quals[i] = int(quals[i])
+                    batchinfo.read_pos_rank[i] = int(ranks[i])
+                    batchinfo.strands[i] = (<char *> strands[i])[0]
+
+            writer.write(batchinfo)
+
+    if writer is None:
+        raise ValueError("No position in %s" % text_file)
+
+    writer.close()
+    return
+
+
+def convert_batchfile_to_text(in_file, text_file):
+    """Convert a binary batchfile into the text one (BaseVarBatchFile_v1.0)."""
+    from basevar.io.openfile import Open
+
+    cdef BatchFileReader reader = BatchFileReader(in_file)
+    cdef BatchInfo batchinfo
+    with Open(text_file, "wb", isbgz=True) if text_file.endswith(".gz") else open(text_file, "w") as OUT:
+        OUT.write("##fileformat=BaseVarBatchFile_v1.0\n")
+        OUT.write("##SampleIDs=%s\n" % ",".join(reader.sample_ids))
+        OUT.write("%s\n" % "\t".join(TEXT_HEADER))
+
+        while reader.read_record():
+            batchinfo = BatchInfo(reader.chrom, position=reader.position, ref_base=reader.ref_base,
+                                  size=reader.sample_num)
+            batchinfo.depth = reader.depth
+            reader.fill(batchinfo, 0)
+            OUT.write("%s\n" % batchinfo.get_str())
+
+    reader.close()
+    return
@@ -0,0 +1,27 @@
+"""Header for writing BCF
+"""
+from basevar.io.htslibWrapper cimport htsFile, bcf_hdr_t, bcf1_t, int32_t
+
+
+cdef class BCFWriter:
+    cdef htsFile *fp
+    cdef bcf_hdr_t *hdr
+    cdef bcf1_t *rec
+    cdef readonly bytes filename
+    cdef list header_lines   # The header is written once the "#CHROM" line is got
+    cdef readonly int sample_num
+
+    # FORMAT of the current record, one value for each sample (two for GT), filled by the caller
+    cdef int32_t *gts
+    cdef char *bases
+    cdef char *strands
+    cdef float *probs
+
+    cdef int low_qual_id
+    cdef int32_t *int_values
+    cdef float *float_values
+
+    cdef int _write_header(self) except -1
+    cdef void set_missing_sample(self, int k)
+    cdef int write_variant(self, bytes chrom, long int position, bytes alleles, float qual, bint is_low_qual,
+                           list int_info, list float_info) except -1
@@ -0,0 +1,232 @@
+# cython: profile=True
+"""Writing the VCF of BaseType as BCF by htslib
+
+The header is given in text just like writing a VCF, then the records are set by typed arrays
+(e.g. one genotype, allele base, strand and base probability for each sample) without formatting
+any string for the samples.
+"""
+import os
+import sys
+
+from libc.stdlib cimport malloc, free
+
+from basevar.log import logger
+from basevar.io.htslibWrapper cimport hts_open, hts_close, hts_set_threads, bcf_hdr_init, bcf_hdr_destroy, \
+    bcf_hdr_parse, bcf_hdr_write, bcf_hdr_read, bcf_hdr_nsamples, bcf_hdr_name2id, bcf_hdr_id2int, bcf_init, \
+    bcf_destroy, bcf_clear, bcf_read, bcf_write, bcf_update_alleles_str, bcf_update_filter, bcf_update_info_int32, \
+    bcf_update_info_float, bcf_update_genotypes, bcf_update_format_char, bcf_update_format_float, \
+    bcf_index_build, bcf_gt_missing, bcf_float_set_missing, BCF_DT_ID
+
+# The same as the default of ``bcftools index``
+DEF CSI_MIN_SHIFT = 14
+
+# Values of an INFO field are at most one for each allele
+DEF MAX_INFO_VALUES = 16
+
+
+def _write_mode(compress_level):
+    return "wb" + (str(compress_level) if compress_level is not None else "")
+
+
+cdef class BCFWriter:
+    """Write the records of BaseType into a BCF file."""
+
+    def __cinit__(self, filename, compress_level=None, int threads=0):
+        self.filename = filename
+        self.fp = hts_open(self.filename, _write_mode(compress_level))
+        if self.fp == NULL:
+            raise IOError("Could not open %s for writing." % filename)
+
+        if threads > 0:
+            hts_set_threads(self.fp, threads)
+
+        self.hdr = NULL
+        self.rec = bcf_init()
+        self.header_lines = []
+        self.sample_num = 0
+
+        self.gts = NULL
+        self.bases = NULL
+        self.strands = NULL
+        self.probs = NULL
+
+        self.int_values = <int32_t *> malloc(MAX_INFO_VALUES * sizeof(int32_t))
+        self.float_values = <float *> malloc(MAX_INFO_VALUES * sizeof(float))
+        assert self.int_values != NULL and self.float_values != NULL, "Could not allocate memory for BCFWriter."
+
+    def __dealloc__(self):
+        self.close()
+
+        if self.rec != NULL:
+            bcf_destroy(self.rec)
+            self.rec = NULL
+
+        free(self.int_values)
+        free(self.float_values)
+        self.int_values = NULL
+        self.float_values = NULL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def write(self, text):
+        """Write the header in text, which must be done before any record."""
+        if self.hdr != NULL:
+            raise ValueError("The header of %s has been written, the records must be written by "
+                             "write_variant()." % self.filename)
+
+        self.header_lines.append(text)
+        if "#CHROM\t" in text:
+            self._write_header()
+
+    cdef int _write_header(self) except -1:
+        cdef bytes text = b"".join(self.header_lines)
+        self.hdr = bcf_hdr_init("r")
+        if bcf_hdr_parse(self.hdr, text) < 0:
+            raise ValueError("Could not parse the VCF header for %s." % self.filename)
+
+        if bcf_hdr_write(self.fp, self.hdr) < 0:
+            raise IOError("Could not write the header into %s." % self.filename)
+
+        self.sample_num = bcf_hdr_nsamples(self.hdr)
+        self.low_qual_id = bcf_hdr_id2int(self.hdr, BCF_DT_ID, "LowQual")
+        if self.sample_num > 0:
+            self.gts = <int32_t *> malloc(2 * self.sample_num * sizeof(int32_t))
+            self.bases = <char *> malloc(self.sample_num * sizeof(char))
+            self.strands = <char *> malloc(self.sample_num * sizeof(char))
+            self.probs = <float *> malloc(self.sample_num * sizeof(float))
+            assert self.gts != NULL and self.bases != NULL and self.strands != NULL and self.probs != NULL, \
+                "Could not allocate memory for the samples of BCFWriter."
+
+        self.header_lines = []
+        return 0
+
+    cdef void set_missing_sample(self, int k):
+        """Set the FORMAT of sample ``k`` of the current record as missing, which is "./.:.:.:." in VCF."""
+        self.gts[2 * k] = bcf_gt_missing
+        self.gts[2 * k + 1] = bcf_gt_missing
+        self.bases[k] = b'.'
+        self.strands[k] = b'.'
+        bcf_float_set_missing(self.probs[k])
+        return
+
+    cdef int write_variant(self, bytes chrom, long int position, bytes alleles, float qual, bint is_low_qual,
+                           list int_info, list float_info) except -1:
+        """Write a record, the FORMAT of samples are in ``gts``, ``bases``, ``strands`` and ``probs``
+        which have been filled by the caller.
+
+        ``position`` is 1-base, ``alleles`` is REF and ALT joined by ",", ``int_info`` and
+        ``float_info`` are [(key, [values])] of the INFO fields.
+        """
+        if self.hdr == NULL:
+            raise ValueError("Missing the VCF header of %s." % self.filename)
+
+        bcf_clear(self.rec)
+        self.rec.rid = bcf_hdr_name2id(self.hdr, chrom)
+        if self.rec.rid < 0:
+            raise ValueError("%s is not in the header of %s." % (chrom, self.filename))
+
+        self.rec.pos = position - 1
+        self.rec.qual = qual
+        bcf_update_alleles_str(self.hdr, self.rec, alleles)
+        if is_low_qual:
+            bcf_update_filter(self.hdr, self.rec, &self.low_qual_id, 1)
+
+        cdef bytes key
+        cdef int i, n
+        for key, values in int_info:
+            n = min(len(values), MAX_INFO_VALUES)
+            for i in range(n):
+                self.int_values[i] = values[i]
+            bcf_update_info_int32(self.hdr, self.rec, key, self.int_values, n)
+
+        for key, values in float_info:
+            n = min(len(values), MAX_INFO_VALUES)
+            for i in range(n):
+                self.float_values[i] = values[i]
+            bcf_update_info_float(self.hdr, self.rec, key, self.float_values, n)
+
+        if self.sample_num > 0:
+            bcf_update_genotypes(self.hdr, self.rec, self.gts, 2 * self.sample_num)
+            bcf_update_format_char(self.hdr, self.rec, "AB", self.bases, self.sample_num)
+            bcf_update_format_char(self.hdr, self.rec, "SO", self.strands, self.sample_num)
+            bcf_update_format_float(self.hdr, self.rec, "BP", self.probs, self.sample_num)
+
+        if bcf_write(self.fp, self.hdr, self.rec) < 0:
+            raise IOError("Error while writing %s:%d into %s." % (chrom, position, self.filename))
+
+        return 0
+
+    def close(self):
+        if self.fp != NULL:
+            hts_close(self.fp)
+            self.fp = NULL
+
+        if self.hdr != NULL:
+            bcf_hdr_destroy(self.hdr)
+            self.hdr = NULL
+
+        free(self.gts)
+        free(self.bases)
+        free(self.strands)
+        free(self.probs)
+        self.gts = NULL
+        self.bases = NULL
+        self.strands = NULL
+        self.probs = NULL
+
+
+def merge_bcf_files(temp_file_names, final_file_name, is_del_raw_file=False, compress_level=None, threads=0):
+    """Merge BCF files of the same header one after another into ``final_file_name`` and build
+    its CSI index. The records are copied as they are without decoding them into text.
+    """
+    cdef bcf_hdr_t *hdr = NULL
+    cdef bcf_hdr_t *in_hdr
+    cdef bcf1_t *rec = bcf_init()
+    cdef htsFile *in_fp
+    cdef htsFile *out_fp = hts_open(final_file_name, _write_mode(compress_level))
+    if out_fp == NULL:
+        logger.error("Could not open %s for writing." % final_file_name)
+        sys.exit(1)
+
+    if threads > 0:
+        hts_set_threads(out_fp, threads)
+
+    for file_name in temp_file_names:
+        in_fp = hts_open(file_name, "r")
+        if in_fp == NULL:
+            logger.error("Could not open %s." % file_name)
+            sys.exit(1)
+
+        in_hdr = bcf_hdr_read(in_fp)
+        if in_hdr == NULL:
+            logger.error("Could not read the header of %s." % file_name)
+            sys.exit(1)
+
+        if hdr == NULL:
+            # All the files have the same header
+            hdr = in_hdr
+            bcf_hdr_write(out_fp, hdr)
+
+        while bcf_read(in_fp, in_hdr, rec) >= 0:
+            bcf_write(out_fp, hdr, rec)
+
+        hts_close(in_fp)
+        if in_hdr != hdr:
+            bcf_hdr_destroy(in_hdr)
+
+        if is_del_raw_file:
+            os.remove(file_name)
+
+    bcf_destroy(rec)
+    if hdr != NULL:
+        bcf_hdr_destroy(hdr)
+
+    hts_close(out_fp)
+    if bcf_index_build(final_file_name, CSI_MIN_SHIFT) != 0:
+        logger.warning("Could not build the CSI index of %s." % final_file_name)
+
+    return
@@ -3,6 +3,24 @@
 Author: Shujia Huang
 Date: 2019-05-29
 """
+cdef struct MaskRun:
+    long long start  # [start, end) 0-base in the whole genome, the sequences are joined in the order of .fai
+    long long end
+    long long kind  # 0 for the lowercase of the packed bases, or the char of all the run, e.g. 'N'
+
+
+cdef class SequenceTuple:
+    cdef public bytes seq_name
+    cdef public long int seq_length
+    cdef public long int start_position
+    cdef public long int line_length
+    cdef public long int full_line_length
+
+    # Offsets of the sequence in the 2-bit packed reference
+    cdef public long long genome_offset
+    cdef public long long packed_offset
+
+
 cdef class FastaIndex:
     cdef long int n_targets
     cdef dict references
@@ -15,6 +33,18 @@ cdef class FastaFile:
     cdef object the_file
     cdef FastaIndex the_index
 
+    # "seek" (read the file for each query), "mmap" (map the FASTA file) or "2bit" (map the
+    # 2-bit packed reference and its mask, see ``pack_reference``)
+    cdef readonly str access
+    cdef const char *fasta_data
+    cdef size_t fasta_size
+    cdef const unsigned char *packed
+    cdef size_t packed_size
+    cdef const char *mask_data
+    cdef size_t mask_size
+    cdef const MaskRun *mask_runs
+    cdef long int mask_run_num
+
     cdef dict references
     cdef bytes cache
     cdef bytes cache_ref_name
@@ -22,6 +52,9 @@ cdef class FastaFile:
     cdef long int cache_end_pos
 
     cpdef void close(self)
+    cdef long int _first_mask_run(self, long long genome_pos)
+    cdef char _packed_base(self, SequenceTuple seq_tuple, long int pos)
+    cdef bytes _fetch(self, SequenceTuple seq_tuple, long int begin_pos, long int end_pos)
     cdef bytes get_character(self, bytes seq_name, long int pos)
     cdef bytes get_sequence(self, bytes seq_name, long int begin_pos, long int end_pos)
     cdef void set_cache_sequence(self, bytes seq_name, long int begin_pos, long int end_pos)
@@ -2,8 +2,21 @@
 """
 FastaFile is a utility class used for reading the Fasta file format,
 and facilitating access to reference sequences.
+
+Besides reading the file for each query, the reference could be memory-mapped, either the
+FASTA file itself or a 2-bit packed copy of it (``pack_reference``), then the queries are
+served without any system call and all the processes share the same pages.
 """
+import os
 import sys
+import struct
+
+from libc.stdlib cimport malloc, free
+from libc.string cimport memset
+from posix.mman cimport mmap, munmap, PROT_READ, MAP_SHARED, MAP_FAILED
+from posix.fcntl cimport open as c_open, O_RDONLY
+from posix.unistd cimport close as c_close
+from posix.stat cimport struct_stat, fstat
 
 from basevar.log import logger
 from basevar.io.openfile import Open
@@ -12,16 +25,40 @@ from basevar.io.openfile import Open
 cdef extern from "stdlib.h":
     long int atoll(char*)
 
+# Sidecars of the 2-bit packed reference: four bases in a byte for each sequence, and the runs
+# of non-ACGT or lowercase bases.
+PACKED_SUFFIX = b".2bp"
+MASK_SUFFIX = b".2bp.mask"
+MASK_MAGIC = b"BVMASK01"
+
+REFERENCE_ACCESS = ("seek", "mmap", "2bit")
+
+cdef char *PACKED_BASES = "ACGT"
+
+
+cdef const char *_mmap_file(bytes filename, size_t *size) except NULL:
+    """Map the whole file read-only and set its size."""
+    cdef struct_stat st
+    cdef int fd = c_open(filename, O_RDONLY)
+    if fd < 0:
+        raise IOError("Could not open %s." % filename)
+
+    if fstat(fd, &st) != 0 or st.st_size == 0:
+        c_close(fd)
+        raise IOError("Could not map %s, it's empty or not a regular file." % filename)
+
+    size[0] = st.st_size
+    cdef void *data = mmap(NULL, size[0], PROT_READ, MAP_SHARED, fd, 0)
+    c_close(fd)
+    if data == MAP_FAILED:
+        raise IOError("Could not map %s into memory." % filename)
+
+    return <const char *> data
+
 
 cdef class SequenceTuple:
     """Structure for storing data from line of fasta index file.
     """
-    cdef public bytes seq_name
-    cdef public long int seq_length
-    cdef public long int start_position
-    cdef public long int line_length
-    cdef public long int full_line_length
-
     def __init__(self, bytes seq_name, long int seq_length, long int start_position,
                  long int line_length, long int full_line_length):
         """Constructor
@@ -31,6 +68,8 @@ cdef class SequenceTuple:
         self.start_position = start_position
         self.line_length = line_length
         self.full_line_length = full_line_length
+        self.genome_offset = 0
+        self.packed_offset = 0
 
 cdef class FastaIndex:
     """
@@ -59,6 +98,8 @@ cdef class FastaIndex:
     def _load_index(self, filename, mode, is_ncbi):
 
         cdef bytes seq_name
+        cdef SequenceTuple seq_tuple
+        cdef long long genome_offset = 0, packed_offset = 0
         with Open(filename, mode) as F:
 
             for the_line in F:
@@ -71,8 +112,12 @@ cdef class FastaIndex:
                     if len(ids) >= 4 and ids[2] == "ref":
                         seq_name = ids[3]
 
-                self.references[seq_name] = SequenceTuple(col[0], atoll(col[1]), atoll(col[2]),
-                                                          atoll(col[3]), atoll(col[4]))
+                seq_tuple = SequenceTuple(col[0], atoll(col[1]), atoll(col[2]), atoll(col[3]), atoll(col[4]))
+                seq_tuple.genome_offset = genome_offset
+                seq_tuple.packed_offset = packed_offset
+                genome_offset += seq_tuple.seq_length
+                packed_offset += (seq_tuple.seq_length + 3) // 4
+                self.references[seq_name] = seq_tuple
 
                 self.target_name[self.n_targets] = self.references[seq_name].seq_name
                 self.target_length[self.n_targets] = self.references[seq_name].seq_length
@@ -86,20 +131,61 @@ cdef class FastaFile:
     """
     Utility for reading sequence from Fasta files.
     """
-    def __init__(self, fastafile, indexfile, mode="rb", parseNCBI=True):
+    def __cinit__(self):
+        self.fasta_data = NULL
+        self.packed = NULL
+        self.mask_data = NULL
+        self.mask_runs = NULL
+        self.mask_run_num = 0
+
+    def __init__(self, fastafile, indexfile, mode="rb", parseNCBI=True, access="seek"):
         """
-        Constructor. Takes file-name and index file-name
+        Constructor. Takes file-name and index file-name, ``access`` is one of REFERENCE_ACCESS.
         """
+        if access not in REFERENCE_ACCESS:
+            raise ValueError("Unknown reference access: %s, must be one of %s" % (access, REFERENCE_ACCESS))
+
         self.filename = fastafile
-        self.the_file = Open(fastafile, mode)
+        self.access = access
         self.the_index = FastaIndex(indexfile, mode=mode, is_ncbi=parseNCBI)
-
         self.references = self.the_index.references
+
+        self.the_file = None
+        if access == "seek":
+            self.the_file = Open(fastafile, mode)
+
+        elif access == "mmap":
+            self.fasta_data = _mmap_file(fastafile, &self.fasta_size)
+
+        else:
+            self._map_packed_reference()
+
         self.cache_ref_name = None
         self.cache_start_pos = -1
         self.cache_end_pos = -1
         self.cache = None
 
+    def __dealloc__(self):
+        self.close()
+
+    def _map_packed_reference(self):
+        cdef long long packed_size = 0, genome_size = 0
+        for seq_tuple in self.references.values():
+            packed_size += (seq_tuple.seq_length + 3) // 4
+            genome_size += seq_tuple.seq_length
+
+        self.packed = <const unsigned char *> _mmap_file(self.filename + PACKED_SUFFIX, &self.packed_size)
+        self.mask_data = _mmap_file(self.filename + MASK_SUFFIX, &self.mask_size)
+        self.mask_runs = <const MaskRun *> (self.mask_data + len(MASK_MAGIC))
+        self.mask_run_num = (self.mask_size - len(MASK_MAGIC)) // sizeof(MaskRun)
+
+        if (<long long> self.packed_size != packed_size or self.mask_data[:len(MASK_MAGIC)] != MASK_MAGIC or
+                (self.mask_run_num > 0 and self.mask_runs[self.mask_run_num - 1].end > genome_size)):
+            raise IOError("%s does not match %s, please pack it again by pack_reference()." % (
+                self.filename + PACKED_SUFFIX, self.filename))
+
+        return
+
     def get_total_sequence_length(self):
         """
         Return the accumulated lengths of all sequences in the
@@ -118,7 +204,89 @@ cdef class FastaFile:
         """
         Wrapper function to close self.theFile
         """
-        self.the_file.close()
+        if self.the_file is not None:
+            self.the_file.close()
+            self.the_file = None
+
+        if self.fasta_data != NULL:
+            munmap(<void *> self.fasta_data, self.fasta_size)
+            self.fasta_data = NULL
+
+        if self.packed != NULL:
+            munmap(<void *> self.packed, self.packed_size)
+            self.packed = NULL
+
+        if self.mask_data != NULL:
+            munmap(<void *> self.mask_data, self.mask_size)
+            self.mask_data = NULL
+            self.mask_runs = NULL
+            self.mask_run_num = 0
+
+    cdef long int _first_mask_run(self, long long genome_pos):
+        """The index of the first run which ends after ``genome_pos``."""
+        cdef long int lo = 0, hi = self.mask_run_num, mid
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.mask_runs[mid].end <= genome_pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    cdef char _packed_base(self, SequenceTuple seq_tuple, long int pos):
+        """The base at 0-base ``pos`` of the 2-bit packed reference."""
+        cdef char base = PACKED_BASES[(self.packed[seq_tuple.packed_offset + (pos >> 2)] >> (6 - 2 * (pos & 3))) & 3]
+        cdef long long genome_pos = seq_tuple.genome_offset + pos
+        cdef long int i = self._first_mask_run(genome_pos)
+        if i < self.mask_run_num and self.mask_runs[i].start <= genome_pos:
+            return base + 32 if self.mask_runs[i].kind == 0 else <char> self.mask_runs[i].kind
+
+        return base
+
+    cdef bytes _fetch(self, SequenceTuple seq_tuple, long int begin_pos, long int end_pos):
+        """The sequence in [begin_pos, end_pos) which must be in the range of ``seq_tuple``."""
+        cdef long int line_length = seq_tuple.line_length
+        cdef long int newline_length = seq_tuple.full_line_length - line_length
+        cdef long int file_start_pos = seq_tuple.start_position + begin_pos + newline_length * (
+            <long int> ((<double> begin_pos) / line_length))
+        cdef long int file_end_pos = seq_tuple.start_position + end_pos + newline_length * (
+            <long int> ((<double> end_pos) / line_length))
+
+        if self.fasta_data != NULL:
+            return self.fasta_data[file_start_pos:file_end_pos].replace(b"\n", b"")
+
+        elif self.packed == NULL:
+            self.the_file.seek(file_start_pos)
+            return self.the_file.read(file_end_pos - file_start_pos).replace("\n", "")
+
+        cdef long int length = end_pos - begin_pos
+        if length <= 0:
+            return b""
+
+        cdef char *buf = <char *> malloc(length * sizeof(char))
+        assert buf != NULL, "Could not allocate memory for fetching reference sequence."
+
+        cdef long int i, pos
+        for i in range(length):
+            pos = begin_pos + i
+            buf[i] = PACKED_BASES[(self.packed[seq_tuple.packed_offset + (pos >> 2)] >> (6 - 2 * (pos & 3))) & 3]
+
+        # Apply the runs which overlap with the sequence
+        cdef long long genome_begin = seq_tuple.genome_offset + begin_pos
+        cdef long long genome_end = genome_begin + length
+        cdef long int k = self._first_mask_run(genome_begin)
+        cdef long long j
+        while k < self.mask_run_num and self.mask_runs[k].start < genome_end:
+            for j in range(max(self.mask_runs[k].start, genome_begin), min(self.mask_runs[k].end, genome_end)):
+                if self.mask_runs[k].kind == 0:
+                    buf[j - genome_begin] += 32  # lowercase
+                else:
+                    buf[j - genome_begin] = <char> self.mask_runs[k].kind
+            k += 1
+
+        cdef bytes seq = buf[:length]
+        free(buf)
+        return seq
 
     cdef bytes get_character(self, bytes seq_name, long int pos):
         """
@@ -142,8 +310,16 @@ cdef class FastaFile:
             # it's empty
             return <char*> ""
 
+        cdef char base
+        if self.packed != NULL:
+            base = self._packed_base(seq_tuple, pos)
+            return (&base)[:1]
+
         filepos = seq_start_position + pos + (full_line_length - line_length) * (
             <long int>((<double>pos)/line_length))
+        if self.fasta_data != NULL:
+            return self.fasta_data[filepos:filepos + 1]
+
         self.the_file.seek(filepos)
 
         try:
@@ -167,18 +343,6 @@ cdef class FastaFile:
         begin_pos = max(0, begin_pos)
         end_pos = min(seq_length - 1, end_pos)
 
-        cdef long int seq_start_pos = seq_tuple.start_position
-        cdef long int line_length = seq_tuple.line_length
-        cdef long int full_line_length = seq_tuple.full_line_length
-        cdef long int desired_sequence_start_pos = seq_start_pos + begin_pos + (
-                full_line_length - line_length) * <long int> ((<double> begin_pos) / line_length)
-        cdef long int desired_sequence_end_pos = seq_start_pos + end_pos + (
-                full_line_length - line_length) * <long int> ((<double> end_pos) / line_length)
-
-        # 0-base
-        cdef long int desired_seq_length = (end_pos - begin_pos)
-        cdef long int desired_sequence_length_infile = (desired_sequence_end_pos - desired_sequence_start_pos)
-
         if end_pos < begin_pos:
             raise IndexError, "Cannot have beginPos = %s, endPos = %s" % (begin_pos, end_pos)
 
@@ -186,8 +350,7 @@ cdef class FastaFile:
             raise IndexError, ("Cannot return sequence from %s to %s. Reference sequence "
                                "length = %s" % (begin_pos, end_pos, seq_length))
 
-        self.the_file.seek(desired_sequence_start_pos)
-        self.cache = self.the_file.read(desired_sequence_length_infile).replace("\n", "")
+        self.cache = self._fetch(seq_tuple, begin_pos, end_pos)
         self.cache_ref_name = seq_name
         self.cache_start_pos = begin_pos
         self.cache_end_pos = end_pos
@@ -212,18 +375,6 @@ cdef class FastaFile:
         begin_pos = max(0, begin_pos)
         end_pos = min(seq_length - 1, end_pos)
 
-        cdef long int seq_start_pos = seq_tuple.start_position
-        cdef long int line_length = seq_tuple.line_length
-        cdef long int full_line_length = seq_tuple.full_line_length
-        cdef long int desired_sequence_start_pos = seq_start_pos + begin_pos + (
-                full_line_length - line_length) * <long int> ((<double> begin_pos) / line_length)
-        cdef long int desired_sequence_end_pos = seq_start_pos + end_pos + (
-                full_line_length - line_length) * <long int> ((<double> end_pos) / line_length)
-
-        # 0-base
-        cdef long int desired_seq_length = (end_pos - begin_pos)
-        cdef long int desired_sequence_length_infile = (desired_sequence_end_pos - desired_sequence_start_pos)
-
         if end_pos < begin_pos:
             raise IndexError, "Cannot have beginPos = %s, endPos = %s" % (begin_pos, end_pos)
 
@@ -231,9 +382,7 @@ cdef class FastaFile:
             raise IndexError, ("Cannot return sequence from %s to %s. Reference sequence "
                                "length = %s" % (begin_pos, end_pos, seq_length))
 
-        self.the_file.seek(desired_sequence_start_pos)
-        cdef bytes seq = self.the_file.read(desired_sequence_length_infile)
-        return seq.replace("\n", "")
+        return self._fetch(seq_tuple, begin_pos, end_pos)
 
     property filename:
         """The filename of the `reference` sequences file. """
@@ -266,3 +415,118 @@ cdef class FastaFile:
 
             return tuple(s)
 
+
+
+def is_packed_reference_updated(fastafile, indexfile=None):
+    """The 2-bit packed reference of ``fastafile`` exists and is newer than the FASTA and its index."""
+    if indexfile is None:
+        indexfile = fastafile + b".fai"
+
+    cdef list packed_files = [fastafile + PACKED_SUFFIX, fastafile + MASK_SUFFIX]
+    if not all([os.path.isfile(f) for f in packed_files]):
+        return False
+
+    cdef double source_mtime = max(os.path.getmtime(fastafile), os.path.getmtime(indexfile))
+    return all([os.path.getmtime(f) >= source_mtime for f in packed_files])
+
+
+def pack_reference(fastafile, indexfile=None, long int chunk_size=4194304):
+    """Pack the bases of ``fastafile`` into 2 bits (``fastafile + PACKED_SUFFIX``) and record the
+    runs of the non-ACGT or lowercase bases (``fastafile + MASK_SUFFIX``), which could be mapped
+    by ``FastaFile(access="2bit")`` and decoded exactly as they are in ``fastafile``.
+    """
+    if indexfile is None:
+        indexfile = fastafile + b".fai"
+
+    # Every chunk starts from a new byte
+    chunk_size -= chunk_size % 4
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be at least 4.")
+
+    # The 2-bit code and the kind of mask run for each char, -1 for no mask run
+    cdef int code_of[256]
+    cdef long long kind_of[256]
+    cdef int c
+    for c in range(256):
+        code_of[c] = 0
+        kind_of[c] = c
+
+    for c in range(4):
+        code_of[<unsigned char> PACKED_BASES[c]] = code_of[<unsigned char> PACKED_BASES[c] + 32] = c
+        kind_of[<unsigned char> PACKED_BASES[c]] = -1
+        kind_of[<unsigned char> PACKED_BASES[c] + 32] = 0
+
+    cdef FastaFile fa = FastaFile(fastafile, indexfile)
+    cdef unsigned char *packed = <unsigned char *> malloc(chunk_size // 4)
+    assert packed != NULL, "Could not allocate memory for packing reference."
+
+    cdef SequenceTuple seq_tuple
+    cdef bytes seq
+    cdef const unsigned char *s
+    cdef long int begin, i, n
+    cdef long long g, kind, run_start = -1, run_end = -1, run_kind = -1
+    cdef list runs = []
+    packed_file, mask_file = fastafile + PACKED_SUFFIX, fastafile + MASK_SUFFIX
+    with open(packed_file + b".tmp", "wb") as P, open(mask_file + b".tmp", "wb") as M:
+        M.write(MASK_MAGIC)
+        for seq_tuple in sorted(fa.references.values(), key=lambda t: t.genome_offset):
+            for begin in range(0, seq_tuple.seq_length, chunk_size):
+                seq = fa._fetch(seq_tuple, begin, min(begin + chunk_size, seq_tuple.seq_length))
+                s = seq
+                n = len(seq)
+                memset(packed, 0, (n + 3) // 4)
+                for i in range(n):
+                    packed[i >> 2] |= code_of[s[i]] << (6 - 2 * (i & 3))
+
+                    kind = kind_of[s[i]]
+                    if kind < 0:
+                        continue
+
+                    g = seq_tuple.genome_offset + begin + i
+                    if kind == run_kind and g == run_end:
+                        run_end += 1
+                    else:
+                        if run_kind >= 0:
+                            runs.extend([run_start, run_end, run_kind])
+                        run_start, run_end, run_kind = g, g + 1, kind
+
+                P.write(packed[:(n + 3) // 4])
+                if len(runs) >= 3 * 65536:
+                    M.write(struct.pack("=%dq" % len(runs), *runs))
+                    runs = []
+
+        if run_kind >= 0:
+            runs.extend([run_start, run_end, run_kind])
+        if runs:
+            M.write(struct.pack("=%dq" % len(runs), *runs))
+
+    free(packed)
+    fa.close()
+
+    os.rename(packed_file + b".tmp", packed_file)
+    os.rename(mask_file + b".tmp", mask_file)
+    return packed_file, mask_file
+
+
+def compare_reference_access(fastafile, access, indexfile=None, long int window=100):
+    """Compare every base and the sequences of each ``window`` get by ``access`` with reading the
+    file, return the number of the different queries.
+    """
+    if indexfile is None:
+        indexfile = fastafile + b".fai"
+
+    cdef FastaFile expect = FastaFile(fastafile, indexfile)
+    cdef FastaFile fa = FastaFile(fastafile, indexfile, access=access)
+    cdef long int diff_num = 0, pos
+    cdef bytes seq_name
+    for seq_name, seq_tuple in fa.references.items():
+        for pos in range(-1, seq_tuple.seq_length + 1):
+            diff_num += fa.get_character(seq_name, pos) != expect.get_character(seq_name, pos)
+
+        for pos in range(0, seq_tuple.seq_length, window // 2 + 1):
+            diff_num += fa.get_sequence(seq_name, pos, pos + window) != expect.get_sequence(seq_name, pos,
+                                                                                           pos + window)
+
+    fa.close()
+    expect.close()
+    return diff_num
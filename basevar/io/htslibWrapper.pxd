@@ -55,7 +55,7 @@ cdef extern from "htslib/kstring.h" nogil:
         char *s
 
 
-cdef extern from "htslib/kfunc.h":
+cdef extern from "htslib/kfunc.h" nogil:
     # exact_fisher_test from htslib
     double kt_fisher_exact(int n11, int n12, int n21, int n22, double *_left, double *_right, double *two)
 
@@ -445,6 +445,16 @@ cdef extern from "htslib/tbx.h" nogil:
     void tbx_destroy(tbx_t *tbx)
 
 
+cdef extern from "htslib/thread_pool.h" nogil:
+    ctypedef struct hts_tpool
+
+    # Create a pool of ``n`` worker threads, which could be shared by many files.
+    hts_tpool *hts_tpool_init(int n)
+
+    # Destroy the pool after all the files attached to it have been closed.
+    void hts_tpool_destroy(hts_tpool *p)
+
+
 cdef extern from "htslib/hts.h" nogil:
     uint32_t kroundup32(uint32_t x)
 
@@ -660,6 +670,16 @@ cdef extern from "htslib/hts.h" nogil:
     # @notes     THIS THREADING API IS LIKELY TO CHANGE IN FUTURE.
     int hts_set_threads(htsFile *fp, int n)
 
+    ctypedef struct htsThreadPool:
+        hts_tpool *pool  # The shared thread pool itself
+        int qsize        # Size of I/O queue to use for this fp, 0 for default
+
+    # @abstract  Attach a shared thread pool to the file for (de)compression
+    # @param fp  The file handle
+    # @param p   A pointer to a htsThreadPool struct
+    # @return    0 for success, or negative if an error occurred.
+    int hts_set_thread_pool(htsFile *fp, htsThreadPool *p)
+
     # @abstract  Set .fai filename for a file opened for reading
     # @return    0 for success, negative on failure
     # @discussion
@@ -892,6 +912,22 @@ cdef extern from "htslib/hts.h" nogil:
     void *ed_swap_8p(void *x)
 
 
+# Building an index on the fly with the threads of BGZF writers, they are exported by htslib but
+# declared in its internal header ``hts_internal.h``, which is not installed.
+cdef extern from * nogil:
+    """
+    int bgzf_idx_push(BGZF *fp, hts_idx_t *hidx, int tid, hts_pos_t beg, hts_pos_t end, uint64_t offset,
+                      int is_mapped);
+    void hts_idx_amend_last(hts_idx_t *idx, uint64_t offset);
+    """
+    #### Push an index entry of the data just written, the same as ``hts_idx_push`` without threads,
+    #    otherwise it's buffered and pushed after the block of ``offset`` has been written.
+    int bgzf_idx_push(BGZF *fp, hts_idx_t *hidx, int tid, int64_t beg, int64_t end, uint64_t offset,
+                      int is_mapped)
+    #### Move the end of the last pushed entry to ``offset``, after flushing
+    void hts_idx_amend_last(hts_idx_t *idx, uint64_t offset)
+
+
 cdef extern from "htslib/sam.h":
     ctypedef struct bam_hdr_t:
         int32_t n_targets
@@ -2062,8 +2098,9 @@ cdef extern from "htslib/vcf.h" nogil:
     uint32_t bcf_float_missing
 
     void bcf_float_set(float *ptr, uint32_t value)
-    void bcf_float_set_vector_end(float *x)
-    void bcf_float_set_missing(float *x)
+    # Macros which take the address of ``x`` by themselves, ``x`` must be an lvalue
+    void bcf_float_set_vector_end(float x)
+    void bcf_float_set_missing(float x)
 
     int bcf_float_is_missing(float f)
     int bcf_float_is_vector_end(float f)
@@ -2205,8 +2242,19 @@ ctypedef struct cAlignedRead:
     unsigned char mapq
 
 
+cdef class ReadArena:
+    """A bump allocator for reads, all the memory is freed together when it's destroyed."""
+    cdef char *block          # the current block, the first pointer-size bytes link to the previous one
+    cdef size_t used          # bytes used in the current block
+    cdef size_t capacity      # bytes of the current block
+    cdef size_t next_block_size
+    cdef size_t total_size    # bytes of all the blocks
+
+    cdef void *alloc(self, size_t size)
+
+
 cdef class ReadIterator:
-    cdef cAlignedRead *get(self, int store_rgID, char** rgID)
+    cdef cAlignedRead *get(self, int store_rgID, char** rgID, ReadArena arena=*)
     cdef int cnext(self) nogil
     cdef char _get_base(self, uint8_t *s, int i)
 
@@ -2215,6 +2263,12 @@ cdef class ReadIterator:
     cdef bam1_t *b
 
 
+# The process-wide htslib thread pool for BGZF/CRAM decompression, all the Samfile opened after
+# ``init_io_thread_pool`` will attach to it.
+cdef int init_io_thread_pool(int thread_num) except -1
+cdef void destroy_io_thread_pool()
+
+
 cdef class Samfile:
     cdef void clear_header(self)
     cdef void clear_index(self)
@@ -2252,6 +2306,9 @@ DEF BAM_FSECONDARY = 256  # Not primary alignment
 DEF BAM_FQCFAIL = 512  # QC failure
 DEF BAM_FDUP = 1024  # Optical or PCR duplicate
 DEF BAM_FCOMPRESSED = 2048  # Is the read compressed
+DEF BAM_FINARENA = 4096  # The cAlignedRead and its cigar_ops are allocated in a ReadArena
+DEF BAM_FSEQINARENA = 8192  # Read sequence is allocated in a ReadArena
+DEF BAM_FQUALINARENA = 16384  # Read quality is allocated in a ReadArena
 ###################################################################################################
 
 
@@ -2304,6 +2361,24 @@ cdef inline void Read_SetCompressed(cAlignedRead* the_read) nogil:
 cdef inline void Read_SetUnCompressed(cAlignedRead* the_read) nogil:
     the_read.bit_flag &= (~BAM_FCOMPRESSED)
 
+cdef inline int Read_IsInArena(cAlignedRead* the_read) nogil:
+    return ((the_read.bit_flag & BAM_FINARENA) != 0)
+
+cdef inline int Read_SeqIsInArena(cAlignedRead* the_read) nogil:
+    return ((the_read.bit_flag & BAM_FSEQINARENA) != 0)
+
+cdef inline int Read_QualIsInArena(cAlignedRead* the_read) nogil:
+    return ((the_read.bit_flag & BAM_FQUALINARENA) != 0)
+
+cdef inline void Read_SetInArena(cAlignedRead* the_read) nogil:
+    the_read.bit_flag |= (BAM_FINARENA | BAM_FSEQINARENA | BAM_FQUALINARENA)
+
+cdef inline void Read_SetSeqNotInArena(cAlignedRead* the_read) nogil:
+    the_read.bit_flag &= (~BAM_FSEQINARENA)
+
+cdef inline void Read_SetQualNotInArena(cAlignedRead* the_read) nogil:
+    the_read.bit_flag &= (~BAM_FQUALINARENA)
+
 ###################################################################################################
 
 cdef void destroy_read(cAlignedRead* the_read)
@@ -9,7 +9,7 @@ from basevar.io.libcutils cimport encode_filename
 from basevar.io.libcutils cimport force_str, charptr_to_str
 
 
-__all__ = ['HTSFile', 'Samfile', 'ReadIterator', 'destroy_read']
+__all__ = ['HTSFile', 'Samfile', 'ReadArena', 'ReadIterator', 'destroy_read']
 
 
 # defines imported from samtools
@@ -45,6 +45,55 @@ cdef dict VALID_HEADER_FIELDS = {
 
 cdef int COMPRESS_COUNT = 40
 
+# The first and the second base of each byte in 4-bit encoded BAM sequence, so that a read
+# could be decoded two bases by one lookup.
+cdef char *BASE_LOOKUP = "=ACMGRSVTWYHKDBN"
+cdef char NIBBLE_PAIR_LOOKUP[512]
+
+cdef int _init_nibble_pair_lookup():
+    cdef int i
+    for i in range(256):
+        NIBBLE_PAIR_LOOKUP[2 * i] = BASE_LOOKUP[i >> 4]
+        NIBBLE_PAIR_LOOKUP[2 * i + 1] = BASE_LOOKUP[i & 0xf]
+    return 0
+
+_init_nibble_pair_lookup()
+
+# The first block of ReadArena is small for the regions without any reads, the following ones
+# will be doubled until MAX_ARENA_BLOCK_SIZE.
+cdef size_t MIN_ARENA_BLOCK_SIZE = 64 * 1024
+cdef size_t MAX_ARENA_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Shared by all the Samfile in the current process, ``pool`` is NULL if it's not initialized.
+cdef htsThreadPool IO_THREAD_POOL
+IO_THREAD_POOL.pool = NULL
+IO_THREAD_POOL.qsize = 0
+
+
+cdef int init_io_thread_pool(int thread_num) except -1:
+    """Create ``thread_num`` htslib worker threads for decoding BAM/CRAM files in this process.
+
+    Threads could not be inherited by ``fork()``, so this should be called in the process which
+    reads the files. Do nothing if ``thread_num`` < 1 or the pool has been created.
+    """
+    if thread_num < 1 or IO_THREAD_POOL.pool != NULL:
+        return 0
+
+    IO_THREAD_POOL.pool = hts_tpool_init(thread_num)
+    if IO_THREAD_POOL.pool == NULL:
+        raise MemoryError("Could not create htslib thread pool with %d threads" % thread_num)
+
+    return 0
+
+
+cdef void destroy_io_thread_pool():
+    """Destroy the shared thread pool. All the files attached to it must be closed before."""
+    if IO_THREAD_POOL.pool != NULL:
+        hts_tpool_destroy(IO_THREAD_POOL.pool)
+        IO_THREAD_POOL.pool = NULL
+
+    return
+
 
 ########################################################################
 ########################################################################
@@ -590,6 +639,13 @@ cdef class Samfile:
         """Open BamFile.
         """
         self.samfile = sam_open(self.filename, mode)
+        if self.samfile == NULL:
+            return
+
+        # BGZF blocks or CRAM containers will be decoded by the shared threads ahead of reading.
+        if IO_THREAD_POOL.pool != NULL:
+            hts_set_thread_pool(<htsFile *> self.samfile, &IO_THREAD_POOL)
+
         self.the_header = bam_hdr_init()
         self.the_header = sam_hdr_read(self.samfile)
 
@@ -712,6 +768,55 @@ cdef class Samfile:
             return result
 
 
+cdef class ReadArena:
+    """
+    Memory of the reads which are loaded together and freed together, e.g. all the reads in a
+    ``BamReadBuffer``. A read and all its buffers are allocated by one pointer bump instead of
+    4 ``malloc``, and there's no ``free`` for each read.
+    """
+    def __cinit__(self):
+        self.block = NULL
+        self.used = 0
+        self.capacity = 0
+        self.next_block_size = MIN_ARENA_BLOCK_SIZE
+        self.total_size = 0
+
+    def __dealloc__(self):
+        cdef char *prev
+        while self.block != NULL:
+            prev = (<char**> self.block)[0]
+            free(self.block)
+            self.block = prev
+
+    cdef void *alloc(self, size_t size):
+        """Return ``size`` bytes which are aligned to 8 bytes."""
+        cdef size_t block_size
+        cdef char *new_block
+        cdef void *ptr
+
+        size = (size + 7) & ~(<size_t> 7)
+        if self.used + size > self.capacity:
+            block_size = self.next_block_size
+            if block_size < size + sizeof(char*):
+                block_size = size + sizeof(char*)
+
+            new_block = <char*> malloc(block_size)
+            assert new_block != NULL, "Could not allocate memory for ReadArena"
+
+            (<char**> new_block)[0] = self.block
+            self.block = new_block
+            self.used = (sizeof(char*) + 7) & ~(<size_t> 7)
+            self.capacity = block_size
+            self.total_size += block_size
+
+            if self.next_block_size < MAX_ARENA_BLOCK_SIZE:
+                self.next_block_size *= 2
+
+        ptr = self.block + self.used
+        self.used += size
+        return ptr
+
+
 cdef class ReadIterator:
     """
     Iterates over mapped reads in a region.
@@ -751,7 +856,7 @@ cdef class ReadIterator:
         if self.b != NULL:
             bam_destroy1(self.b)
 
-    cdef cAlignedRead* get(self, int store_rgID, char** rgID):
+    cdef cAlignedRead* get(self, int store_rgID, char** rgID, ReadArena arena=None):
         """ Some very importance data structure in sam.h and wrapper by htslibWrapper module.
         
         /*************************
@@ -789,6 +894,8 @@ cdef class ReadIterator:
         } bam1_core_t;
         
         Notes: read pos is 0-base!
+
+        The read is allocated in ``arena`` if it's provided, or it must be freed by ``destroy_read``.
         """
         cdef bam1_core_t* c = &self.b.core
         cdef uint8_t* s = bam_get_seq(self.b)
@@ -801,13 +908,29 @@ cdef class ReadIterator:
         if q[0] == 0xff:
             return NULL
 
-        cdef cAlignedRead* the_read = <cAlignedRead*> malloc(sizeof(cAlignedRead))
-        cdef char* seq = <char*> malloc((len_seq + 1) * sizeof(char))
-        cdef char* qual = <char*> malloc((len_seq + 1) * sizeof(char))
+        cdef cAlignedRead* the_read
+        cdef short* cigar_ops
+        cdef char* seq
+        cdef char* qual
+        cdef char* buf
+        if arena is not None:
+            # [cAlignedRead | cigar_ops | seq | qual] in one piece of memory.
+            buf = <char*> arena.alloc(sizeof(cAlignedRead) + 2 * c.n_cigar * sizeof(short) +
+                                      2 * (len_seq + 1) * sizeof(char))
+            the_read = <cAlignedRead*> buf
+            cigar_ops = <short*> (buf + sizeof(cAlignedRead))
+            seq = <char*> (cigar_ops + 2 * c.n_cigar)
+            qual = seq + len_seq + 1
+        else:
+            the_read = <cAlignedRead*> malloc(sizeof(cAlignedRead))
+            cigar_ops = <short*> malloc(2 * c.n_cigar * sizeof(short))
+            seq = <char*> malloc((len_seq + 1) * sizeof(char))
+            qual = <char*> malloc((len_seq + 1) * sizeof(char))
 
         assert the_read != NULL
         assert seq != NULL
         assert qual != NULL
+        assert cigar_ops != NULL, "Error cigar_ops is NULL"
 
         # Try to grab the read-group tag value
         cdef uint8_t* v = NULL
@@ -825,19 +948,22 @@ cdef class ReadIterator:
             else:
                 rgID[0] = NULL
 
+        # Two bases for each byte
         cdef int i = 0
+        for i in range(len_seq >> 1):
+            memcpy(seq + 2 * i, NIBBLE_PAIR_LOOKUP + 2 * s[i], 2)
+
+        if len_seq & 1:
+            seq[len_seq - 1] = BASE_LOOKUP[s[len_seq >> 1] >> 4]
+
+        memcpy(qual, q, len_seq)
         for i in range(len_seq):
-            seq[i] = self._get_base(s, i)
-            qual[i] = q[i]
-            assert qual[i] <= 93
-            assert qual[i] >= 0
+            assert q[i] <= 93
 
         seq[len_seq] = '\0'
         qual[len_seq] = '\0'
 
         read_start = c.pos  # 0-base
-        cdef short* cigar_ops = <short*> malloc(2 * c.n_cigar * sizeof(short))
-        assert cigar_ops != NULL, "Error cigar_ops is NULL"
 
         cdef uint32_t* cigar = bam_get_cigar(self.b)
         for i in range(c.n_cigar):
@@ -870,6 +996,8 @@ cdef class ReadIterator:
         the_read.mapq = c.qual
 
         Read_SetUnCompressed(the_read)
+        if arena is not None:
+            Read_SetInArena(the_read)
 
         return the_read
 
@@ -878,27 +1006,39 @@ cdef class ReadIterator:
         return sam_itr_next(self.the_samfile, self.the_iterator, self.b) >= 0
 
     cdef char _get_base(self, uint8_t *s, int i):
-        cdef char* base_lookup = "=ACMGRSVTWYHKDBN"
-        return base_lookup[bam_seqi(s, i)]
+        return BASE_LOOKUP[bam_seqi(s, i)]
 
 
 cdef void destroy_read(cAlignedRead* the_read):
-    """De-allocate memory for read.
+    """De-allocate memory for read. The memory in ReadArena will be freed with the arena.
     """
+    release_seq(the_read)
+    release_qual(the_read)
+
+    if the_read.hash != NULL:
+        free(the_read.hash)
 
-    if the_read.seq != NULL:
-        free(the_read.seq)
+    if not Read_IsInArena(the_read):
+        if the_read.cigar_ops != NULL:
+            free(the_read.cigar_ops)
 
-    if the_read.qual != NULL:
-        free(the_read.qual)
+        free(the_read)
 
-    if the_read.cigar_ops != NULL:
-        free(the_read.cigar_ops)
 
-    if the_read.hash != NULL:
-        free(the_read.hash)
+cdef inline void release_seq(cAlignedRead* read):
+    """Free the sequence of read before replacing it."""
+    if Read_SeqIsInArena(read):
+        Read_SetSeqNotInArena(read)
+    elif read.seq != NULL:
+        free(read.seq)
+
 
-    free(the_read)
+cdef inline void release_qual(cAlignedRead* read):
+    """Free the quality of read before replacing it."""
+    if Read_QualIsInArena(read):
+        Read_SetQualNotInArena(read)
+    elif read.qual != NULL:
+        free(read.qual)
 
 
 cdef void compress_seq(cAlignedRead* read, char* refseq):
@@ -946,7 +1086,7 @@ cdef void compress_seq(cAlignedRead* read, char* refseq):
     strcpy(final_seq, new_seq)
 
     final_seq[new_seq_index] = 0
-    free(read.seq)
+    release_seq(read)
     free(new_seq)
 
     read.seq = final_seq
@@ -998,7 +1138,7 @@ cdef void compress_qual(cAlignedRead* read, int qual_bin_size):
     strcpy(final_qual, new_qual)
 
     final_qual[new_qual_index] = 0
-    free(read.qual)
+    release_qual(read)
     free(new_qual)
 
     read.qual = final_qual
@@ -1029,7 +1169,7 @@ cdef void uncompress_seq(cAlignedRead* read, char* refseq):
             ref_index += 1
             new_seq_index += 1
 
-    free(read.seq)
+    release_seq(read)
     read.seq = new_seq
     read.seq[read.r_len] = 0
     return
@@ -1056,7 +1196,7 @@ cdef void uncompress_qual(cAlignedRead* read):
 
     assert read.r_len == new_qual_index
 
-    free(read.qual)
+    release_qual(read)
     read.qual = new_qual
     read.qual[read.r_len] = 0
     return
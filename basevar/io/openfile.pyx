@@ -9,7 +9,7 @@ import os
 import gzip
 import heapq
 
-from basevar.io.BGZF.bgzf import BGZFile
+from basevar.io.BGZF.bgzf import BGZFile, TabixBGZFile, inflate_bgzf_blocks
 
 def _expanded_open(path, mode):
     try:
@@ -18,21 +18,45 @@ def _expanded_open(path, mode):
         return open(os.path.expanduser(path), mode)
 
 
-def Open(file_name, mode, compress_level=9, isbgz=True):
+def Open(file_name, mode, compress_level=None, isbgz=True, tabix=False, threads=0):
     """
     Function that allows transparent usage of dictzip, gzip and
     ordinary files
+
+    Set ``tabix`` to build the tabix index (the first two columns are
+    CHROM and POS) while writing a BGZF file, it's saved when the file is closed.
+
+    ``compress_level`` is None for the default level: htslib's for BGZF and 9 for gzip.
+    BGZF blocks are compressed by ``threads`` background threads if ``threads`` > 0.
     """
     if file_name.endswith(".gz") or file_name.endswith(".GZ"):
         file_dir = os.path.dirname(file_name)
         if not os.path.exists(file_dir):
             file_name = os.path.expanduser(file_name)
 
-        return BGZFile(file_name, mode) if isbgz else gzip.GzipFile(file_name, mode, compress_level)
+        if isbgz and tabix and 'w' in mode:
+            return TabixBGZFile(file_name, mode, seq_col=0, start_col=1, end_col=1,
+                                compress_level=compress_level, threads=threads)
+
+        if isbgz:
+            return BGZFile(file_name, mode, compress_level=compress_level, threads=threads)
+        else:
+            return gzip.GzipFile(file_name, mode, 9 if compress_level is None else compress_level)
     else:
         return _expanded_open(file_name, mode)
 
 
+def read_range(file_name, long int start, long int end, bint bgzf=False):
+    """Read the bytes in [start, end) of ``file_name``, which are decompressed if it's BGZF and then
+    [start, end) must be aligned to the blocks (e.g. by ``bgzf_block_offsets``).
+    """
+    with open(file_name, "rb") as I:
+        I.seek(start)
+        data = I.read(end - start)
+
+    return inflate_bgzf_blocks(data) if bgzf else data
+
+
 class FileForQueueing(object):
     def __init__(self, the_file, line, is_del_raw_file=False):
         """
@@ -1,6 +1,6 @@
 """Fast cython implementation of some windowing functions.
 """
-from basevar.io.htslibWrapper cimport cAlignedRead
+from basevar.io.htslibWrapper cimport cAlignedRead, ReadArena
 
 cdef bint check_and_trim_read(cAlignedRead*the_read, cAlignedRead* the_last_read, int* filtered_read_counts_by_type,
                               int min_map_qual, bint trim_overlapping, bint trim_soft_clipped)
@@ -12,6 +12,7 @@ cdef class ReadArray:
     cdef int __size
     cdef int __capacity
     cdef int __longest_read
+    cdef ReadArena arena  # keep the memory of reads alive until all of them are destroyed
 
     cdef void append(self, cAlignedRead* value)
     cdef int get_size(self)
@@ -38,6 +39,7 @@ cdef class BamReadBuffer:
     cdef int trim_soft_clipped
     cdef int verbosity
 
+    cdef ReadArena arena  # all the reads in this buffer are allocated in it
     cdef ReadArray reads
     cdef ReadArray bad_reads
     cdef cAlignedRead* last_read
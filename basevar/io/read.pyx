@@ -2,7 +2,7 @@
 """Fast cython implementation of some windowing functions.
 """
 from basevar.log import logger
-from basevar.io.htslibWrapper cimport cAlignedRead
+from basevar.io.htslibWrapper cimport cAlignedRead, ReadArena
 from basevar.io.htslibWrapper cimport destroy_read
 from basevar.io.htslibWrapper cimport compress_read
 from basevar.io.htslibWrapper cimport uncompress_read
@@ -68,9 +68,13 @@ cdef extern from "math.h":
 cdef class ReadArray:
     """Simple structure to wrap a raw C array, with some bounds checking.
     """
-    def __cinit__(self, int size):
+    def __cinit__(self, int size, ReadArena arena=None):
         """Allocate an array of size 'size', with initial values 'init'.
+
+        ``arena`` should be provided if the reads are allocated in it, the array will keep it
+        alive so that the reads could be safely destroyed in ``__dealloc__``.
         """
+        self.arena = arena
         self.array = <cAlignedRead**> (malloc(size * sizeof(cAlignedRead*)))
         assert self.array != NULL, "Could not allocate memory for ReadArray"
 
@@ -378,9 +382,10 @@ cdef class BamReadBuffer:
         cdef int initial_size = max(100, ((end - start)/options.r_len))
         self.is_sorted = True
 
-        self.reads = ReadArray(initial_size)
-        self.bad_reads = ReadArray(initial_size)
-        self.broken_mates = ReadArray(initial_size)
+        self.arena = ReadArena()
+        self.reads = ReadArray(initial_size, self.arena)
+        self.bad_reads = ReadArray(initial_size, self.arena)
+        self.broken_mates = ReadArray(initial_size, self.arena)
         self.filtered_read_counts_by_type = <int*>(calloc(7, sizeof(int)))
         self.chrom = chrom
         self.start = start
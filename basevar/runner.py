@@ -14,6 +14,16 @@ from caller.launch import BaseTypeRunner
 from basevar.utils import do_cprofile
 
 
+def add_bgzf_output_arguments(cmd):
+    """Arguments for writing .gz (BGZF) outputs, which are shared by the commands."""
+    cmd.add_argument('--compress-level', dest='compress_level', metavar='INT', type=int, default=None,
+                     choices=range(10), help='Compression level (0-9) of the .gz outputs. [htslib default]')
+    cmd.add_argument('--write-threads', dest='write_threads', metavar='INT', type=int, default=0,
+                     help='Number of background threads for compressing each .gz output, the program '
+                          'doesn\'t have to wait for compression when writing. [0]')
+    return
+
+
 def parser_commandline_args():
     desc = "BaseVar: A python software for calling population variants for ultra low pass " \
            "whole genome sequencing data."
@@ -29,6 +39,13 @@ def parser_commandline_args():
                               help='list of input BAM/CRAM filenames, one per line')
     basetype_cmd.add_argument('-R', '--reference', dest='referencefile', metavar='Reference_fasta', required=True,
                               help='Input reference fasta file.')
+    basetype_cmd.add_argument('--reference-access', dest='reference_access', type=str, default='seek',
+                              choices=['seek', 'mmap', '2bit'],
+                              help='How to read the reference: "seek" reads the fasta file for each query, '
+                                   '"mmap" maps the (uncompressed) fasta file into memory and "2bit" maps a '
+                                   '2-bit packed copy of it (Reference_fasta.2bp and Reference_fasta.2bp.mask, '
+                                   'which will be created if they are missing or out of date). The mapped pages '
+                                   'are shared by all the processes. [seek]')
 
     basetype_cmd.add_argument('-q', dest='mapq', metavar='INT', type=int, default=10,
                               help='Only include reads with mapping quality >= INT. [10]', required=False)
@@ -41,6 +58,12 @@ def parser_commandline_args():
                                    'position coverage file which filename is provided by --output-cvg.')
     basetype_cmd.add_argument('--output-cvg', dest='outcvg', type=str, required=True,
                               help='Output position coverage file.')
+    basetype_cmd.add_argument('--vcf-mode', dest='vcf_mode', type=str, default='vcf',
+                              choices=['vcf', 'sites', 'bcf', 'bcf-sites'],
+                              help='Format of --output-vcf. "sites": VCF with INFO but without the FORMAT of '
+                                   'samples. "bcf": BCF with the FORMAT of samples, --output-vcf must end with '
+                                   '".bcf" and it will be indexed by CSI. "bcf-sites": BCF without the FORMAT of '
+                                   'samples. [vcf]')
 
     basetype_cmd.add_argument('--positions', metavar='position-list-file', type=str, dest='positions',
                               help='skip unlisted positions one per row. The position format in the file could '
@@ -57,6 +80,31 @@ def parser_commandline_args():
                               help='INT simples per batchfile. [500]')
     basetype_cmd.add_argument('--nCPU', dest='nCPU', metavar='INT', type=int, default=1,
                               help='Number of processer to use. [1]')
+    basetype_cmd.add_argument('--calling-threads', dest='calling_threads', metavar='INT', type=int, default=1,
+                              help='Number of threads for calling variants in each process. All the threads '
+                                   'share the same data in memory. [1]')
+    basetype_cmd.add_argument('--io-threads', dest='io_threads', metavar='INT', type=int, default=0,
+                              help='Number of htslib threads shared by all the alignment files in each process '
+                                   'for BAM/CRAM decompression. It\'s independent of --nCPU, each process has '
+                                   'its own threads. [0]')
+    basetype_cmd.add_argument('--max-open-files', dest='max_open_files', metavar='INT', type=int, default=512,
+                              help='Maximum number of alignment files keeping opened (with their index) in each '
+                                   'process, so that they could be reused by the next chromosome without opening '
+                                   'again. Make sure it\'s smaller than `ulimit -n`. [512]')
+    basetype_cmd.add_argument('--without-batchfile', dest='without_batchfile', action='store_true',
+                              help='Load the alignment files and call variants window by window without '
+                                   'creating batchfiles.')
+    basetype_cmd.add_argument('--memory-budget', dest='memory_budget', metavar='INT', type=int, default=4096,
+                              help='Memory (MB) for loading a window of positions in each process when setting '
+                                   '--without-batchfile, the regions will be tiled into windows by it. [4096]')
+    basetype_cmd.add_argument('--window-size', dest='window_size', metavar='INT', type=int, default=0,
+                              help='Split the regions into windows of INT positions and the --nCPU processes '
+                                   'take them one by one from a work queue, which keeps all the processes busy '
+                                   'even if the coverage is uneven. Split the regions evenly into --nCPU parts '
+                                   'if 0. [0]')
+    basetype_cmd.add_argument('--weight-by-index', dest='weight_by_index', action='store_true',
+                              help='Estimate the reads in each window by the BAM index of some input files, and '
+                                   'put the heaviest windows into the work queue first. Only for --window-size.')
     basetype_cmd.add_argument('-m', '--min-af', dest='min_af', type=float, metavar='float', default=0.001,
                               help='Setting prior precision of MAF and skip uneffective caller positions. Usually '
                                    'you can set it to be min(0.001, 100/x), x is the number of your input BAM files.'
@@ -101,10 +149,13 @@ def parser_commandline_args():
                               action='store', type=int, default=1, required=False)
 
     basetype_cmd.add_argument('--smart-rerun', dest='smartrerun', action='store_true',
-                              help='Rerun process by checking batchfiles.')
+                              help='Rerun process by checking batchfiles. With --window-size, only the windows '
+                                   'which are not in the checkpoint manifest (<outcvg>.manifest) of the last run '
+                                   'are called again.')
 
     basetype_cmd.add_argument("--verbosity", dest="verbosity", action='store', type=int, default=1,
                               help="Level of logging(1,3). [1]")
+    add_bgzf_output_arguments(basetype_cmd)
 
     # VQSR commands
     vqsr_cmd = commands.add_parser('VQSR', help='Variants quality recalibrate.')
@@ -114,6 +165,25 @@ def parser_commandline_args():
                           help='Traning data set at true category.')
     vqsr_cmd.add_argument('-O', '--output', dest='output_vcf_file_name', metavar='VCF', type=str, required=True,
                           help='Output VCF file after VQSR.')
+    vqsr_cmd.add_argument('--nCPU', dest='nCPU', metavar='INT', type=int, default=1,
+                          help='Number of processes for fitting the Gaussian mixture models of different '
+                               'number of gaussians at the same time. [1]')
+    vqsr_cmd.add_argument('--selection-subsample', dest='selection_subsample', metavar='INT', type=int, default=0,
+                          help='Select the number of gaussians on a stratified subsample of INT training '
+                               'variants, then fit the selected model on all of them. Use all the training '
+                               'variants if 0. [0]')
+    vqsr_cmd.add_argument('--seed', dest='seed', metavar='INT', type=int, default=None,
+                          help='Random seed for fitting the models and subsampling, the models are the same '
+                               'no matter how many processes are used with the same seed.')
+    vqsr_cmd.add_argument('--streaming', dest='streaming', action='store_true',
+                          help='Bounded memory for very large callsets: read the VCF twice, train the models '
+                               'on samples of the variants in the first pass, then score and output the '
+                               'variants chunk by chunk in the second pass.')
+    vqsr_cmd.add_argument('--reservoir-size', dest='reservoir_size', metavar='INT', type=int, default=2000000,
+                          help='Number of variants sampled uniformly for training the bad model with '
+                               '--streaming, the training sites are sampled separately up to 500000. '
+                               '[2000000]')
+    add_bgzf_output_arguments(vqsr_cmd)
 
     # ApplyVQSR commands
     apply_vqsr_cmd = commands.add_parser('ApplyVQSR', help='Apply a score cutoff to filter variants based '
@@ -124,6 +194,10 @@ def parser_commandline_args():
                                      'annotated with its VQSLOD. Required')
     apply_vqsr_cmd.add_argument('--ts', dest='truth_sensitivity_level', metavar='float', type=float, default=0.95,
                                 help='The truth sensitivity level at which to start filtering. default=0.95')
+    apply_vqsr_cmd.add_argument('--nCPU', dest='nCPU', metavar='INT', type=int, default=1,
+                                help='Number of processes for filtering the chunks of a BGZF or plain text '
+                                     'VCF at the same time. [1]')
+    add_bgzf_output_arguments(apply_vqsr_cmd)
 
     # Merge files
     merge_cmd = commands.add_parser('merge', help='Merge bed/vcf files')
@@ -132,6 +206,7 @@ def parser_commandline_args():
     merge_cmd.add_argument('-L', '--file-list', dest='infilelist', metavar='FILE', help='Input files\' list.')
     merge_cmd.add_argument('-O', '--outputfile', dest='outputfile', metavar='FILE', required=True,
                            help='Output file')
+    add_bgzf_output_arguments(merge_cmd)
 
     return cmdparse.parse_args()
 
@@ -160,6 +235,11 @@ def basetype(args):
         sys.stderr.write("[ERROR] Missing input BAM/CRAM files.\n\n")
         sys.exit(1)
 
+    if args.outvcf and ("bcf" in args.vcf_mode) != args.outvcf.endswith(".bcf"):
+        sys.stderr.write("[ERROR] --output-vcf must end with '.bcf' if and only if --vcf-mode is 'bcf' "
+                         "or 'bcf-sites'.\n\n")
+        sys.exit(1)
+
     # The main function
     bt = BaseTypeRunner(args)
     is_success = bt.basevar_caller()
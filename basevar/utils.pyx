@@ -2,11 +2,15 @@ import sys
 import os
 import heapq
 import time
+from collections import deque
 
 import cProfile
 import pstats
 
+from basevar.io.BGZF.bgzf import concat_tabix_indexes, read_bgzf_block, inflate_bgzf_blocks, deflate_bgzf_blocks, \
+    BGZF_EOF, BGZF_EMPTY_BLOCK_SIZE
 from basevar.io.BGZF.tabix import tabix_index
+from basevar.io.bcf import merge_bcf_files
 from basevar.io.fasta cimport FastaFile
 from basevar.io.openfile import Open, FileForQueueing
 
@@ -109,8 +113,8 @@ def get_last_modification_file(bytes dirname):
         # dirname is empty
         return ""
 
-def vcf_header_define(ref_file_path, info=None, samples=None):
-    """define header for VCF"""
+def vcf_header_define(ref_file_path, info=None, samples=None, sites_only=False):
+    """define header for VCF, without FORMAT and samples if ``sites_only``"""
 
     if not samples:
         samples = []
@@ -118,14 +122,15 @@ def vcf_header_define(ref_file_path, info=None, samples=None):
     fa = FastaFile(ref_file_path, ref_file_path + ".fai")
     fa_name = os.path.basename(fa.filename)
     contigs = ["##contig=<ID=%s,length=%d,assembly=%s>" % (c, s, fa_name) for c, s in zip(fa.refnames, fa.lengths)]
-    header = [
-        '##fileformat=VCFv4.2',
-        '##FILTER=<ID=LowQual,Description="Low quality (QUAL < 60)">',
+    formats = [] if sites_only else [
         '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
         '##FORMAT=<ID=AB,Number=1,Type=String,Description="Allele Base">',
         '##FORMAT=<ID=SO,Number=1,Type=String,Description="Strand orientation of the mapping base. Marked as + or -">',
-        '##FORMAT=<ID=BP,Number=1,Type=String,Description="Base Probability which calculate by base quality">',
-
+        '##FORMAT=<ID=BP,Number=1,Type=String,Description="Base Probability which calculate by base quality">'
+    ]
+    header = [
+        '##fileformat=VCFv4.2',
+        '##FILTER=<ID=LowQual,Description="Low quality (QUAL < 60)">'] + formats + [
         '##INFO=<ID=CM_AF,Number=A,Type=Float,Description="An ordered, comma delimited list of allele frequencies base on LRT algorithm">',
         '##INFO=<ID=CM_CAF,Number=A,Type=Float,Description="An ordered, comma delimited list of allele frequencies just base on read count">',
         '##INFO=<ID=CM_AC,Number=A,Type=Integer,Description="An ordered, comma delimited allele depth in CMDB">',
@@ -140,7 +145,7 @@ def vcf_header_define(ref_file_path, info=None, samples=None):
         '##INFO=<ID=QD,Number=1,Type=Float,Description="Variant Confidence Quality by Depth">',
         '\n'.join([info] + contigs if info else contigs),
         '##reference=file://{}'.format(os.path.realpath(fa.filename)),
-        '\t'.join(['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT'] + samples)
+        '\t'.join(['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO'] + ([] if sites_only else ['FORMAT'] + samples))
     ]
 
     fa.close()
@@ -207,6 +212,40 @@ cdef list generate_regions_by_process_num(list regions, int process_num, bint co
     else:
         return regions_for_each_process
 
+cdef list generate_windows(list regions, long int window_size):
+    """Split ``regions`` ([[chrid, start, end], ...], 1-base) into small windows for the work queue.
+
+    Each window is a list of regions in the same chromosome with at most ``window_size`` positions,
+    and the windows keep the order of ``regions``.
+    """
+    cdef list windows = []
+    cdef list window = []
+    cdef long int window_len = 0
+    cdef long int start, end, sub_end
+    for chrid, start, end in regions:
+
+        # Never put different chromosomes into one window
+        if window and window[-1][0] != chrid:
+            windows.append(window)
+            window = []
+            window_len = 0
+
+        while start <= end:
+            if window_len == window_size:
+                windows.append(window)
+                window = []
+                window_len = 0
+
+            sub_end = min(end, start + window_size - window_len - 1)
+            window.append([chrid, start, sub_end])
+            window_len += sub_end - start + 1
+            start = sub_end + 1
+
+    if window:
+        windows.append(window)
+
+    return windows
+
 def fetch_next(iter_fh):
     """
     re-define the next funtion of fetching info from pysam
@@ -426,7 +465,7 @@ cdef void fast_merge_files(list temp_file_names, basestring final_file_name, bin
                 os.remove(file_name)
     return
 
-def merge_files(temp_file_names, final_file_name, is_del_raw_file=False):
+def merge_files(temp_file_names, final_file_name, is_del_raw_file=False, compress_level=None, threads=0):
     """
     Merging output VCF/CVG files into a final big one
     """
@@ -434,7 +473,9 @@ def merge_files(temp_file_names, final_file_name, is_del_raw_file=False):
     if final_file_name == "-":
         output_file = sys.stdout
     else:
-        output_file = Open(final_file_name, 'wb', isbgz=True if final_file_name.endswith(".gz") else False)
+        # Build tabix index along the way for BGZF file
+        output_file = Open(final_file_name, 'wb', isbgz=True if final_file_name.endswith(".gz") else False,
+                           tabix=final_file_name.endswith(".gz"), compress_level=compress_level, threads=threads)
 
     the_heap = []
 
@@ -481,12 +522,203 @@ def merge_files(temp_file_names, final_file_name, is_del_raw_file=False):
 
     return
 
+
+def _scan_bgzf_file(file_name, tail_block_num=4):
+    """Find out the layout of a BGZF VCF/CVG file without decompressing the whole file.
+
+    Return a dict with:
+        ``header``: the header lines
+        ``head_data``: data lines in the blocks of header, they will be compressed again. It's
+                       empty if the header ends at the end of a block, as ``TabixBGZFile`` writes
+        ``data_start``: offset of the first block after the header blocks
+        ``data_end``: offset of the EOF marker or the end of file
+        ``first``, ``last``: (chrom, position) of the first and the last data lines, None if no data
+
+    Return None if it's not a BGZF file or the last line is longer than ``tail_block_num`` blocks.
+    """
+    header, buf, first_data = [], b"", b""
+    cdef bint in_header = True
+    cdef long int offset = 0, data_start = 0, tail_offset = 0, size
+    cdef int block_num_after_header = 0
+    tail = deque(maxlen=tail_block_num)  # The last non-empty blocks: (offset, size)
+
+    with open(file_name, "rb") as fh:
+        try:
+            while True:
+                size, block = read_bgzf_block(fh, skip=not in_header)
+                if size == 0:
+                    break
+
+                if size > BGZF_EMPTY_BLOCK_SIZE:
+                    if in_header:
+                        data = inflate_bgzf_blocks(block)
+                        if header and not buf and not data.startswith(b"#"):
+                            # The header ends at the end of the last block as ``TabixBGZFile``
+                            # writes, all the data blocks could be copied.
+                            in_header = False
+                            data_start = offset
+                            first_data = data
+                            tail.append((offset, size))
+                            block_num_after_header += 1
+                            offset += size
+                            continue
+
+                        buf += data
+                        while buf.startswith(b"#") and b"\n" in buf:
+                            line, buf = buf.split(b"\n", 1)
+                            header.append(line + b"\n")
+
+                        # Header is done and the first data line is complete
+                        if buf and not buf.startswith(b"#") and b"\n" in buf:
+                            in_header = False
+                            data_start = offset + size
+                    else:
+                        tail.append((offset, size))
+                        block_num_after_header += 1
+
+                offset += size
+
+        except ValueError:
+            return None
+
+        if in_header:
+            data_start = offset
+
+        tail_data = []
+        for tail_offset, size in tail:
+            fh.seek(tail_offset)
+            tail_data.append(inflate_bgzf_blocks(fh.read(size)))
+
+        fh.seek(max(0, offset - BGZF_EMPTY_BLOCK_SIZE))
+        data_end = offset - BGZF_EMPTY_BLOCK_SIZE if fh.read() == BGZF_EOF else offset
+
+    text = b"".join(tail_data).rstrip(b"\n")
+    if block_num_after_header <= tail_block_num:
+        text = (buf + b"".join(tail_data)).rstrip(b"\n")
+    elif b"\n" not in text:
+        return None
+
+    first = last = None
+    if text:
+        col = (buf or first_data).split(b"\t", 2)
+        first = (col[0], int(col[1]))
+        col = text.rsplit(b"\n", 1)[-1].split(b"\t", 2)
+        last = (col[0], int(col[1]))
+
+    return {"header": header, "head_data": buf, "data_start": data_start, "data_end": data_end,
+            "first": first, "last": last}
+
+
+def _is_in_order(list layouts):
+    """The files must not overlap with each other and in order by their (chrom, position)."""
+    seen_chroms = set()
+    last = None
+    for layout in layouts:
+        if layout["first"] is None:
+            continue
+
+        first = layout["first"]
+        if last is not None:
+            if first[0] == last[0]:
+                if first[1] <= last[1]:
+                    return False
+            elif first[0] in seen_chroms:
+                return False
+
+        if first[0] == layout["last"][0] and first[1] > layout["last"][1]:
+            return False
+
+        seen_chroms.update([first[0], layout["last"][0]])
+        last = layout["last"]
+
+    return True
+
+
+def concat_bgzf_files(temp_file_names, final_file_name, is_del_raw_file=False, compress_level=None,
+                      tabix=False):
+    """
+    Merging BGZF VCF/CVG files which are already in order and not overlap with each other
+    by concatenating their BGZF blocks directly, only the blocks of header are compressed again.
+
+    Set ``tabix`` to create the tabix index of ``final_file_name``. The indexes of the files are
+    merged if all of them have been written by ``TabixBGZFile``, or the index is created by
+    ``tabix_index`` after concatenating.
+
+    Return False and do nothing if any of the files is not BGZF or they are not in order, use
+    ``merge_files`` in that case.
+    """
+    layouts = []
+    for file_name in temp_file_names:
+        layout = _scan_bgzf_file(file_name)
+        if layout is None:
+            sys.stderr.write("[INFO] %s is not a BGZF file, can't be concatenated.\n" % file_name)
+            return False
+
+        layouts.append(layout)
+
+    if not _is_in_order(layouts):
+        sys.stderr.write("[INFO] Files are not in order or overlap with each other, can't be concatenated: "
+                         "%s\n" % ",".join(temp_file_names))
+        return False
+
+    # The records of each file are all in the copied blocks if its header ends at the end of a block
+    index_files = [f + ".tbi" for f in temp_file_names]
+    cdef bint is_merge_index = tabix and all([not layout["head_data"] and os.path.isfile(f)
+                                              for layout, f in zip(layouts, index_files)])
+    cdef list shifts = []
+
+    cdef long int remain
+    level = -1 if compress_level is None else compress_level
+    with open(final_file_name, "wb") as OUT:
+        for index, (file_name, layout) in enumerate(zip(temp_file_names, layouts)):
+            if index == 0:
+                OUT.write(deflate_bgzf_blocks(b"".join(layout["header"]) + layout["head_data"], level))
+            elif layout["head_data"]:
+                OUT.write(deflate_bgzf_blocks(layout["head_data"], level))
+
+            # Copy the rest of blocks byte-for-byte
+            shifts.append(OUT.tell() - layout["data_start"])
+            remain = layout["data_end"] - layout["data_start"]
+            with open(file_name, "rb") as I:
+                I.seek(layout["data_start"])
+                while remain > 0:
+                    data = I.read(min(remain, 4 * 1024 * 1024))
+                    if not data:
+                        raise IOError("%s is truncated when concatenating" % file_name)
+
+                    OUT.write(data)
+                    remain -= len(data)
+
+        OUT.write(BGZF_EOF)
+
+    if is_merge_index:
+        concat_tabix_indexes(index_files, shifts, final_file_name + ".tbi")
+    elif tabix:
+        # Column indices are 0-based. Note: this is different from the tabix command line
+        # utility where column indices start at 1.
+        tabix_index(final_file_name, force=True, seq_col=0, start_col=1, end_col=1)
+
+    if is_del_raw_file:
+        for file_name, index_file in zip(temp_file_names, index_files):
+            os.remove(file_name)
+            if os.path.isfile(index_file):
+                os.remove(index_file)
+
+    return True
+
+
 def merge_batch_files(temp_file_names, final_file_name, output_isbgz=False, is_del_raw_file=False, justbase=False):
     """
     Merging output batch files into a final big one.
 
     ``temp_file_names``: must contain the same positions but different samples per file
     """
+    from basevar.io.batchfile import BATCHFILE_SUFFIX, merge_batchfiles
+    if all([f.endswith(BATCHFILE_SUFFIX) for f in temp_file_names]):
+        # Binary batchfiles are merged column by column, ``output_isbgz`` and ``justbase`` are useless.
+        merge_batchfiles(list(temp_file_names), final_file_name, is_del_raw_file=is_del_raw_file)
+        return
+
     # Final output file
     if final_file_name == "-":
         output_file = sys.stdout
@@ -624,22 +856,32 @@ def load_popgroup_info(samples, in_popgroup_file):
 
     return popgroup
 
-def output_cvg_and_vcf(sub_cvg_files, sub_vcf_files, outcvg, outvcf=None):
+def output_cvg_and_vcf(sub_cvg_files, sub_vcf_files, outcvg, outvcf=None, compress_level=None, threads=0):
     """CVG file and VCF file could use the same tabix strategy."""
     for out_final_file, sub_file_list in zip([outcvg, outvcf], [sub_cvg_files, sub_vcf_files]):
 
         if out_final_file:
-            output_file(sub_file_list, out_final_file, del_raw_file=True)
+            output_file(sub_file_list, out_final_file, del_raw_file=True, compress_level=compress_level,
+                        threads=threads)
 
     return
 
-def output_file(sub_files, out_file_name, del_raw_file=False):
-    if out_file_name.endswith(".gz"):
-        merge_files(sub_files, out_file_name, is_del_raw_file=del_raw_file)
-
-        # Column indices are 0-based. Note: this is different from the tabix command line
-        # utility where column indices start at 1.
-        tabix_index(out_file_name, force=True, seq_col=0, start_col=1, end_col=1)
+def output_file(sub_files, out_file_name, del_raw_file=False, compress_level=None, threads=0):
+    if out_file_name.endswith(".bcf"):
+        # The CSI index is built after merging
+        merge_bcf_files(sub_files, out_file_name, is_del_raw_file=del_raw_file, compress_level=compress_level,
+                        threads=threads)
+    elif out_file_name.endswith(".gz"):
+        # The per-process files are in order most of the time, just concatenate their BGZF blocks
+        # and tabix indexes
+        if not concat_bgzf_files(sub_files, out_file_name, is_del_raw_file=del_raw_file,
+                                 compress_level=compress_level, tabix=True):
+            # The tabix index is built while merging
+            merge_files(sub_files, out_file_name, is_del_raw_file=del_raw_file, compress_level=compress_level,
+                        threads=threads)
+            if del_raw_file:
+                for f in sub_files:
+                    safe_remove(f + ".tbi")
     else:
         merge_files(sub_files, out_file_name, is_del_raw_file=del_raw_file)
 
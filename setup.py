@@ -64,15 +64,16 @@ MOD_NAMES = [
     CALLER_PRE + '.io.libcutils',
     CALLER_PRE + '.io.openfile',
     CALLER_PRE + '.io.fasta',
-    CALLER_PRE + '.io.bam',
     CALLER_PRE + '.io.read',
     CALLER_PRE + '.caller.basetype',
     CALLER_PRE + '.caller.batch',
+    CALLER_PRE + '.caller.cvg',
     CALLER_PRE + '.caller.batchcaller',
     CALLER_PRE + '.caller.variantcaller',
     CALLER_PRE + '.caller.basetypeprocess',
     CALLER_PRE + '.caller.launch',
     CALLER_PRE + '.caller.do',
+    CALLER_PRE + '.caller.manifest',
 
     # For VQSR
     CALLER_PRE + '.caller.vqsr.vcfutils',
@@ -94,6 +95,9 @@ if __name__ == "__main__":
     # extension for htslib!
     htslib_mod = [
         CALLER_PRE + '.io.htslibWrapper',
+        CALLER_PRE + '.io.bam',
+        CALLER_PRE + '.io.batchfile',
+        CALLER_PRE + '.io.bcf',
         CALLER_PRE + '.io.BGZF.bgzf',
         CALLER_PRE + '.io.BGZF.tabix',
     ]
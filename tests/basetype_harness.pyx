@@ -0,0 +1,130 @@
+"""Harness of BaseType, BaseTypeEngine and PopGroupEngine for tests, which creates them by Python
+lists of bases and qualities.
+"""
+from libc.stdlib cimport calloc, free
+
+from basevar.caller.basetype cimport BaseType, BaseTypeEngine, PopGroupEngine
+
+
+cdef BaseType _new_basetype(bytes ref_base, list bases, list quals, float min_af, bint compress):
+    """Create BaseType by Python lists of bases and phred-scale base qualities"""
+    cdef int sample_size = len(bases)
+    cdef char **sample_bases = <char**>(calloc(sample_size, sizeof(char*)))
+    assert sample_bases != NULL, "Could not allocate memory for sample_bases in _new_basetype."
+
+    cdef int *sample_quals = <int*>(calloc(sample_size, sizeof(int)))
+    assert sample_quals != NULL, "Could not allocate memory for sample_quals in _new_basetype."
+
+    cdef int i
+    for i in range(sample_size):
+        sample_bases[i] = bases[i]
+        sample_quals[i] = quals[i]
+
+    cdef BaseType bt = BaseType()
+    bt.cinit(ref_base, sample_bases, sample_quals, sample_size, min_af, compress)
+
+    free(sample_bases)
+    free(sample_quals)
+
+    return bt
+
+
+def basetype_by_site(bytes ref_base, list bases, list quals, float min_af, list specific_base_comb=None,
+                     bint use_engine=True, bint compress=False):
+    """Calculate LRT for one position.
+
+    ``bases``, ``quals``: Bases and phred-scale base qualities of all the samples.
+    ``use_engine``: Use ``BaseTypeEngine`` or ``BaseType.lrt``.
+    ``compress``: Run EM over (base, base quality) classes instead of samples.
+
+    Return a tuple of (is_variant, alt_bases, af_by_lrt, var_qual)
+    """
+    cdef BaseType bt = _new_basetype(ref_base, bases, quals, min_af, compress)
+
+    cdef BaseTypeEngine engine = BaseTypeEngine(bt.lik_row_num)
+    cdef bint is_variant
+    if use_engine:
+        is_variant = engine.lrt(bt, specific_base_comb)
+    else:
+        # ``engine`` is only used if the likelihood is compressed
+        is_variant = bt.lrt(specific_base_comb, engine)
+
+    return is_variant, bt.alt_bases, bt.af_by_lrt, bt.var_qual
+
+
+def basetype_by_sites(bytes ref_base, list sites, float min_af, int thread_num=1, bint compress=True):
+    """Calculate LRT for a block of positions by ``BaseTypeEngine.lrt_block``.
+
+    ``sites``: A list of (bases, quals) for each position.
+    ``thread_num``: The number of threads to run EM.
+
+    Return a list of (is_variant, alt_bases, af_by_lrt, var_qual) in the same order of ``sites``
+    """
+    cdef list bts = [_new_basetype(ref_base, bases, quals, min_af, compress) for bases, quals in sites]
+    cdef BaseTypeEngine engine = BaseTypeEngine(thread_num=thread_num)
+    cdef list is_variants = engine.lrt_block(bts, None)
+    engine.close()
+
+    cdef BaseType bt
+    return [(is_variant, bt.alt_bases, bt.af_by_lrt, bt.var_qual) for is_variant, bt in zip(is_variants, bts)]
+
+
+def group_basetype_by_site(bytes ref_base, list bases, list quals, float min_af, dict popgroup,
+                           list specific_base_comb, bint one_pass=True):
+    """Calculate LRT for each population group of one position by ``PopGroupEngine``.
+
+    ``popgroup``: group_id => [a list samples_index]
+    ``one_pass``: Gather all the groups in one pass or copy the data group by group.
+
+    Return a dict of group_id => (alt_bases, af_by_lrt, qual_pvalue of the samples in the group)
+    """
+    cdef int sample_size = len(bases)
+    cdef char **sample_bases = <char**>(calloc(sample_size, sizeof(char*)))
+    assert sample_bases != NULL, "Could not allocate memory for sample_bases in group_basetype_by_site."
+
+    cdef int *sample_quals = <int*>(calloc(sample_size, sizeof(int)))
+    assert sample_quals != NULL, "Could not allocate memory for sample_quals in group_basetype_by_site."
+
+    cdef int i
+    for i in range(sample_size):
+        sample_bases[i] = bases[i]
+        sample_quals[i] = quals[i]
+
+    cdef PopGroupEngine group_engine = PopGroupEngine(popgroup, sample_size)
+    cdef list group_bts
+    if one_pass:
+        group_bts = group_engine.basetypes(ref_base, sample_bases, sample_quals, min_af)
+    else:
+        group_bts = group_engine._gather_basetypes(ref_base, sample_bases, sample_quals, min_af)
+
+    free(sample_bases)
+    free(sample_quals)
+
+    BaseTypeEngine().lrt_block(group_bts, [specific_base_comb] * len(group_bts))
+
+    cdef BaseType bt
+    return {group: (bt.alt_bases, bt.af_by_lrt, [bt.qual_pvalue[i] for i in range(len(popgroup[group]))])
+            for group, bt in zip(group_engine.groups, group_bts)}
+
+
+def prescreen_by_site(bytes ref_base, list bases, list quals, float min_af):
+    """Return True if the position could be skipped by the pre-screen of ``BaseTypeEngine``."""
+    cdef int sample_size = len(bases)
+    cdef char **sample_bases = <char**>(calloc(sample_size, sizeof(char*)))
+    assert sample_bases != NULL, "Could not allocate memory for sample_bases in prescreen_by_site."
+
+    cdef int *sample_quals = <int*>(calloc(sample_size, sizeof(int)))
+    assert sample_quals != NULL, "Could not allocate memory for sample_quals in prescreen_by_site."
+
+    cdef int i
+    for i in range(sample_size):
+        sample_bases[i] = bases[i]
+        sample_quals[i] = quals[i]
+
+    cdef BaseTypeEngine engine = BaseTypeEngine()
+    cdef bint is_non_variant = engine.is_non_variant(ref_base, sample_bases, sample_quals, sample_size, min_af)
+
+    free(sample_bases)
+    free(sample_quals)
+
+    return is_non_variant
@@ -0,0 +1,28 @@
+"""Benchmark of the calling stage (EM, rank sum tests, FS/SOR and the records) by the threads
+
+Usage: python benchmark_calling.py [position_num] [sample_num] [variant_rate]
+"""
+import sys
+
+import pyxharness  # Build the harness by pyximport
+from calling_harness import calling
+
+
+def benchmark_calling(position_num, sample_num, variant_rate):
+    single = None
+    for thread_num in [1, 2, 4]:
+        cvg, vcf, elapsed = calling(position_num=position_num, sample_num=sample_num, thread_num=thread_num,
+                                    variant_rate=variant_rate)
+        single = single or elapsed
+        print("Calling %d positions of %d samples (%d variants) by %d threads: %.3f s (%.2fx)" % (
+            position_num, sample_num, vcf.count(b"\n"), thread_num, elapsed, single / elapsed))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark_calling(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+                          float(sys.argv[3]) if len(sys.argv) > 3 else 0.1)
+    else:
+        benchmark_calling(1000, 1000, 0.01)
+        benchmark_calling(1000, 1000, 0.1)
+        benchmark_calling(1000, 10000, 0.1)
@@ -0,0 +1,23 @@
+"""Benchmark of outputting CVG records: CVGWriter vs. the Python formatter it replaced
+
+Usage: python benchmark_cvg_writer.py [position_num] [sample_num]
+"""
+import sys
+
+import pyxharness  # Build the harness by pyximport
+from cvg_harness import benchmark
+
+
+def benchmark_cvg_writer(position_num, sample_num):
+    native, python = benchmark(position_num=position_num, sample_num=sample_num)
+    print("CVG records of %d samples: CVGWriter %.0f lines/s, Python formatter %.0f lines/s (%.1fx)" % (
+        sample_num, native, python, native / python))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark_cvg_writer(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    else:
+        benchmark_cvg_writer(200000, 100)
+        benchmark_cvg_writer(200000, 1000)
+        benchmark_cvg_writer(20000, 100000)
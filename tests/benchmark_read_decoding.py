@@ -0,0 +1,31 @@
+"""Benchmark of decoding reads from BAM/CRAM: per-read malloc/free vs. ReadArena
+
+Usage: python benchmark_read_decoding.py in.bam chr:start-end [repeat]
+"""
+import sys
+
+import pyxharness  # Build the harness by pyximport
+from read_decoding_harness import benchmark_read_decoding
+
+
+def benchmark(bamfile, region, repeat=3):
+
+    for use_arena, name in [(False, "malloc/free"), (True, "ReadArena")]:
+        best = None
+        for _ in range(repeat):
+            read_num, elapsed = benchmark_read_decoding(bamfile, region, use_arena)
+            if best is None or elapsed < best:
+                best = elapsed
+
+        print("%-12s %d reads, %.3f seconds, %.0f reads/s" % (
+            name, read_num, best, read_num / best if best > 0 else 0.0))
+
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__ + "\n")
+        sys.exit(1)
+
+    benchmark(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 3)
@@ -0,0 +1,78 @@
+"""Harness of the calling stage for tests and benchmark: ``_basetypeprocess`` on a synthetic chunk
+of ``BatchInfo``, by the threads of ``BaseTypeEngine``.
+"""
+import io
+import random
+import time
+
+from basevar.caller.batch cimport BatchInfo
+from basevar.caller.basetype cimport BaseTypeEngine, PopGroupEngine
+from basevar.caller.cvg cimport CVGWriter
+from basevar.caller.variantcaller cimport _basetypeprocess
+
+cdef list BASE = [b"A", b"C", b"G", b"T"]
+cdef list OTHER_BASES = [b"N", b"+AT", b"-C"]
+
+
+cdef list _synthetic_chunk(int position_num, int sample_num, double variant_rate):
+    """``BatchInfo`` of ``position_num`` positions, about ``variant_rate`` of them have an ALT base
+    in 10%-40% of the samples, the others only have sequencing errors.
+    """
+    cdef list batchinfos = []
+    cdef BatchInfo batchinfo
+    cdef bytes ref_base, alt_base, b
+    cdef double alt_freq, r
+    cdef int i, k
+    for k in range(position_num):
+        ref_base = random.choice(BASE)
+        alt_base = random.choice([x for x in BASE if x != ref_base])
+        alt_freq = random.uniform(0.1, 0.4) if random.random() < variant_rate else 0.0
+
+        batchinfo = BatchInfo(b"chr1", position=k + 1, ref_base=ref_base, size=sample_num)
+        for i in range(sample_num):
+            r = random.random()
+            if r < 0.02:
+                b = random.choice(OTHER_BASES)
+            elif r < 0.03:
+                b = random.choice(BASE)
+            elif r < 0.03 + alt_freq:
+                b = alt_base
+            else:
+                b = ref_base
+
+            batchinfo.sample_bases[i] = b
+            batchinfo.strands[i] = b'.' if b[0] == b'N' else b'+' if random.random() < 0.5 else b'-'
+            batchinfo.sample_base_quals[i] = random.randint(2, 40)
+            batchinfo.mapqs[i] = random.randint(0, 60)
+            batchinfo.read_pos_rank[i] = random.randint(1, 150)
+            if b[0] != b'-' and b[0] != b'+' and b[0] != b'N':
+                batchinfo.depth += 1
+
+        batchinfos.append(batchinfo)
+
+    return batchinfos
+
+
+def calling(int position_num=1000, int sample_num=500, int thread_num=1, double variant_rate=0.1,
+            int group_num=3, bint sites_only=False, seed=10):
+    """Call a synthetic chunk by ``_basetypeprocess`` with ``thread_num`` threads.
+
+    Return (CVG records, VCF records, seconds of ``_basetypeprocess``).
+    """
+    random.seed(seed)
+    cdef list batchinfos = _synthetic_chunk(position_num, sample_num, variant_rate)
+    cdef PopGroupEngine group_engine = PopGroupEngine(
+        {b"G%d" % g: list(range(g, sample_num, group_num)) for g in range(group_num)}, sample_num)
+    cdef BaseTypeEngine engine = BaseTypeEngine(thread_num=thread_num)
+
+    out_cvg = io.BytesIO()
+    out_vcf = io.BytesIO()
+    cdef CVGWriter cvg_writer = CVGWriter(out_cvg)
+
+    start_time = time.time()
+    _basetypeprocess(batchinfos, group_engine, 0.001, engine, cvg_writer, out_vcf, sites_only)
+    elapsed = time.time() - start_time
+
+    cvg_writer.flush()
+    engine.close()
+    return out_cvg.getvalue(), out_vcf.getvalue(), elapsed
@@ -0,0 +1,12 @@
+"""pytest configuration of the tests.
+
+``tests`` is a package, so pytest puts the root of the repository into ``sys.path`` instead of this
+directory. The tests import ``pyxharness``, the harnesses and each other by their plain module names,
+which works for both ``pytest`` and ``python tests/test_xxx.py``.
+"""
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+if TESTS_DIR not in sys.path:
+    sys.path.insert(0, TESTS_DIR)
@@ -0,0 +1,147 @@
+"""Harness of CVGWriter for tests and benchmark: the Python formatter of CVG records which is
+replaced by ``CVGWriter`` and a synthetic stream of ``BatchInfo``.
+"""
+import io
+import random
+import time
+
+from basevar.caller.algorithm cimport strand_bias
+from basevar.caller.batch cimport BatchInfo
+from basevar.caller.basetype cimport PopGroupEngine
+from basevar.caller.cvg cimport CVGWriter
+
+cdef list BASE = ['A', 'C', 'G', 'T']
+
+
+cdef list _python_base_depth_and_indel(char ** bases, int size):
+    # coverage info for each position
+    cdef dict base_depth = {b: 0 for b in BASE}
+    cdef dict indel_depth = {}
+
+    cdef int i = 0
+    for i in range(size):
+
+        # The size of `base[i]` would be 1 except indel!
+        if bases[i][0] == 'N':
+            continue
+
+        if bases[i] in base_depth:
+            # ignore all bases('*') which not match ``cmm.BASE``
+            base_depth[bases[i]] += 1
+        else:
+            # Indel
+            indel_depth[bases[i]] = indel_depth.get(bases[i], 0) + 1
+
+    cdef bytes indels = bytes(','.join(
+        [k + '|' + str(v) for k, v in indel_depth.items()]
+    ) if indel_depth else ".")
+
+    return [base_depth, indels]
+
+cdef void _python_cvg_record(BatchInfo batchinfo, PopGroupEngine group_engine, out_file_handle):
+    """The Python formatter of CVG records which is replaced by ``CVGWriter``, as the reference
+    of ``benchmark``.
+    """
+    # coverage info for each position
+    cdef dict base_depth
+    cdef bytes indels
+    base_depth, indels = _python_base_depth_and_indel(batchinfo.sample_bases, batchinfo.size)
+
+    cdef double fs, sor
+    cdef int ref_fwd, ref_rev, alt_fwd, alt_rev
+    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = 0, -1, 0, 0, 0, 0
+
+    cdef bytes ref_base = batchinfo.ref_base
+    cdef bytes b1, b2
+    if sum(base_depth.values()) > 0:
+        base_sorted = sorted([(b, base_depth[b]) for b in BASE], key=lambda x: x[1], reverse=True)
+        b1, b2 = base_sorted[0][0], base_sorted[1][0]
+
+        fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = strand_bias(
+            ref_base.upper(),  # reference
+            [b1 if b1 != ref_base.upper() else b2],  # alt-allele
+            batchinfo.sample_bases,
+            batchinfo.strands,
+            batchinfo.size
+        )
+
+    cdef list group_info
+    if sum(base_depth.values()):
+
+        group_info = []
+        for depth, indel in group_engine.base_depth_and_indel(batchinfo.sample_bases):
+            indel = [indel] if indel != "." else []
+            s = ':'.join(map(str, [depth[b] for b in BASE]) + indel)
+            group_info.append(s)
+
+        out_file_handle.write(
+            '\t'.join(
+                [batchinfo.chrid, str(batchinfo.position), ref_base, str(sum(base_depth.values()))] +
+                [str(base_depth[b]) for b in BASE] +
+                [indels] +
+                [str("%.3f" % fs), str("%.3f" % sor), ','.join(map(str, [ref_fwd, ref_rev, alt_fwd, alt_rev]))] +
+                group_info
+            ) + '\n'
+        )
+
+    return
+
+
+cdef list _synthetic_batchinfos(int batchinfo_num, int sample_num, list bases):
+    """``BatchInfo`` of random bases and strands, ``sample_bases`` point to the items of ``bases``."""
+    cdef list batchinfos = []
+    cdef BatchInfo batchinfo
+    cdef bytes b
+    cdef int i, k
+    for k in range(batchinfo_num):
+        batchinfo = BatchInfo(b"chr1", position=k + 1, ref_base=random.choice([b"A", b"C", b"G", b"T"]),
+                              size=sample_num)
+        for i in range(sample_num):
+            b = random.choice(bases)
+            batchinfo.sample_bases[i] = b
+            if b[0] == b'N':
+                batchinfo.strands[i] = b'.'
+            else:
+                batchinfo.strands[i] = b'+' if random.random() < 0.5 else b'-'
+            if b[0] != b'-' and b[0] != b'+' and b[0] != b'N':
+                batchinfo.depth += 1
+
+        batchinfos.append(batchinfo)
+
+    return batchinfos
+
+
+def benchmark(int position_num=2000, int sample_num=100, int group_num=3, seed=10):
+    """Lines per second of ``CVGWriter`` and the Python formatter it replaced on a synthetic stream of
+    ``BatchInfo``, the outputs must be the same. Return (lines/s of CVGWriter, lines/s of Python).
+    """
+    random.seed(seed)
+
+    # The bases of a position are mostly the same as each other, with some errors and indels.
+    cdef list bases = [b"A"] * 40 + [b"C", b"G", b"T", b"N", b"N", b"+AT", b"-C"]
+    cdef list batchinfos = _synthetic_batchinfos(64, sample_num, bases)
+    cdef PopGroupEngine group_engine = PopGroupEngine(
+        {"G%d" % g: list(range(g, sample_num, group_num)) for g in range(group_num)}, sample_num)
+
+    cdef BatchInfo batchinfo
+    cdef int i
+    out_native = io.BytesIO()
+    writer = CVGWriter(out_native)
+    start_time = time.time()
+    for i in range(position_num):
+        batchinfo = batchinfos[i % len(batchinfos)]
+        batchinfo.position = i + 1
+        (<CVGWriter> writer).write_record(batchinfo, group_engine)
+    writer.flush()
+    native_elapsed = time.time() - start_time
+
+    out_python = io.BytesIO()
+    start_time = time.time()
+    for i in range(position_num):
+        batchinfo = batchinfos[i % len(batchinfos)]
+        batchinfo.position = i + 1
+        _python_cvg_record(batchinfo, group_engine, out_python)
+    python_elapsed = time.time() - start_time
+
+    assert out_native.getvalue() == out_python.getvalue(), "CVGWriter is different from the Python formatter"
+    return position_num / max(native_elapsed, 1e-9), position_num / max(python_elapsed, 1e-9)
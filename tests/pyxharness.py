@@ -0,0 +1,22 @@
+"""Build the Cython harness modules of tests (``*_harness.pyx`` in this directory) by pyximport.
+
+The harnesses reach the C-level API (cdef classes and functions) of basevar which could not be
+called from Python, they are compiled against the source tree with the include directories of
+``setup.py`` and linked with htslib as the extensions of ``setup.py`` are. Set ``HTSLIB_LIBRARY_DIR``
+if libhts is not in the default library path. Import this module before importing any harness.
+"""
+import os
+
+import pyximport
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+INCLUDE_DIRS = [os.path.join(ROOT_DIR, "basevar", "caller"),
+                os.path.join(ROOT_DIR, "basevar", "io", "BGZF")]
+LIBRARIES = ["hts"]
+LIBRARY_DIRS = [d for d in os.environ.get("HTSLIB_LIBRARY_DIR", "").split(os.pathsep) if d]
+
+pyximport.install(setup_args={"include_dirs": INCLUDE_DIRS,
+                              "options": {"build_ext": {"libraries": LIBRARIES,
+                                                        "library_dirs": LIBRARY_DIRS}}},
+                  language_level=2)
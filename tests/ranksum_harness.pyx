@@ -0,0 +1,33 @@
+"""Harness of the rank sum tests for tests, which run them by Python lists of bases and annotations.
+"""
+from libc.stdlib cimport malloc, free
+
+from basevar.caller.algorithm cimport ref_vs_alt_ranksumtest, ref_vs_alt_ranksumtests
+
+
+def ranksumtests_by_site(bytes ref_base, list alt_bases, list bases, list mapqs, list read_pos_rank,
+                         list base_quals):
+    """Return the phred scale values of ``ref_vs_alt_ranksumtests`` for [mapqs, read_pos_rank, base_quals]
+    and the ones of ``ref_vs_alt_ranksumtest`` for each of them.
+    """
+    cdef int size = len(bases)
+    cdef char **sample_bases = <char **> malloc(max(1, size) * sizeof(char *))
+    cdef int *info = <int *> malloc(3 * max(1, size) * sizeof(int))
+    assert sample_bases != NULL and info != NULL, "Could not allocate memory in ranksumtests_by_site."
+
+    cdef int i, k
+    for i in range(size):
+        sample_bases[i] = bases[i]
+        info[i] = mapqs[i]
+        info[size + i] = read_pos_rank[i]
+        info[2 * size + i] = base_quals[i]
+
+    cdef double results[3]
+    ref_vs_alt_ranksumtests(ref_base, alt_bases, sample_bases, info, info + size, info + 2 * size, size, results)
+    cdef list by_histogram = [results[k] for k in range(3)]
+    cdef list by_sorting = [ref_vs_alt_ranksumtest(ref_base, alt_bases, sample_bases, info + k * size, size)
+                            for k in range(3)]
+
+    free(sample_bases)
+    free(info)
+    return by_histogram, by_sorting
@@ -0,0 +1,36 @@
+"""Harness of decoding reads from BAM/CRAM for benchmark_read_decoding.py
+"""
+import time
+
+from basevar.io.htslibWrapper cimport Samfile, ReadArena, ReadIterator, cAlignedRead, destroy_read
+
+
+def benchmark_read_decoding(filename, region, bint use_arena=True):
+    """Decode all the reads in ``region`` of ``filename`` and return (read number, seconds).
+
+    The reads are allocated in one ``ReadArena`` if ``use_arena`` is True, or each of them is
+    malloc-ed and then freed by ``destroy_read`` as what we did before.
+    """
+    cdef Samfile reader = Samfile(filename)
+    reader.open("r", True)
+
+    cdef ReadArena arena = ReadArena() if use_arena else None
+    cdef ReadIterator reader_iter = reader.fetch(region)
+    cdef cAlignedRead *the_read
+    cdef long int read_num = 0
+
+    start_time = time.time()
+    while reader_iter.cnext():
+        the_read = reader_iter.get(0, NULL, arena)
+        if the_read == NULL:
+            continue
+
+        read_num += 1
+        if arena is None:
+            destroy_read(the_read)
+
+    arena = None  # free all the reads in arena
+    elapsed = time.time() - start_time
+
+    reader.close()
+    return read_num, elapsed
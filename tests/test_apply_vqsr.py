@@ -0,0 +1,53 @@
+"""Test filtering VCF in chunks and the VQSLOD sidecar of ApplyVQSR
+"""
+import os
+import random
+import tempfile
+
+from basevar.caller.vqsr import vqsr
+from basevar.io.openfile import Open
+
+
+def test_filter_vcf_in_chunks():
+    random.seed(1)
+    lines = ["##fileformat=VCFv4.2", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+    expect = list(lines)
+    for i in range(5000):
+        vqslod = random.uniform(-5, 5)
+        lines.append("chr1\t%d\t.\tA\tC\t30\t.\tAC=1;VQSLOD=%.3f" % (i + 1, vqslod))
+        expect.append(lines[-1].replace("\t.\tAC", "\tPASS\tAC") if round(vqslod, 3) >= 0.5 else lines[-1])
+
+    outdir = tempfile.mkdtemp()
+    vcf_files = [os.path.join(outdir, "test.vcf"), os.path.join(outdir, "test.vcf.gz")]
+    for vcf_file in vcf_files:
+        # The BGZF one is split by its blocks
+        with Open(vcf_file, "w") as OUT:
+            OUT.write("\n".join(lines) + "\n")
+
+    # Small chunks for lines crossing them
+    vqsr.APPLY_CHUNK_BYTES = 1000
+    for vcf_file in vcf_files:
+        for nproc in [1, 3]:
+            results = list(vqsr._filter_vcf(vcf_file, 0.5, nproc))
+            assert "".join(t for t, _, _ in results) == "\n".join(expect) + "\n"
+            assert sum(n for _, n, _ in results) == 5000
+            assert sum(n for _, _, n in results) == sum(1 for l in expect if "\tPASS\t" in l)
+
+    print("Filter VCF in chunks done")
+
+
+def test_vqslod_sidecar():
+    vcf_file = os.path.join(tempfile.mkdtemp(), "test.vcf")
+    with open(vcf_file, "w") as OUT:
+        OUT.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+    vqsr.write_vqslod_sidecar(vcf_file + vqsr.VQSLOD_SUFFIX, [1.5, -2.0, 3.25],
+                              [vqsr.POSITIVE_TRAIN_FLAG, vqsr.NEGATIVE_TRAIN_FLAG,
+                               vqsr.POSITIVE_TRAIN_FLAG | vqsr.NEGATIVE_TRAIN_FLAG])
+    assert vqsr.load_training_vqslod(vcf_file) == ([1.5, 3.25], [-2.0, 3.25])
+    print("VQSLOD sidecar done")
+
+
+if __name__ == "__main__":
+    test_filter_vcf_in_chunks()
+    test_vqslod_sidecar()
@@ -0,0 +1,123 @@
+"""Test BaseType
+"""
+import random
+
+import pyxharness  # Build the harness by pyximport
+from basetype_harness import basetype_by_site, basetype_by_sites, group_basetype_by_site, prescreen_by_site
+
+
+def random_site(sample_size, alt_bases):
+    bases, quals = [], []
+    for _ in range(sample_size):
+        r = random.random()
+        if r < 0.02:
+            b = 'N'
+        elif r < 0.9:
+            b = 'A'
+        else:
+            b = random.choice(alt_bases)
+
+        bases.append(b)
+        quals.append(random.randint(2, 40))
+
+    return bases, quals
+
+
+def test_engine_vs_basetype(site_num=1000):
+    """``BaseTypeEngine`` must give the same result with ``BaseType.lrt``"""
+    random.seed(10)
+
+    variant_num = 0
+    for i in range(site_num):
+        bases, quals = random_site(random.randint(1, 300), random.choice(['C', 'CG', 'CGT', 'CGTT']))
+        min_af = random.choice([0.001, 0.01, 0.05])
+        comb = ['A', 'C', 'G'] if i % 5 == 0 else None
+
+        r1 = basetype_by_site('A', bases, quals, min_af, comb, use_engine=True)
+        r2 = basetype_by_site('A', bases, quals, min_af, comb, use_engine=False)
+        assert r1 == r2, "Different LRT result: %s vs %s" % (r1, r2)
+
+        if r1[0]:
+            variant_num += 1
+
+    print("%d sites, %d variants" % (site_num, variant_num))
+
+
+def test_compressed_likelihood(site_num=1000):
+    """EM over (base, quality) classes should give the same result with EM over samples"""
+    random.seed(20)
+
+    for i in range(site_num):
+        bases, quals = random_site(random.randint(1, 300), random.choice(['C', 'CG', 'CGT']))
+        quals = [random.choice([2, 10, 20, 30, 37, 40]) for _ in quals]
+        comb = ['A', 'C', 'G'] if i % 5 == 0 else None
+
+        r1 = basetype_by_site('A', bases, quals, 0.01, comb, compress=True)
+        r2 = basetype_by_site('A', bases, quals, 0.01, comb, compress=False)
+        assert r1 == r2, "Different LRT result: %s vs %s" % (r1, r2)
+
+    print("%d sites done" % site_num)
+
+
+def test_prescreen(site_num=5000):
+    """Pre-screen should never skip a variant"""
+    random.seed(30)
+
+    skip_num = 0
+    for i in range(site_num):
+        sample_size = random.randint(1, 200)
+        bases = ['A'] * sample_size
+        for _ in range(random.choice([0, 1, 1, 2, 3, 5])):
+            bases[random.randrange(sample_size)] = random.choice(['C', 'C', 'G', 'T'])
+
+        quals = [random.choice([0, 1, 2, 3, 5, 10, 20, 30, 40]) for _ in bases]
+        min_af = random.choice([0.001, 0.01, 0.05])
+
+        is_skip = prescreen_by_site('A', bases, quals, min_af)
+        is_variant = basetype_by_site('A', bases, quals, min_af, use_engine=False)[0]
+        assert not (is_skip and is_variant), "Skip a variant: %s %s" % (bases, quals)
+
+        if is_skip:
+            skip_num += 1
+
+    print("%d sites, %d skipped by pre-screen" % (site_num, skip_num))
+
+
+def test_thread_calling(site_num=200, thread_num=4):
+    """Calling by threads should give the same result in the same order"""
+    random.seed(40)
+
+    sites = [random_site(random.randint(1, 2000), random.choice(['C', 'CG', 'CGT'])) for _ in range(site_num)]
+    r1 = basetype_by_sites('A', sites, 0.001, thread_num=1)
+    r2 = basetype_by_sites('A', sites, 0.001, thread_num=thread_num)
+    assert r1 == r2, "Different result by %d threads" % thread_num
+
+    print("%d sites, %d threads done" % (site_num, thread_num))
+
+
+def test_group_basetype(site_num=500, group_num=5):
+    """Gather all the population groups in one pass should be the same as group by group"""
+    random.seed(50)
+
+    for _ in range(site_num):
+        bases, quals = random_site(random.randint(1, 500), random.choice(['C', 'CG', 'CGT']))
+        popgroup = {}
+        for i in range(len(bases)):
+            g = random.randint(0, group_num)  # group_num means not in any group
+            if g < group_num:
+                popgroup.setdefault('G%d_AF' % g, []).append(i)
+
+        comb = random.choice([['A', 'C'], ['A', 'C', 'G'], ['A', 'G', 'T']])
+        r1 = group_basetype_by_site('A', bases, quals, 0.001, popgroup, comb, one_pass=True)
+        r2 = group_basetype_by_site('A', bases, quals, 0.001, popgroup, comb, one_pass=False)
+        assert r1 == r2, "Different group LRT result: %s vs %s" % (r1, r2)
+
+    print("%d sites with %d groups done" % (site_num, group_num))
+
+
+if __name__ == "__main__":
+    test_engine_vs_basetype()
+    test_compressed_likelihood()
+    test_prescreen()
+    test_thread_calling()
+    test_group_basetype()
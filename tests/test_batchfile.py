@@ -0,0 +1,122 @@
+"""Test binary batchfile
+"""
+import os
+import random
+import tempfile
+
+from basevar.io.batchfile import INDEX_SUFFIX, convert_text_to_batchfile, convert_batchfile_to_text, \
+    merge_batchfiles
+
+HEADER = ["#CHROM", "POS", "REF", "Depth(CoveredSample)", "MappingQuality", "Readbases",
+          "ReadbasesQuality", "ReadPositionRank", "Strand"]
+
+
+def random_text_batchfile(filename, sample_ids, positions, ref_bases=None, chrom="chr1"):
+    """Create a text batchfile (BaseVarBatchFile_v1.0) and return its records."""
+    records = []
+    with open(filename, "w") as OUT:
+        OUT.write("##fileformat=BaseVarBatchFile_v1.0\n")
+        OUT.write("##SampleIDs=%s\n" % ",".join(sample_ids))
+        OUT.write("%s\n" % "\t".join(HEADER))
+
+        for i, pos in enumerate(positions):
+            ref = ref_bases[i] if ref_bases else random.choice("ACGT")
+            if random.random() < 0.2:
+                col = [chrom, str(pos), ref, "0", ".", ".", ".", ".", "."]
+            else:
+                mapqs, bases, quals, ranks, strands = [], [], [], [], []
+                depth = 0
+                for _ in sample_ids:
+                    b = random.choice(["A", "C", "G", "T", "N", "N", "+AT", "-G", "ACG"])
+                    if b[0] not in "+-" and b != "N":
+                        depth += 1
+
+                    mapqs.append(str(random.randint(0, 60)))
+                    bases.append(b)
+                    quals.append(str(random.randint(0, 41)))
+                    ranks.append(str(random.randint(0, 150)))
+                    strands.append(random.choice("+-."))
+
+                col = [chrom, str(pos), ref, str(max(depth, 1))] + \
+                      [",".join(c) for c in [mapqs, bases, quals, ranks, strands]]
+
+            OUT.write("%s\n" % "\t".join(col))
+            records.append(col)
+
+    return records
+
+
+def read_text_batchfile(filename):
+    with open(filename) as I:
+        return [line.strip().split("\t") for line in I]
+
+
+def test_text_round_trip(position_num=3000):
+    """Text => binary => text must keep all the information"""
+    random.seed(10)
+    tmpdir = tempfile.mkdtemp()
+
+    text_file = os.path.join(tmpdir, "a.batch")
+    bin_file = os.path.join(tmpdir, "a.batch.bvb")
+    out_file = os.path.join(tmpdir, "a.out.batch")
+
+    random_text_batchfile(text_file, ["S%d" % i for i in range(17)], range(1000, 1000 + position_num))
+    convert_text_to_batchfile(text_file, bin_file)
+    convert_batchfile_to_text(bin_file, out_file)
+
+    assert os.path.exists(bin_file + INDEX_SUFFIX), "Missing index of %s" % bin_file
+    assert read_text_batchfile(text_file) == read_text_batchfile(out_file), "Different after round trip"
+    print("Round trip of %d positions done, text: %d bytes, binary: %d bytes" % (
+        position_num, os.path.getsize(text_file), os.path.getsize(bin_file)))
+
+
+def test_merge(position_num=2000, batch_num=4):
+    """Merging binary batchfiles must be the same as putting all the samples in one text batchfile"""
+    random.seed(20)
+    tmpdir = tempfile.mkdtemp()
+
+    positions = range(1, position_num + 1)
+    ref_bases = [random.choice("ACGT") for _ in positions]
+    bin_files, all_records, sample_nums, sample_ids = [], [], [], []
+    for k in range(batch_num):
+        ids = ["B%d_S%d" % (k, i) for i in range(random.randint(1, 10))]
+        text_file = os.path.join(tmpdir, "b%d.batch" % k)
+        all_records.append(random_text_batchfile(text_file, ids, positions, ref_bases=ref_bases))
+
+        bin_file = text_file + ".bvb"
+        convert_text_to_batchfile(text_file, bin_file)
+        bin_files.append(bin_file)
+        sample_nums.append(len(ids))
+        sample_ids.extend(ids)
+
+    merged_file = os.path.join(tmpdir, "merged.bvb")
+    merged_text = os.path.join(tmpdir, "merged.batch")
+    merge_batchfiles(bin_files, merged_file, is_del_raw_file=True)
+    convert_batchfile_to_text(merged_file, merged_text)
+
+    expected = []
+    for records in zip(*all_records):
+        depth = sum([int(r[3]) for r in records])
+        if depth == 0:
+            expected.append(records[0][:3] + ["0", ".", ".", ".", ".", "."])
+            continue
+
+        columns = [[] for _ in range(5)]
+        for r, n in zip(records, sample_nums):
+            # The samples of a batch without any coverage are empty
+            values = r[4:9] if r[3] != "0" else [",".join([v] * n) for v in ["0", "N", "0", "0", "."]]
+            for c in range(5):
+                columns[c].append(values[c])
+
+        expected.append(records[0][:3] + [str(depth)] + [",".join(c) for c in columns])
+
+    lines = read_text_batchfile(merged_text)
+    assert lines[1] == ["##SampleIDs=%s" % ",".join(sample_ids)], "Different sample ids after merging"
+    assert lines[3:] == expected, "Different records after merging"
+    assert not any([os.path.exists(f) for f in bin_files]), "Raw batchfiles are not deleted"
+    print("Merge %d batchfiles of %d samples done" % (batch_num, len(sample_ids)))
+
+
+if __name__ == "__main__":
+    test_text_round_trip()
+    test_merge()
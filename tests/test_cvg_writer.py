@@ -0,0 +1,14 @@
+"""Test the CVG record encoder
+"""
+import pyxharness  # Build the harness by pyximport
+from cvg_harness import benchmark
+
+
+def test_cvg_writer(position_num=2000, sample_num=100):
+    """``CVGWriter`` must output the same records as the Python formatter"""
+    benchmark(position_num=position_num, sample_num=sample_num)
+    print("CVG records of %d positions and %d samples done" % (position_num, sample_num))
+
+
+if __name__ == "__main__":
+    test_cvg_writer()
@@ -0,0 +1,61 @@
+"""Test the memory-mapped and 2-bit packed access of FastaFile
+"""
+import os
+import random
+import tempfile
+
+from basevar.io.fasta import pack_reference, compare_reference_access, is_packed_reference_updated
+
+
+def write_fasta(fastafile, sequences, line_length=60):
+    """Write the FASTA file and its .fai index"""
+    offset = 0
+    with open(fastafile, "w") as OUT, open(fastafile + ".fai", "w") as IDX:
+        for name, seq in sequences:
+            header = ">%s test\n" % name
+            OUT.write(header)
+            offset += len(header)
+
+            IDX.write("%s\t%d\t%d\t%d\t%d\n" % (name, len(seq), offset, line_length, line_length + 1))
+            for i in range(0, len(seq), line_length):
+                line = seq[i:i + line_length] + "\n"
+                OUT.write(line)
+                offset += len(line)
+
+
+def random_sequence(length):
+    """Mix the uppercase, lowercase, N and IUPAC bases in runs"""
+    seq = ""
+    while len(seq) < length:
+        n = random.randint(1, 50)
+        r = random.random()
+        if r < 0.6:
+            seq += "".join([random.choice("ACGT") for _ in range(n)])
+        elif r < 0.8:
+            seq += "".join([random.choice("acgt") for _ in range(n)])
+        elif r < 0.95:
+            seq += random.choice("Nn") * n
+        else:
+            seq += "".join([random.choice("RYMK") for _ in range(n)])
+
+    return seq[:length]
+
+
+def test_reference_access():
+    random.seed(10)
+    fastafile = os.path.join(tempfile.mkdtemp(), "ref.fa")
+    write_fasta(fastafile, [("chr%d" % i, random_sequence(length))
+                            for i, length in enumerate([1, 7, 60, 61, 1000, 12345])])
+
+    assert not is_packed_reference_updated(fastafile)
+    pack_reference(fastafile, chunk_size=64)
+    assert is_packed_reference_updated(fastafile)
+
+    for access in ["mmap", "2bit"]:
+        diff_num = compare_reference_access(fastafile, access)
+        assert diff_num == 0, "%d different queries by %s access" % (diff_num, access)
+    print("FastaFile access done")
+
+
+if __name__ == "__main__":
+    test_reference_access()
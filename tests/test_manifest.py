@@ -0,0 +1,46 @@
+"""Test the checkpoint manifest of windows
+"""
+import argparse
+import os
+import tempfile
+
+from basevar.caller.manifest import WindowManifest, file_md5, parameter_hash
+
+
+def test_resume():
+    """Only the windows which are done and not changed could be skipped by a rerun"""
+    tmpdir = tempfile.mkdtemp()
+    manifest_file = os.path.join(tmpdir, "out.cvg.gz.manifest")
+    options = argparse.Namespace(window_size=100, mapq=10, nCPU=4)
+    param_hash = parameter_hash(options, ["a.bam", "b.bam"])
+
+    manifest = WindowManifest(manifest_file, param_hash)
+    for i in range(4):
+        cvg_file = os.path.join(tmpdir, "out.cvg.gz.window_%d" % i)
+        with open(cvg_file, "w") as OUT:
+            OUT.write("window %d\n" % i)
+
+        if i != 2:
+            manifest.add(i, [["chr1", i * 100 + 1, i * 100 + 100]], cvg_file, file_md5(cvg_file))
+    manifest.close()
+
+    # Changing a file of the window
+    with open(os.path.join(tmpdir, "out.cvg.gz.window_3"), "a") as OUT:
+        OUT.write("changed\n")
+
+    # The arguments for performance do not change the hash
+    options.nCPU = 8
+    manifest = WindowManifest(manifest_file, parameter_hash(options, ["a.bam", "b.bam"]), resume=True)
+    assert manifest.missing(4) == [2, 3], "Wrong windows to rerun: %s" % manifest.missing(4)
+    assert manifest.output_files() == ([os.path.join(tmpdir, "out.cvg.gz.window_%d" % i) for i in [0, 1]], [])
+    manifest.close()
+
+    options.mapq = 20
+    manifest = WindowManifest(manifest_file, parameter_hash(options, ["a.bam", "b.bam"]), resume=True)
+    assert manifest.missing(4) == [0, 1, 2, 3], "All the windows must be rerun with different parameters"
+    manifest.remove()
+    print("Resume by manifest done")
+
+
+if __name__ == "__main__":
+    test_resume()
@@ -0,0 +1,81 @@
+"""Test merging VCF/CVG files
+"""
+import gzip
+import os
+import random
+import shutil
+import tempfile
+
+from basevar.io.BGZF.tabix import TabixFile, tabix_index
+from basevar.io.openfile import Open
+from basevar.utils import concat_bgzf_files, merge_files
+
+
+def random_bgzf_file(filename, regions, tabix=False):
+    with Open(filename, "wb", isbgz=True, tabix=tabix) as OUT:
+        OUT.write("##fileformat=CVGv1.0\n")
+        OUT.write("#CHROM\tPOS\tREF\tDepth\n")
+        for chrom, start, end in regions:
+            for pos in range(start, end):
+                OUT.write("%s\t%d\t%s\t%d\n" % (chrom, pos, random.choice("ACGT"), random.randint(0, 1000)))
+
+    return
+
+
+def test_concat_bgzf_files():
+    """Concatenating BGZF blocks must be the same as merging line by line"""
+    random.seed(10)
+    tmpdir = tempfile.mkdtemp()
+
+    regions = [[("chr1", 1, 20000)], [("chr1", 20000, 50000), ("chr2", 1, 100)], [], [("chr3", 10, 30000)]]
+    sub_files = []
+    for i, r in enumerate(regions):
+        sub_files.append(os.path.join(tmpdir, "out.cvg.gz.temp_%d.gz" % i))
+        random_bgzf_file(sub_files[-1], r)
+
+    out1 = os.path.join(tmpdir, "concat.cvg.gz")
+    out2 = os.path.join(tmpdir, "merge.cvg.gz")
+    assert concat_bgzf_files(sub_files, out1), "Files in order must be concatenated"
+    merge_files(sub_files, out2)
+    assert gzip.open(out1).read() == gzip.open(out2).read(), "Different results of concat and merge"
+
+    # Not in order
+    assert not concat_bgzf_files(sub_files[::-1], out1), "Files not in order can't be concatenated"
+    print("Concatenate %d BGZF files done" % len(sub_files))
+
+
+def test_concat_tabix_indexes():
+    """The merged tabix index must find the same records as the one created by ``tabix_index``"""
+    random.seed(10)
+    tmpdir = tempfile.mkdtemp()
+
+    regions = [[("chr1", 1, 20000)], [("chr1", 20000, 50000), ("chr2", 1, 100)], [], [("chr2", 100, 101)],
+               [("chr3", 10, 30000)]]
+    sub_files = []
+    for i, r in enumerate(regions):
+        sub_files.append(os.path.join(tmpdir, "out.cvg.gz.temp_%d.gz" % i))
+        random_bgzf_file(sub_files[-1], r, tabix=True)
+
+    out1 = os.path.join(tmpdir, "concat.cvg.gz")
+    out2 = os.path.join(tmpdir, "index.cvg.gz")
+    assert concat_bgzf_files(sub_files, out1, is_del_raw_file=True, tabix=True)
+    assert not any([os.path.exists(f) or os.path.exists(f + ".tbi") for f in sub_files]), "Raw files are not deleted"
+
+    shutil.copy(out1, out2)
+    tabix_index(out2, force=True, seq_col=0, start_col=1, end_col=1)
+
+    tb1, tb2 = TabixFile(out1), TabixFile(out2)
+    assert tb1.contigs == tb2.contigs
+    for _ in range(1000):
+        chrom = random.choice(["chr1", "chr2", "chr3"])
+        start = random.randint(0, 50000)
+        end = start + random.choice([1, 100, 20000])
+        assert list(tb1.fetch(chrom, start, end)) == list(tb2.fetch(chrom, start, end)), \
+            "Different records in %s:%d-%d" % (chrom, start, end)
+
+    print("Concatenate tabix indexes of %d BGZF files done" % len(sub_files))
+
+
+if __name__ == "__main__":
+    test_concat_bgzf_files()
+    test_concat_tabix_indexes()
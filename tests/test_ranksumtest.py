@@ -0,0 +1,68 @@
+"""Test the counting-based rank sum tests against the sorting one and scipy
+"""
+import math
+import random
+
+from scipy.stats import mannwhitneyu
+
+import pyxharness  # Build the harness by pyximport
+from ranksum_harness import ranksumtests_by_site
+
+BASES = ["A", "C", "G", "T", "N", "+AT", "-C"]
+
+
+def random_site(sample_num, is_long_read=False):
+    ref_base = random.choice(BASES[:4])
+    alt_bases = random.sample([b for b in BASES[:4] if b != ref_base], random.randint(1, 3))
+    bases = [random.choice(BASES[:random.randint(2, len(BASES))]) for _ in range(sample_num)]
+    annotations = [[random.randint(0, 60) for _ in range(sample_num)],
+                   # Long reads are out of the range of histogram sometimes
+                   [random.randint(0, 2000 if is_long_read else 150) for _ in range(sample_num)],
+                   [random.randint(0, 41) for _ in range(sample_num)]]
+    return ref_base, alt_bases, bases, annotations
+
+
+def test_ranksumtests(site_num=2000, sample_num=500):
+    """The histogram must give the same result as sorting"""
+    random.seed(10)
+
+    max_diff = 0.0
+    for i in range(site_num):
+        ref_base, alt_bases, bases, annotations = random_site(sample_num, is_long_read=i % 10 == 0)
+        by_histogram, by_sorting = ranksumtests_by_site(ref_base, alt_bases, bases, *annotations)
+        max_diff = max([max_diff] + [abs(a - b) for a, b in zip(by_histogram, by_sorting)])
+
+    assert max_diff < 1e-6, "The rank sum tests are different from RankSumTest: %g" % max_diff
+    print("Rank sum tests of %d sites done, max difference: %g" % (site_num, max_diff))
+
+
+def test_tie_correction(site_num=200):
+    """The same as the tie-corrected Mann-Whitney U test of scipy without continuity correction"""
+    random.seed(20)
+
+    for i in range(site_num):
+        ref_base, alt_bases, bases, annotations = random_site(random.randint(2, 300), is_long_read=i % 10 == 0)
+        by_histogram, by_sorting = ranksumtests_by_site(ref_base, alt_bases, bases, *annotations)
+        for k, values in enumerate(annotations):
+            ref = [v for b, v in zip(bases, values) if b == ref_base]
+            alt = [v for b, v in zip(bases, values) if b in alt_bases]
+            if not ref or not alt:
+                assert by_histogram[k] == by_sorting[k] == -1.0
+                continue
+
+            if len(set(ref + alt)) == 1:
+                # scipy refuses all the same values, which is not significant at all
+                assert by_histogram[k] == by_sorting[k] == 0.0
+                continue
+
+            pvalue = mannwhitneyu(ref, alt, use_continuity=False, alternative="two-sided")[1]
+            expected = -10 * math.log10(pvalue) if 0 < pvalue < 1 else (0.0 if pvalue >= 1 else 10000.0)
+            assert abs(by_histogram[k] - expected) < 1e-6 and abs(by_sorting[k] - expected) < 1e-6, \
+                "Different from scipy: %s %s vs %s" % (by_histogram[k], by_sorting[k], expected)
+
+    print("Tie correction of %d sites done" % site_num)
+
+
+if __name__ == "__main__":
+    test_ranksumtests()
+    test_tie_correction()
@@ -0,0 +1,63 @@
+"""Test building tabix index while writing
+"""
+import gzip
+import os
+import random
+import shutil
+import tempfile
+
+from basevar.io.BGZF.bgzf import TabixBGZFile
+from basevar.io.BGZF.tabix import tabix_index
+
+
+def test_tabix_writer(line_num=200000, threads=0):
+    """The index must be the same as the one created by ``tabix_index``"""
+    random.seed(10)
+    tmpdir = tempfile.mkdtemp()
+
+    f1 = os.path.join(tmpdir, "a.cvg.gz")
+    f2 = os.path.join(tmpdir, "b.cvg.gz")
+    with TabixBGZFile(f1, "wb", seq_col=0, start_col=1, end_col=1, compress_level=4, threads=threads) as OUT:
+        OUT.write("##fileformat=CVGv1.0\n#CHROM\tPOS\tREF\tDepth\n")
+
+        # 3 chromosomes, the position starts from 1 on each of them
+        chrom_size = line_num // 3 + 1
+        pos = 0
+        for i in range(line_num):
+            chrom = "chr%d" % (1 + i // chrom_size)
+            pos = pos + random.randint(1, 100) if i % chrom_size else 1
+            line = "%s\t%d\t%s\t%d\n" % (chrom, pos, random.choice("ACGT"), random.randint(0, 1000))
+
+            # Lines may be written by pieces
+            k = random.randint(0, len(line))
+            OUT.write(line[:k])
+            OUT.write(line[k:])
+
+    shutil.copy(f1, f2)
+    tabix_index(f2, force=True, seq_col=0, start_col=1, end_col=1)
+
+    assert gzip.open(f1 + ".tbi").read() == gzip.open(f2 + ".tbi").read(), "Different tabix index"
+    print("Tabix index of %d lines by %d compression threads done" % (line_num, threads))
+
+
+def test_tabix_writer_edges():
+    """Files without any record or without the last '\\n'"""
+    tmpdir = tempfile.mkdtemp()
+    header = "##fileformat=CVGv1.0\n#CHROM\tPOS\tREF\tDepth\n"
+    for i, text in enumerate([header, header + "chr1\t1\tA\t10\nchr1\t5\tC\t3", "chr2\t10\tG\t1"]):
+        for threads in [0, 4]:
+            f1 = os.path.join(tmpdir, "a%d_%d.cvg.gz" % (i, threads))
+            f2 = os.path.join(tmpdir, "b%d_%d.cvg.gz" % (i, threads))
+            with TabixBGZFile(f1, "wb", seq_col=0, start_col=1, end_col=1, threads=threads) as OUT:
+                OUT.write(text)
+
+            shutil.copy(f1, f2)
+            tabix_index(f2, force=True, seq_col=0, start_col=1, end_col=1)
+            assert gzip.open(f1 + ".tbi").read() == gzip.open(f2 + ".tbi").read(), \
+                "Different tabix index of %r by %d threads" % (text, threads)
+
+
+if __name__ == "__main__":
+    test_tabix_writer()
+    test_tabix_writer(threads=4)
+    test_tabix_writer_edges()
@@ -0,0 +1,20 @@
+"""Test the calling stage of BaseType
+"""
+import pyxharness  # Build the harness by pyximport
+from calling_harness import calling
+
+
+def test_calling_threads(position_num=500, sample_num=200):
+    """The threads must output the same records as one thread"""
+    cvg, vcf, _ = calling(position_num=position_num, sample_num=sample_num, thread_num=1)
+    assert vcf.count(b"\n") > 0 and cvg.count(b"\n") == position_num
+
+    for thread_num in [2, 4]:
+        assert calling(position_num=position_num, sample_num=sample_num, thread_num=thread_num)[:2] == (cvg, vcf)
+
+    print("Calling %d positions of %d samples by threads done, %d variants" % (
+        position_num, sample_num, vcf.count(b"\n")))
+
+
+if __name__ == "__main__":
+    test_calling_threads()
@@ -0,0 +1,53 @@
+"""Test loading the annotations of VQSR
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from basevar.caller.vqsr.variant_data_manager import load_data_set, OnlineMoments, ReservoirSample
+
+
+def test_load_data_set():
+    records = [
+        "chr1\t100\t.\tA\tC\t30\t.\tQD=10.5;FS=3.012;BaseQRankSum=nan;SOR=0.7;MQRankSum=-1.2;ReadPosRankSum=0.3",
+        "chr1\t200\t.\tN\tC\t30\t.\tQD=1;FS=1;BaseQRankSum=1;SOR=1;MQRankSum=1;ReadPosRankSum=1",  # N REF
+        "chr1\t300\t.\tG\tT\t30\t.\tQD=2;FS=4;BaseQRankSum=1;SOR=1;ReadPosRankSum=1",  # Missing MQRankSum
+        "chr2\t400\t.\tT\tA\t30\t.\tDB;ReadPosRankSum=6;MQRankSum=5;SOR=4;BaseQRankSum=3;FS=10001.0;QD=1.0004",
+    ]
+    header = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+    vcf_file = os.path.join(tempfile.mkdtemp(), "test.vcf")
+    with open(vcf_file, "w") as OUT:
+        OUT.write(header + "\n".join(records) + "\n")
+
+    h_info, data_set = load_data_set(vcf_file, set(["chr2:400"]))
+    assert len(data_set) == 2
+    assert data_set.annotations.tolist() == [[10.5, 3.012, 10000, 0.7, -1.2, 0.3],
+                                             [1.0, 10000, 3, 4, 5, 6]], data_set.annotations
+    assert data_set.at_training_site.tolist() == [False, True]
+
+    with open(vcf_file) as I:
+        raw = I.read()
+    assert [raw[o:].split("\n")[0] for o in data_set.offsets] == [records[0], records[3]]
+    print("Load data set done")
+
+
+def test_streaming_statistics():
+    rng = np.random.RandomState(10)
+    data = rng.normal(5, 3, (10000, 6))
+
+    moments = OnlineMoments(6)
+    sample = ReservoirSample(100, 6, rng)
+    for i in range(0, len(data), 999):
+        moments.update(data[i:i + 999])
+        sample.add(data[i:i + 999], np.zeros(len(data[i:i + 999]), dtype=bool))
+
+    assert np.allclose(moments.mean, data.mean(axis=0)) and np.allclose(moments.std, data.std(axis=0))
+    assert sample.seen == len(data) and len(sample.to_data_set()) == 100
+    assert len(set(map(tuple, sample.annotations))) == 100, "The sample must be drawn without replacement"
+    print("Streaming statistics done")
+
+
+if __name__ == "__main__":
+    test_load_data_set()
+    test_streaming_statistics()
@@ -0,0 +1,79 @@
+"""Test evaluating the variants of VQSR in chunks
+"""
+import math
+
+import numpy as np
+from scipy.special import logsumexp
+from sklearn.mixture import GaussianMixture
+
+from basevar.caller.vqsr.variant_datum import VariantDataSet
+from basevar.caller.vqsr.variant_recalibrator_argument_collection import VariantRecalibratorArgumentCollection
+from basevar.caller.vqsr.variant_recalibrator_engine import VariantRecalibratorEngine
+
+
+def lod_by_datum(data, gmm, evaluate_contrastively=False):
+    """VQSLOD of each variant by itself"""
+    lod = data.lod.copy()
+    for i in range(len(data)):
+        this_lod = gmm.score(data.annotations[i][np.newaxis, :]) / np.log(10)
+        lod[i] = data.prior + lod[i] - this_lod if evaluate_contrastively else this_lod
+
+    return lod
+
+
+def datum_in_one_dimension(gmm, annotations, k):
+    """log10(Sum(pi_j * p(v|n,j))) of the ``k``th annotation of a variant"""
+    p = []
+    for j, w in enumerate(gmm.weights_):
+        sigma = gmm.covariances_[j][k][k]
+        p.append(math.log(w) - (math.log(sigma) + 0.5 * math.log(2 * math.pi)) -
+                 0.5 * ((annotations[k] - gmm.means_[j][k]) / sigma) ** 2)
+
+    return logsumexp(p) / np.log(10)
+
+
+def worst_annotation_by_datum(data, good_model, bad_model):
+    worst = []
+    for annotations in data.annotations:
+        prob_diff = [datum_in_one_dimension(good_model, annotations, k) -
+                     datum_in_one_dimension(bad_model, annotations, k) for k in range(len(annotations))]
+        worst.append(np.argsort(prob_diff)[0])
+
+    return np.array(worst)
+
+
+def test_evaluate_in_chunks(variant_num=503):
+    rng = np.random.RandomState(10)
+    good_model = GaussianMixture(3, covariance_type="full", random_state=10).fit(
+        np.concatenate([rng.normal(0, 1, (2000, 6)), rng.normal(2, 0.5, (500, 6))]))
+    bad_model = GaussianMixture(2, covariance_type="full", random_state=10).fit(rng.normal(-1, 2, (1000, 6)))
+
+    annotations = rng.normal(0, 1.5, (variant_num, 6))
+    expect = VariantDataSet(annotations, np.zeros(variant_num, dtype=bool), np.arange(variant_num))
+    good_lod = lod_by_datum(expect, good_model)
+    expect.lod = good_lod
+    lod = lod_by_datum(expect, bad_model, evaluate_contrastively=True)
+    worst_annotation = worst_annotation_by_datum(expect, good_model, bad_model)
+
+    # 7 and 100 don't divide the number of variants, 1000 is larger than it
+    for chunk_size in [1, 7, 100, variant_num, 1000]:
+        vrac = VariantRecalibratorArgumentCollection()
+        vrac.EVALUATE_CHUNK_SIZE = chunk_size
+        engine = VariantRecalibratorEngine(vrac)
+
+        data = VariantDataSet(annotations, np.zeros(variant_num, dtype=bool), np.arange(variant_num))
+        engine.evaluate_data(data, good_model)
+        assert np.allclose(data.lod, good_lod), "Different LOD of the good model in chunks of %d" % chunk_size
+
+        engine.evaluate_data(data, bad_model, evaluate_contrastively=True)
+        assert np.allclose(data.lod, lod), "Different VQSLOD in chunks of %d" % chunk_size
+
+        engine.calculate_worst_performing_annotation(data, good_model, bad_model)
+        assert (data.worst_annotation == worst_annotation).all(), \
+            "Different worst annotations in chunks of %d" % chunk_size
+
+    print("Evaluating %d variants in chunks done" % variant_num)
+
+
+if __name__ == "__main__":
+    test_evaluate_in_chunks()
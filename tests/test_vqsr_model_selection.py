@@ -0,0 +1,30 @@
+"""Test selecting the GMM of VQSR in parallel
+"""
+import numpy as np
+
+from basevar.caller.vqsr.variant_recalibrator_argument_collection import VariantRecalibratorArgumentCollection
+from basevar.caller.vqsr.variant_recalibrator_engine import VariantRecalibratorEngine
+
+
+def fit(data, nproc, subsample=0):
+    vrac = VariantRecalibratorArgumentCollection()
+    vrac.NINIT = 2
+    vrac.NPROC = nproc
+    vrac.SELECTION_SUBSAMPLE = subsample
+    vrac.SEED = 10
+
+    gmm = VariantRecalibratorEngine(vrac).generate_model(data, 4)
+    return gmm.n_components, gmm.bic(data)
+
+
+def test_parallel_model_selection():
+    rng = np.random.RandomState(1)
+    data = np.concatenate([rng.normal(-2, 1, (3000, 6)), rng.normal(3, 0.5, (1000, 6))])
+
+    assert fit(data, 1) == fit(data, 4), "The parallel model selection is different from the serial one"
+    assert fit(data, 1, subsample=1000) == fit(data, 4, subsample=1000)
+    print("Parallel model selection done")
+
+
+if __name__ == "__main__":
+    test_parallel_model_selection()
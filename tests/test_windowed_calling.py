@@ -0,0 +1,80 @@
+"""Test that calling in windows outputs the same records as calling the whole regions at once
+"""
+import gzip
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from test_fasta_access import write_fasta
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "140k_thalassemia_brca_bam")
+regions = "chr11:5246595-5247400,chr11:5247600-5248428"
+
+
+def write_reference(fastafile, chrom="chr11", start=5246595, end=5248428, flank=1000):
+    """Random bases around ``start`` - ``end`` and N elsewhere"""
+    random.seed(10)
+    seq = "N" * (start - flank) + "".join([random.choice("ACGT") for _ in range(end - start + 2 * flank)])
+    write_fasta(fastafile, [(chrom, seq)])
+
+
+def basetype(outdir, prefix, *args):
+    """Run basetype on the test BAMs and return the (CVG, VCF) records"""
+    with open(os.path.join(data_dir, "bam100.list")) as I:
+        bamfiles = [os.path.join(data_dir, line.strip()) for line in I if line.strip()]
+
+    bamlist = os.path.join(outdir, "bam.list")
+    with open(bamlist, "w") as OUT:
+        OUT.write("\n".join(bamfiles) + "\n")
+
+    outcvg = os.path.join(outdir, prefix + ".cvg.gz")
+    outvcf = os.path.join(outdir, prefix + ".vcf.gz")
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         env.get("PYTHONPATH", "")])
+    subprocess.check_call([sys.executable, "-c", "from basevar.runner import main; main()", "basetype",
+                           "-L", bamlist, "-R", os.path.join(outdir, "ref.fa"), "--regions", regions,
+                           "--batch-count", "10", "--output-cvg", outcvg, "--output-vcf", outvcf,
+                           "--pop-group", os.path.join(data_dir, "sample_group.info")] + list(args),
+                          cwd=outdir, env=env)
+
+    records = []
+    for fname in [outcvg, outvcf]:
+        with gzip.open(fname) as I:
+            records.append([line for line in I if not line.startswith(b"##")])
+
+    return records
+
+
+def test_memory_budget():
+    """The windows of ``--memory-budget`` must not lose the reads at their edges"""
+    outdir = tempfile.mkdtemp()
+    write_reference(os.path.join(outdir, "ref.fa"))
+
+    cvg, vcf = basetype(outdir, "whole", "--without-batchfile")
+    assert len(cvg) > 1 and len(vcf) > 1
+
+    # 1M budget splits the regions into windows of several hundred positions
+    assert basetype(outdir, "budget", "--without-batchfile", "--memory-budget", "1") == [cvg, vcf]
+    print("Calling by memory budget done, %d positions" % (len(cvg) - 1))
+
+
+def test_window_size():
+    """The windows of ``--window-size`` must not lose the reads at their edges"""
+    outdir = tempfile.mkdtemp()
+    write_reference(os.path.join(outdir, "ref.fa"))
+
+    cvg, vcf = basetype(outdir, "whole", "--window-size", "0")
+    assert len(cvg) > 1 and len(vcf) > 1
+
+    # 300 doesn't divide the regions, so the last window of each region is a short one
+    assert basetype(outdir, "window", "--window-size", "300", "--nCPU", "2") == [cvg, vcf]
+    print("Calling by windows done, %d positions" % (len(cvg) - 1))
+
+
+if __name__ == "__main__":
+    test_memory_budget()
+    test_window_size()